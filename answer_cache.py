@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def answer_cache_path(database):
+    """
+    :param database: The path of the SQLite document database.
+    :return: The path of the answer cache kept next to it, shared by every process serving that database.
+    """
+    return os.path.splitext(database)[0] + '_answers.db'
+
+
+def hits_fingerprint(hits):
+    """
+    :param hits: A list of hit dictionaries with 'id' and 'content' keys.
+    :return: A digest of the retrieved chunks and their text, independent of their order, so a
+        cached answer is only reused when it was generated from the same evidence.
+    """
+    chunks = sorted(
+        (hit['id'], hashlib.sha256(hit['content'].encode('utf-8')).hexdigest()) for hit in hits if hit.get('content')
+    )
+    return hashlib.sha256(json.dumps(chunks).encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """
+    A persistent cache of generated answers, looked up by the meaning of the question.
+
+    An answer is reused for a new question when the cosine similarity of their embeddings
+    reaches threshold, the generation parameters are the same, and retrieval for the new
+    question returned the same chunks with the same text. Entries expire after ttl seconds,
+    the least recently used entries are evicted beyond max_entries, and ChromaDBManager drops
+    the entries built on a source when it deletes, re-ingests or renames that source.
+
+    The embeddings of all live entries are kept in memory as one normalized matrix, so a
+    lookup is a single matrix-vector product. Lookups only read: the recency of hits is kept
+    in memory and written in batches, and expired entries are dropped when answers are stored.
+    """
+
+    def __init__(self, db_path='answer_cache.db', threshold=0.95, ttl=7 * 24 * 3600, max_entries=10000,
+                 recency_flush_interval=60.0, recency_flush_size=256):
+        """
+        :param db_path: The SQLite file holding the cache.
+        :param threshold: The minimum cosine similarity between two questions to share an answer.
+        :param ttl: The number of seconds an answer stays valid, or None to keep answers forever.
+        :param max_entries: The maximum number of cached answers.
+        :param recency_flush_interval: The number of seconds hits may go without their recency
+            being written, which only affects which entries are evicted first.
+        :param recency_flush_size: The number of hit entries that triggers writing their recency.
+        """
+        import numpy as np
+
+        self.np = np
+        self.db_path = db_path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.recency_flush_interval = recency_flush_interval
+        self.recency_flush_size = recency_flush_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS answers (
+            ID INTEGER PRIMARY KEY,
+            Query TEXT,
+            Embedding BLOB,
+            Params TEXT,
+            Fingerprint TEXT,
+            Answer TEXT,
+            Hits TEXT,
+            CreatedAt REAL,
+            LastUsed REAL
+        )
+        ''')
+        # Serves invalidation by source
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS answer_sources (
+            Source TEXT,
+            AnswerID INTEGER,
+            PRIMARY KEY (Source, AnswerID)
+        )
+        ''')
+        self.conn.commit()
+        self._ids = None
+        self._matrix = None
+        self._touched = {}
+        self._last_flush = time.monotonic()
+
+    def _load(self):
+        # Built on first use from every stored entry
+        if self._ids is None:
+            np = self.np
+            rows = self.conn.execute('SELECT ID, Embedding FROM answers').fetchall()
+            self._ids = [row[0] for row in rows]
+            self._matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) if rows else None
+
+    def _normalize(self, embedding):
+        vector = self.np.asarray(embedding, dtype=self.np.float32)
+        return vector / max(float(self.np.linalg.norm(vector)), 1e-12)
+
+    def _delete(self, ids):
+        ids = set(ids)
+        if not ids:
+            return
+        self.conn.executemany('DELETE FROM answers WHERE ID = ?', [(id_,) for id_ in ids])
+        self.conn.executemany('DELETE FROM answer_sources WHERE AnswerID = ?', [(id_,) for id_ in ids])
+        if self._ids is not None:
+            keep = [i for i, id_ in enumerate(self._ids) if id_ not in ids]
+            self._ids = [self._ids[i] for i in keep]
+            self._matrix = self._matrix[keep] if keep else None
+
+    def _flush_recency(self):
+        if self._touched:
+            self.conn.executemany(
+                'UPDATE answers SET LastUsed = ? WHERE ID = ?',
+                [(last_used, id_) for id_, last_used in self._touched.items()],
+            )
+            self.conn.commit()
+            self._touched = {}
+        self._last_flush = time.monotonic()
+
+    def _expire(self, now):
+        if self.ttl is None:
+            return
+        rows = self.conn.execute('SELECT ID FROM answers WHERE CreatedAt < ?', (now - self.ttl,)).fetchall()
+        self._delete(row[0] for row in rows)
+
+    def lookup(self, embedding, params, hits):
+        """
+        :param embedding: The embedding of the question.
+        :param params: A JSON-serializable value of the generation parameters.
+        :param hits: The hits retrieved for the question.
+        :return: A (answer, hits) tuple of the cached answer and the hits stored with it, or None.
+        """
+        params = json.dumps(params, sort_keys=True)
+        fingerprint = hits_fingerprint(hits)
+        with self._lock:
+            now = time.time()
+            # Expired entries are skipped here and deleted by put
+            created_after = now - self.ttl if self.ttl is not None else float('-inf')
+            self._load()
+            query = self._normalize(embedding)
+            if self._matrix is None or self._matrix.shape[1] != len(query):
+                self.misses += 1
+                return None
+            similarities = self._matrix @ query
+            # Paraphrases are tried from the most similar down
+            for i in self.np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+                # Rows invalidated by another process are gone from the table but not from the matrix
+                row = self.conn.execute(
+                    'SELECT Answer, Hits FROM answers WHERE ID = ? AND Params = ? AND Fingerprint = ? AND CreatedAt >= ?',
+                    (self._ids[i], params, fingerprint, created_after),
+                ).fetchone()
+                if row is not None:
+                    self._touched[self._ids[i]] = now
+                    if (len(self._touched) >= self.recency_flush_size
+                            or time.monotonic() - self._last_flush >= self.recency_flush_interval):
+                        self._flush_recency()
+                    self.hits += 1
+                    return row[0], json.loads(row[1])
+            self.misses += 1
+            return None
+
+    def put(self, query, embedding, params, hits, answer, sources=None):
+        """
+        Store a generated answer.
+
+        :param query: The question, kept for inspection.
+        :param embedding: The embedding of the question.
+        :param params: A JSON-serializable value of the generation parameters.
+        :param hits: The hits retrieved for the question.
+        :param answer: The generated answer.
+        :param sources: The hits to return with the answer, e.g. the spans that made it into the
+            prompt. Their 'id', 'source', 'page' and 'score' keys are stored. Defaults to hits.
+        """
+        vector = self._normalize(embedding)
+        stored_hits = [
+            {'id': hit['id'], 'source': hit['source'], 'page': hit['page'], 'score': hit['score']}
+            for hit in (hits if sources is None else sources)
+        ]
+        with self._lock:
+            now = time.time()
+            # Eviction below picks the least recently used entries
+            self._flush_recency()
+            self._load()
+            if self._matrix is not None and self._matrix.shape[1] != len(vector):
+                # The embedding model changed, earlier questions can no longer be compared
+                self._delete(list(self._ids))
+            cursor = self.conn.execute(
+                '''
+                INSERT INTO answers (Query, Embedding, Params, Fingerprint, Answer, Hits, CreatedAt, LastUsed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''',
+                (query, vector.tobytes(), json.dumps(params, sort_keys=True), hits_fingerprint(hits), answer,
+                 json.dumps(stored_hits), now, now),
+            )
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO answer_sources (Source, AnswerID) VALUES (?, ?)',
+                [(source, cursor.lastrowid) for source in {hit['source'] for hit in hits}],
+            )
+            self._ids.append(cursor.lastrowid)
+            self._matrix = vector[None, :] if self._matrix is None else self.np.vstack([self._matrix, vector])
+
+            self._expire(now)
+            excess = len(self._ids) - self.max_entries
+            if excess > 0:
+                rows = self.conn.execute('SELECT ID FROM answers ORDER BY LastUsed LIMIT ?', (excess,)).fetchall()
+                self._delete(row[0] for row in rows)
+            self.conn.commit()
+
+    def invalidate_sources(self, sources):
+        """
+        Drop every answer generated from chunks of the given sources.
+
+        :param sources: A list of sources.
+        :return: The number of dropped answers.
+        """
+        with self._lock:
+            ids = set()
+            for source in sources:
+                ids.update(row[0] for row in self.conn.execute(
+                    'SELECT AnswerID FROM answer_sources WHERE Source = ?', (source,)
+                ))
+            self._delete(ids)
+            self.conn.commit()
+            return len(ids)
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute('DELETE FROM answers')
+            self.conn.execute('DELETE FROM answer_sources')
+            self.conn.commit()
+            self._ids = []
+            self._matrix = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_recency()
+        self.conn.close()
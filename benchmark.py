@@ -0,0 +1,1143 @@
+import json
+import os
+import random
+import string
+import tempfile
+import time
+
+import fire
+
+
+def make_documents(num_chunks, chunk_size=2000, chunks_per_page=2, seed=0):
+    """
+    Build a synthetic corpus of Document chunks shaped like the output of PDFProcessor.
+
+    :param num_chunks: The number of chunks to generate.
+    :param chunk_size: The number of characters in each chunk.
+    :param chunks_per_page: The number of chunks that share a page number.
+    :param seed: The random seed, so that repeated runs build the same corpus.
+    :return: A list of Document objects.
+    """
+    from langchain.schema import Document
+
+    rng = random.Random(seed)
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10))) for _ in range(5000)]
+    documents = []
+    for i in range(num_chunks):
+        text = ''
+        while len(text) < chunk_size:
+            text += rng.choice(words) + ' '
+        page = i // chunks_per_page
+        source = f"/corpus/paper_{page // 10:06d}.pdf"
+        documents.append(Document(page_content=text[:chunk_size], metadata={'source': source, 'page': page % 10}))
+    return documents
+
+
+def benchmark_ingest(sizes=(5000, 10000, 20000, 40000), chunk_size=2000):
+    """
+    Time SQLiteDBManager.insert_documents on growing corpora, first into an empty database
+    and then re-ingesting the same corpus, which exercises the duplicate check on every chunk.
+    Per-chunk times that stay flat as the corpus grows mean ingest time grows linearly.
+
+    :param sizes: The corpus sizes, in chunks, to benchmark.
+    :param chunk_size: The number of characters in each chunk.
+    """
+    from database import SQLiteDBManager
+
+    print(f"{'chunks':>10} {'ingest s':>10} {'us/chunk':>10} {'re-ingest s':>12} {'us/chunk':>10}")
+    for size in sizes:
+        documents = make_documents(size, chunk_size=chunk_size)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manager = SQLiteDBManager(os.path.join(tmp_dir, 'bench.db'))
+
+            start = time.perf_counter()
+            manager.insert_documents(documents)
+            ingest = time.perf_counter() - start
+
+            start = time.perf_counter()
+            manager.insert_documents(documents)
+            reingest = time.perf_counter() - start
+
+        print(f"{size:>10} {ingest:>10.2f} {ingest / size * 1e6:>10.1f} {reingest:>12.2f} {reingest / size * 1e6:>10.1f}")
+
+
+def benchmark_parsing(directory, worker_counts=(1, 2, 4, 8, 16)):
+    """
+    Measure PDF parsing and splitting throughput of PDFProcessor.load_files across worker counts,
+    and check that every worker count yields the same chunks in the same order.
+
+    :param directory: A directory of PDF files.
+    :param worker_counts: The numbers of worker processes to benchmark.
+    """
+    from pdfloader import PDFProcessor
+
+    pdf_processor = PDFProcessor(directory)
+    paths = pdf_processor.list_pdf_files(directory)
+    megabytes = sum(os.path.getsize(path) for path in paths) / 2 ** 20
+    print(f"{len(paths)} files, {megabytes:.1f} MB")
+    print(f"{'workers':>8} {'seconds':>8} {'files/s':>8} {'MB/s':>8} {'chunks':>8} {'failed':>7} {'speedup':>8}")
+
+    baseline = None
+    for num_workers in worker_counts:
+        start = time.perf_counter()
+        documents, failures = pdf_processor.load_files(paths, num_workers=num_workers)
+        elapsed = time.perf_counter() - start
+
+        chunks = [(document.metadata['source'], document.metadata['page'], document.page_content) for document in documents]
+        if baseline is None:
+            baseline = (chunks, elapsed)
+        elif chunks != baseline[0]:
+            print(f"{num_workers} workers produced different chunks than {worker_counts[0]}")
+        print(f"{num_workers:>8} {elapsed:>8.2f} {len(paths) / elapsed:>8.1f} {megabytes / elapsed:>8.2f} "
+              f"{len(documents):>8} {len(failures):>7} {baseline[1] / elapsed:>7.1f}x")
+
+
+def benchmark_rechunk(directory, chunk_sizes=(500, 1000, 2000, 4000), chunk_overlap=100, num_workers=1):
+    """
+    Time re-chunking a directory of PDFs with different splitter settings, extracting the text
+    on every run compared with serving it from the page text cache.
+
+    :param directory: A directory of PDF files.
+    :param chunk_sizes: The chunk sizes to split with, one run each.
+    :param chunk_overlap: The chunk overlap of every run.
+    :param num_workers: The number of worker processes.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    from pdfloader import PDFProcessor
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        processors = {
+            'uncached': PDFProcessor(directory, num_workers=num_workers),
+            'cached': PDFProcessor(directory, num_workers=num_workers, page_cache_dir=cache_dir),
+        }
+        paths = processors['uncached'].list_pdf_files(directory)
+        megabytes = sum(os.path.getsize(path) for path in paths) / 2 ** 20
+
+        # Fill the cache first, so every timed cached run is warm
+        start = time.perf_counter()
+        processors['cached'].load_files(paths)
+        fill = time.perf_counter() - start
+        cache_megabytes = sum(
+            os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(cache_dir) for name in names
+        ) / 2 ** 20
+        print(f"{len(paths)} files, {megabytes:.1f} MB of PDFs, cache filled in {fill:.2f}s, "
+              f"{cache_megabytes:.1f} MB cached")
+
+        print(f"{'chunk size':>10} {'uncached s':>11} {'cached s':>9} {'speedup':>8} {'chunks':>8}")
+        for chunk_size in chunk_sizes:
+            times = {}
+            for label, pdf_processor in processors.items():
+                pdf_processor.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+                start = time.perf_counter()
+                documents, _ = pdf_processor.load_files(paths)
+                times[label] = time.perf_counter() - start
+            print(f"{chunk_size:>10} {times['uncached']:>11.2f} {times['cached']:>9.2f} "
+                  f"{times['uncached'] / times['cached']:>7.1f}x {len(documents):>8}")
+
+
+def benchmark_splitters(directory, chunk_size=2000, chunk_overlap=100, chunk_tokens=254, overlap_tokens=32,
+                        page_cache_dir=None, repeats=3):
+    """
+    Compare the character-based langchain splitter with TokenTextSplitter on the pages of a
+    directory of PDFs: split time, number of chunks, and chunk lengths in model tokens.
+
+    :param directory: A directory of PDF files.
+    :param chunk_size: The chunk size of the character splitter.
+    :param chunk_overlap: The chunk overlap of the character splitter.
+    :param chunk_tokens: The chunk size of the token splitter.
+    :param overlap_tokens: The chunk overlap of the token splitter.
+    :param page_cache_dir: An optional page text cache, to skip extraction on repeated runs.
+    :param repeats: The number of timed runs per splitter; the fastest is reported.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    from pdfloader import PDFProcessor
+    from token_splitter import TokenTextSplitter
+
+    pdf_processor = PDFProcessor(directory, page_cache_dir=page_cache_dir)
+    pages = []
+    failed = 0
+    for path in pdf_processor.list_pdf_files(directory):
+        try:
+            pages.extend(pdf_processor.load_pages(path))
+        except Exception:
+            failed += 1
+    megabytes = sum(len(page.page_content) for page in pages) / 2 ** 20
+    print(f"{len(pages)} pages, {megabytes:.1f} MB of text, {failed} files failed to load")
+
+    token_splitter = TokenTextSplitter(chunk_tokens, overlap_tokens)
+    splitters = {
+        'characters': RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap),
+        'tokens': token_splitter,
+    }
+    # Measure every chunk with the tokenizer the embedding model truncates by
+    tokenizer = token_splitter.tokenizer
+    tokenizer('warm up')
+
+    print(f"{'splitter':>10} {'seconds':>8} {'pages/s':>8} {'chunks':>8} {'mean tok':>9} {'max tok':>8} "
+          f"{'truncated':>10} {'tokens':>10}")
+    for label, splitter in splitters.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            chunks = splitter.split_documents(pages)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        lengths = [len(ids) for ids in tokenizer(
+            [chunk.page_content for chunk in chunks], add_special_tokens=False, verbose=False
+        )['input_ids']]
+        truncated = sum(length > chunk_tokens for length in lengths)
+        print(f"{label:>10} {best:>8.3f} {len(pages) / best:>8.0f} {len(chunks):>8} "
+              f"{sum(lengths) / len(lengths):>9.1f} {max(lengths):>8} {truncated / len(lengths):>10.1%} {sum(lengths):>10}")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def benchmark_retrieval(database='my_database.db', vector_database='./chroma_db', num_queries=200, k=5,
+                        query_words=8, latency_budget=None, seed=0):
+    """
+    Compare recall@k and latency of vector-only and hybrid retrieval on an existing index.
+
+    Each query is a random span of words taken from a stored chunk, and the chunk it came from
+    is the relevant result, which mimics users searching for exact terms such as gene names,
+    drug names or trial IDs.
+
+    :param database: The SQLite database of the index.
+    :param vector_database: The Chroma directory of the index.
+    :param num_queries: The number of queries to sample.
+    :param k: The number of results per query.
+    :param query_words: The number of words in each query.
+    :param latency_budget: The latency budget passed to hybrid queries.
+    :param seed: The random seed used to sample queries.
+    """
+    from database import ChromaDBManager
+
+    rng = random.Random(seed)
+    # The query cache is disabled so both modes pay for their own prompt embeddings
+    with ChromaDBManager(database, vector_database, query_cache_size=0) as chroma_manager:
+        with chroma_manager.sqlite_db_manager.pool.connection() as conn:
+            rows = conn.execute('SELECT ID, Content FROM documents').fetchall()
+        queries = []
+        for id_, content in rng.sample(rows, min(num_queries, len(rows))):
+            words = chroma_manager.sqlite_db_manager.codec.decode(content).split()
+            start = rng.randint(0, max(0, len(words) - query_words))
+            queries.append((id_, ' '.join(words[start:start + query_words])))
+
+        print(f"{'mode':>8} {'recall@' + str(k):>10} {'p50 ms':>8} {'p95 ms':>8}")
+        for mode in ('vector', 'hybrid'):
+            latencies = []
+            found = 0
+            for id_, prompt in queries:
+                start = time.perf_counter()
+                hits = chroma_manager._search(prompt, k, mode=mode, latency_budget=latency_budget)
+                latencies.append(time.perf_counter() - start)
+                found += any(hit['id'] == id_ for hit in hits)
+            print(f"{mode:>8} {found / len(queries):>10.3f} {percentile(latencies, 0.5) * 1e3:>8.1f} "
+                  f"{percentile(latencies, 0.95) * 1e3:>8.1f}")
+
+
+def benchmark_compression(database='my_database.db', num_chunks=5000, k=5, num_queries=500, seed=0):
+    """
+    Report storage bytes per chunk and the cost of reading query results for each storage mode.
+
+    The chunks of an existing database (or a synthetic corpus when it holds too few) are copied
+    into a fresh database per mode, and the read cost is measured on get_documents_by_ids for k
+    random IDs, which is what the query path does for every returned result.
+
+    :param database: The SQLite database to sample chunks from.
+    :param num_chunks: The number of chunks to copy into each benchmark database.
+    :param k: The number of chunks read per simulated query.
+    :param num_queries: The number of simulated queries.
+    :param seed: The random seed.
+    """
+    from langchain.schema import Document
+    from database import SQLiteDBManager
+
+    with SQLiteDBManager(database) as source_manager:
+        with source_manager.pool.connection() as conn:
+            rows = conn.execute('SELECT Content, Source, Page FROM documents LIMIT ?', (num_chunks,)).fetchall()
+        documents = [
+            Document(page_content=source_manager.codec.decode(content), metadata={'source': source, 'page': page})
+            for content, source, page in rows
+        ]
+    if len(documents) < num_chunks:
+        documents += make_documents(num_chunks - len(documents), seed=seed)
+
+    rng = random.Random(seed)
+    print(f"{'mode':>10} {'content B/chunk':>16} {'file B/chunk':>13} {'read us/query':>14}")
+    for mode in (None, 'zlib', 'zstd', 'zstd+dict'):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'bench.db')
+            compression = mode.split('+')[0] if mode else None
+            with SQLiteDBManager(db_path, compression=compression) as manager:
+                if mode == 'zstd+dict':
+                    manager.train_compression_dictionary(
+                        samples=[document.page_content for document in rng.sample(documents, min(2000, len(documents)))]
+                    )
+                manager.insert_documents_bulk(documents)
+
+                with manager.pool.connection() as conn:
+                    content_bytes, count = conn.execute('SELECT SUM(LENGTH(CAST(Content AS BLOB))), COUNT(*) FROM documents').fetchone()
+                    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                    ids = [row[0] for row in conn.execute('SELECT ID FROM documents')]
+
+                start = time.perf_counter()
+                for _ in range(num_queries):
+                    manager.get_documents_by_ids(rng.sample(ids, k))
+                read = (time.perf_counter() - start) / num_queries
+
+            file_bytes = os.path.getsize(db_path)
+        print(f"{mode or 'plain':>10} {content_bytes / count:>16.0f} {file_bytes / count:>13.0f} {read * 1e6:>14.1f}")
+
+
+class CountingEmbeddings:
+    """
+    Wrap an embedding function and count the texts it embeds.
+    """
+
+    def __init__(self, embedding_function):
+        self.embedding_function = embedding_function
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return self.embedding_function.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embedding_function.embed_query(text)
+
+
+def benchmark_incremental_add(num_chunks=2000, changed_fraction=0.1, batch_size=256, seed=0):
+    """
+    Time ingesting a corpus, re-ingesting it after changing part of it, and re-ingesting it
+    unchanged, with the number of chunks embedded by each pass. test_database.py checks that
+    only the changed chunks are embedded.
+
+    :param num_chunks: The number of chunks in the corpus.
+    :param changed_fraction: The fraction of chunks whose text changes before re-ingesting.
+    :param batch_size: The batch size passed to add_documents_to_chroma.
+    :param seed: The random seed.
+    """
+    from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+    from langchain.schema import Document
+    from database import ChromaDBManager
+
+    documents = make_documents(num_chunks, seed=seed)
+    rng = random.Random(seed)
+    changed = set(rng.sample(range(num_chunks), int(num_chunks * changed_fraction)))
+    changed_documents = [
+        Document(page_content=document.page_content[::-1], metadata=document.metadata) if i in changed else document
+        for i, document in enumerate(documents)
+    ]
+
+    embeddings = CountingEmbeddings(SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with ChromaDBManager(os.path.join(tmp_dir, 'bench.db'), os.path.join(tmp_dir, 'chroma'), embeddings) as chroma_manager:
+            for label, corpus in (('initial', documents), ('re-ingest', changed_documents), ('unchanged', changed_documents)):
+                embeddings.embedded = 0
+                start = time.perf_counter()
+                chroma_manager.add_documents_to_chroma(corpus, batch_size=batch_size)
+                elapsed = time.perf_counter() - start
+                print(f"{label:>10}: {len(corpus)} chunks in {elapsed:.2f}s ({len(corpus) / elapsed:.0f} chunks/s), "
+                      f"{embeddings.embedded} embedded")
+
+
+class SyntheticPDFProcessor:
+    """
+    Stand in for PDFProcessor.iter_files, yielding generated chunks for made-up file paths.
+    """
+
+    def __init__(self, chunks_per_file=50, chunk_size=2000):
+        self.chunks_per_file = chunks_per_file
+        self.chunk_size = chunk_size
+
+    def iter_files(self, paths, num_workers=None, file_hashes=None):
+        from langchain.schema import Document
+
+        for path in paths:
+            # Seeded by path, so a file yields the same chunks whichever files are loaded with it
+            documents = make_documents(self.chunks_per_file, chunk_size=self.chunk_size, seed=path)
+            yield path, [Document(page_content=document.page_content, metadata=dict(document.metadata, source=path))
+                         for document in documents], None
+
+
+class InterruptingEmbeddings(CountingEmbeddings):
+    """
+    Count embedded texts and fail once a number of texts has been embedded, like a killed ingest.
+    """
+
+    def __init__(self, embedding_function, fail_after=None):
+        super().__init__(embedding_function)
+        self.fail_after = fail_after
+
+    def embed_documents(self, texts):
+        if self.fail_after is not None and self.embedded + len(texts) > self.fail_after:
+            raise RuntimeError('interrupted')
+        return super().embed_documents(texts)
+
+
+def benchmark_streaming_ingest(num_files=100, chunks_per_file=50, batch_size=256, queue_size=4):
+    """
+    Compare the peak Python memory of materializing a corpus before add_documents_to_chroma
+    with streaming it through ingest_files, then interrupt a streaming ingest halfway and report
+    how many chunks resuming it embeds. test_database.py checks the resumed ingest.
+
+    :param num_files: The number of synthetic files.
+    :param chunks_per_file: The number of chunks per file.
+    :param batch_size: The number of chunks embedded and written at a time.
+    :param queue_size: The number of files or batches a stage may run ahead of the next.
+    """
+    import tracemalloc
+
+    from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+    from database import ChromaDBManager
+
+    pdf_processor = SyntheticPDFProcessor(chunks_per_file)
+    paths = [f"/corpus/file_{i:06d}.pdf" for i in range(num_files)]
+    manifest_entries = {path: (0, 0, path) for path in paths}
+    total = num_files * chunks_per_file
+    model = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+
+    def materialized(chroma_manager):
+        documents = [document for _, file_documents, _ in pdf_processor.iter_files(paths) for document in file_documents]
+        chroma_manager.add_documents_to_chroma(documents, batch_size=batch_size)
+
+    def streamed(chroma_manager):
+        chroma_manager.ingest_files(pdf_processor, paths, manifest_entries, batch_size, queue_size)
+
+    for label, ingest in (('materialized', materialized), ('streamed', streamed)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with ChromaDBManager(os.path.join(tmp_dir, 'bench.db'), os.path.join(tmp_dir, 'vectors'), model,
+                                 vector_backend='numpy') as chroma_manager:
+                tracemalloc.start()
+                start = time.perf_counter()
+                ingest(chroma_manager)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        print(f"{label:>12}: {total} chunks in {elapsed:.2f}s ({total / elapsed:.0f} chunks/s), "
+              f"peak {peak / 2 ** 20:.1f} MB")
+
+    embeddings = InterruptingEmbeddings(model, fail_after=total // 2)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with ChromaDBManager(os.path.join(tmp_dir, 'bench.db'), os.path.join(tmp_dir, 'vectors'), embeddings,
+                             vector_backend='numpy') as chroma_manager:
+            first = chroma_manager.ingest_files(pdf_processor, paths, manifest_entries, batch_size, queue_size)
+            embeddings.fail_after = None
+            manifest = chroma_manager.sqlite_db_manager.get_source_manifest()
+            remaining = [path for path in paths if path not in manifest]
+            second = chroma_manager.ingest_files(pdf_processor, remaining, manifest_entries, batch_size, queue_size)
+    # Chunks embedded ahead of the write that failed are the only ones embedded twice
+    print(f"interrupted after {len(first['added'])} chunks, resumed {len(remaining)} files adding "
+          f"{len(second['added'])}, {embeddings.embedded} chunks embedded for {total}")
+
+
+def benchmark_watch(num_files=200, burst_size=20, chunks_per_file=10, poll_interval=0.5, debounce=1.0):
+    """
+    Measure the freshness lag of DirectoryWatcher: the time from a file being written, renamed
+    or deleted to the change being committed. test_watcher.py checks what each change does.
+
+    :param num_files: The number of files written, in bursts.
+    :param burst_size: The number of files written per burst.
+    :param chunks_per_file: The number of synthetic chunks per file.
+    :param poll_interval: The number of seconds between polls.
+    :param debounce: The number of seconds a file must go unchanged before it is ingested.
+    """
+    import threading
+
+    from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+    from database import ChromaDBManager
+    from watcher import DirectoryWatcher
+
+    pdf_processor = SyntheticPDFProcessor(chunks_per_file)
+    embeddings = CountingEmbeddings(SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2"))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        directory = os.path.join(tmp_dir, 'pdfs')
+        os.makedirs(directory)
+        with ChromaDBManager(os.path.join(tmp_dir, 'bench.db'), os.path.join(tmp_dir, 'vectors'), embeddings,
+                             vector_backend='numpy') as chroma_manager:
+            watcher = DirectoryWatcher(chroma_manager, pdf_processor, directory, poll_interval, debounce)
+            thread = threading.Thread(target=watcher.run, daemon=True)
+            thread.start()
+
+            def wait_for(expected):
+                # Wait until the manifest holds exactly the expected sources
+                while set(chroma_manager.sqlite_db_manager.get_source_manifest()) != expected:
+                    assert thread.is_alive(), "the watcher stopped"
+                    time.sleep(0.05)
+
+            lags = []
+            paths = []
+            for start in range(0, num_files, burst_size):
+                written = time.perf_counter()
+                for i in range(start, min(start + burst_size, num_files)):
+                    path = os.path.join(directory, f"file_{i:06d}.pdf")
+                    with open(path, 'w') as f:
+                        f.write(path)
+                    paths.append(path)
+                wait_for(set(paths))
+                lags.append(time.perf_counter() - written)
+            print(f"   added: {num_files} files in bursts of {burst_size}, lag p50 {percentile(lags, 0.5):.2f}s, "
+                  f"max {max(lags):.2f}s")
+
+            embedded = embeddings.embedded
+            renamed = [path.replace('file_', 'renamed_') for path in paths]
+            start = time.perf_counter()
+            for path, new_path in zip(paths, renamed):
+                os.rename(path, new_path)
+            wait_for(set(renamed))
+            print(f" renamed: {num_files} files, lag {time.perf_counter() - start:.2f}s, "
+                  f"{embeddings.embedded - embedded} chunks embedded")
+
+            start = time.perf_counter()
+            for path in renamed[::2]:
+                os.remove(path)
+            wait_for(set(renamed[1::2]))
+            print(f" deleted: {len(renamed[::2])} files, lag {time.perf_counter() - start:.2f}s")
+
+            start = time.perf_counter()
+            for _ in range(10):
+                watcher.scan()
+            print(f"    scan: {(time.perf_counter() - start) / 10 * 1000:.2f} ms per poll of {len(renamed[1::2])} files")
+
+            watcher.stop()
+            thread.join()
+
+
+def benchmark_query_many(database='my_database.db', vector_database='./chroma_db', num_prompts=512, k=5,
+                         batch_sizes=(1, 16, 64, 256), seed=0):
+    """
+    Compare the throughput of looping over ChromaDBManager.query with query_many.
+
+    :param database: The SQLite database of the index.
+    :param vector_database: The Chroma directory of the index.
+    :param num_prompts: The number of prompts, sampled from stored chunks.
+    :param k: The number of results per prompt.
+    :param batch_sizes: The query_many batch sizes to benchmark.
+    :param seed: The random seed used to sample prompts.
+    """
+    from database import ChromaDBManager
+
+    rng = random.Random(seed)
+    # The query cache is disabled so every run embeds and searches every prompt
+    with ChromaDBManager(database, vector_database, query_cache_size=0) as chroma_manager:
+        with chroma_manager.sqlite_db_manager.pool.connection() as conn:
+            rows = conn.execute('SELECT Content FROM documents').fetchall()
+        prompts = []
+        for _ in range(num_prompts):
+            words = chroma_manager.sqlite_db_manager.codec.decode(rng.choice(rows)[0]).split()
+            start = rng.randint(0, max(0, len(words) - 12))
+            prompts.append(' '.join(words[start:start + 12]))
+
+        start = time.perf_counter()
+        for prompt in prompts:
+            chroma_manager.query(prompt, num_result=k)
+        looped = time.perf_counter() - start
+        print(f"{'looped query':>20}: {num_prompts / looped:>8.1f} prompts/s")
+
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            chroma_manager.query_many(prompts, num_result=k, batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+            print(f"{'query_many bs=' + str(batch_size):>20}: {num_prompts / elapsed:>8.1f} prompts/s "
+                  f"({looped / elapsed:.1f}x)")
+
+
+def benchmark_server(database='my_database.db', vector_database='./chroma_db', vector_backend='chroma',
+                     num_requests=200, concurrencies=(1, 8, 32), max_batch_size=8, k=3, seed=0):
+    """
+    Load-test the server mode over HTTP with a StubGenerator, reporting throughput, latency
+    and the batch sizes the worker formed.
+
+    :param database: The SQLite database of the index.
+    :param vector_database: The vector store directory of the index.
+    :param vector_backend: The backend of the index, 'chroma' or 'numpy'.
+    :param num_requests: The number of questions sent per concurrency level.
+    :param concurrencies: The numbers of clients sending questions at the same time.
+    :param max_batch_size: The maximum number of questions generated together.
+    :param k: The number of chunks retrieved per question.
+    :param seed: The random seed used to sample questions.
+    """
+    import http.client
+    import json
+    import threading
+
+    from database import ChromaDBManager, format_hits
+    from main import format_query_results_to_dialogs
+    from server import RAGService, StubGenerator, make_server
+
+    rng = random.Random(seed)
+    with ChromaDBManager(database, vector_database, vector_backend=vector_backend, query_cache_size=0) as chroma_manager:
+        with chroma_manager.sqlite_db_manager.pool.connection() as conn:
+            rows = conn.execute('SELECT Content FROM documents').fetchall()
+        questions = []
+        for _ in range(num_requests):
+            words = chroma_manager.sqlite_db_manager.codec.decode(rng.choice(rows)[0]).split()
+            start = rng.randint(0, max(0, len(words) - 12))
+            questions.append(' '.join(words[start:start + 12]))
+
+        service = RAGService(
+            chroma_manager, StubGenerator,
+            lambda spans, query: format_query_results_to_dialogs(format_hits(spans), query)[0],
+            num_result=k, max_batch_size=max_batch_size, queue_size=num_requests,
+        ).start()
+        server = make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        service.ready.wait()
+        port = server.server_address[1]
+
+        print(f"{'clients':>8} {'req/s':>8} {'p50 s':>7} {'p95 s':>7} {'mean batch':>11}")
+        for concurrency in concurrencies:
+            pending = list(questions)
+            latencies = []
+            lock = threading.Lock()
+
+            def client():
+                connection = http.client.HTTPConnection('127.0.0.1', port)
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        question = pending.pop()
+                    sent = time.perf_counter()
+                    connection.request('POST', '/query', json.dumps({'query': question}))
+                    response = connection.getresponse()
+                    response.read()
+                    assert response.status == 200, f"request failed with status {response.status}"
+                    with lock:
+                        latencies.append(time.perf_counter() - sent)
+
+            batches, batched = service.batches, service.batched_requests
+            start = time.perf_counter()
+            clients = [threading.Thread(target=client) for _ in range(concurrency)]
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            mean_batch = (service.batched_requests - batched) / max(1, service.batches - batches)
+            print(f"{concurrency:>8} {num_requests / elapsed:>8.1f} {percentile(latencies, 0.5):>7.3f} "
+                  f"{percentile(latencies, 0.95):>7.3f} {mean_batch:>11.1f}")
+
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def benchmark_batch_queries(database='my_database.db', vector_database='./chroma_db', vector_backend='chroma',
+                            num_queries=120, max_batch_size=6, k=3, max_query_words=300, seed=0):
+    """
+    Compare answering a JSONL file of queries one at a time with batches of max_batch_size
+    dialogs, unsorted and grouped by prompt length, using a StubGenerator that pays for padding
+    like Llama.generate does.
+
+    :param database: The SQLite database of the index.
+    :param vector_database: The vector store directory of the index.
+    :param vector_backend: The backend of the index, 'chroma' or 'numpy'.
+    :param num_queries: The number of queries, sampled from stored chunks with varied lengths.
+    :param max_batch_size: The maximum number of dialogs per chat_completion call.
+    :param k: The number of chunks retrieved per query.
+    :param max_query_words: The maximum number of words per query.
+    :param seed: The random seed used to sample queries.
+    """
+    import json
+
+    from database import ChromaDBManager, format_hits
+    from main import answer_queries_file, format_query_results_to_dialogs
+    from server import StubGenerator
+
+    rng = random.Random(seed)
+    with ChromaDBManager(database, vector_database, vector_backend=vector_backend, query_cache_size=0) as chroma_manager:
+        with chroma_manager.sqlite_db_manager.pool.connection() as conn:
+            rows = conn.execute('SELECT Content FROM documents').fetchall()
+        words = chroma_manager.sqlite_db_manager.codec.decode(rng.choice(rows)[0]).split()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            queries_file = os.path.join(tmp_dir, 'queries.jsonl')
+            with open(queries_file, 'w') as f:
+                for i in range(num_queries):
+                    length = rng.randint(4, max_query_words)
+                    f.write(json.dumps({'id': i, 'query': ' '.join(rng.choice(words) for _ in range(length))}) + '\n')
+
+            for label, batch_size, group_by_length in (('one at a time', 1, False),
+                                                       ('batched', max_batch_size, False),
+                                                       ('batched, grouped', max_batch_size, True)):
+                # A decoding step of a 7B model on one GPU
+                generator = StubGenerator(decode_seconds_per_token=0.005)
+                start = time.perf_counter()
+                answered = answer_queries_file(
+                    chroma_manager, generator,
+                    lambda spans, query: format_query_results_to_dialogs(format_hits(spans), query)[0],
+                    queries_file, os.path.join(tmp_dir, 'answers.jsonl'), num_result=k,
+                    max_batch_size=batch_size, group_by_length=group_by_length,
+                )
+                elapsed = time.perf_counter() - start
+                print(f"{label:>18}: {answered / elapsed:>7.1f} queries/s")
+
+
+def benchmark_answer_cache(database='my_database.db', vector_database='./chroma_db', vector_backend='chroma',
+                           num_questions=40, paraphrases=4, k=3, threshold=0.95, seed=0):
+    """
+    Answer a query file in which every question is asked several times in different words,
+    with and without the answer cache, using a StubGenerator.
+
+    :param database: The SQLite database of the index.
+    :param vector_database: The vector store directory of the index.
+    :param vector_backend: The backend of the index, 'chroma' or 'numpy'.
+    :param num_questions: The number of distinct questions, sampled from stored chunks.
+    :param paraphrases: The number of times each question is asked.
+    :param k: The number of chunks retrieved per query.
+    :param threshold: The cosine similarity above which a cached answer is reused.
+    :param seed: The random seed used to sample questions.
+    """
+    import json
+
+    from answer_cache import AnswerCache
+    from database import ChromaDBManager, format_hits
+    from main import answer_queries_file, format_query_results_to_dialogs
+    from server import StubGenerator
+
+    rng = random.Random(seed)
+    prefixes = ('', 'Please tell me: ', 'I would like to know ', 'Question: ')
+    suffixes = ('', '?', ' please', ', thanks')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label, cache_path in (('no cache', None), ('answer cache', os.path.join(tmp_dir, 'answers.db'))):
+            answer_cache = AnswerCache(cache_path, threshold=threshold) if cache_path else None
+            with ChromaDBManager(database, vector_database, vector_backend=vector_backend,
+                                 answer_cache=answer_cache) as chroma_manager:
+                if label == 'no cache':
+                    with chroma_manager.sqlite_db_manager.pool.connection() as conn:
+                        rows = conn.execute('SELECT Content FROM documents').fetchall()
+                    queries_file = os.path.join(tmp_dir, 'queries.jsonl')
+                    with open(queries_file, 'w') as f:
+                        questions = []
+                        for _ in range(num_questions):
+                            words = chroma_manager.sqlite_db_manager.codec.decode(rng.choice(rows)[0]).split()
+                            start = rng.randint(0, max(0, len(words) - 12))
+                            questions.append(' '.join(words[start:start + 12]))
+                        # Paraphrases arrive in later windows than the first asking
+                        for round_ in range(paraphrases):
+                            for question in questions:
+                                query = rng.choice(prefixes) + question + rng.choice(suffixes)
+                                f.write(json.dumps({'query': query if round_ else question}) + '\n')
+
+                start = time.perf_counter()
+                answer_queries_file(
+                    chroma_manager, StubGenerator(),
+                    lambda spans, query: format_query_results_to_dialogs(format_hits(spans), query)[0],
+                    queries_file, os.path.join(tmp_dir, 'answers.jsonl'), num_result=k,
+                    window_size=num_questions, answer_params={'benchmark': True},
+                )
+                elapsed = time.perf_counter() - start
+                hit_rate = answer_cache.stats()['hit_rate'] if answer_cache else 0.0
+            print(f"{label:>14}: {num_questions * paraphrases / elapsed:>7.1f} queries/s, hit rate {hit_rate:.0%}")
+
+
+def benchmark_filters(database='my_database.db', vector_database='./chroma_db', vector_backend='chroma',
+                      num_queries=200, k=5, overfetch=10, seed=0):
+    """
+    Compare filtered queries against over-fetching and filtering in Python, for a selective
+    filter (one source) and a non-selective one (every page but the first).
+
+    :param database: The SQLite database of the index.
+    :param vector_database: The vector store directory of the index.
+    :param vector_backend: 'chroma' or 'numpy', the backend of the index.
+    :param num_queries: The number of queries, sampled from stored chunks.
+    :param k: The number of results per query.
+    :param overfetch: The multiple of k fetched by the post-filtering baseline.
+    :param seed: The random seed used to sample queries and the selected source.
+    """
+    from database import ChromaDBManager
+
+    rng = random.Random(seed)
+    with ChromaDBManager(database, vector_database, query_cache_size=0, vector_backend=vector_backend) as chroma_manager:
+        with chroma_manager.sqlite_db_manager.pool.connection() as conn:
+            rows = conn.execute('SELECT Content FROM documents').fetchall()
+            sources = [row[0] for row in conn.execute('SELECT DISTINCT Source FROM documents')]
+        prompts = []
+        for _ in range(num_queries):
+            words = chroma_manager.sqlite_db_manager.codec.decode(rng.choice(rows)[0]).split()
+            start = rng.randint(0, max(0, len(words) - 12))
+            prompts.append(' '.join(words[start:start + 12]))
+
+        source = rng.choice(sources)
+        cases = {
+            'none': None,
+            'selective': {'sources': [source]},
+            'non-selective': {'page_range': (1, None)},
+        }
+        print(f"{'filter':>14} {'method':>12} {'matching':>9} {'p50 ms':>8} {'p95 ms':>8} {'full k':>7}")
+        for name, filters in cases.items():
+            matching = len(rows)
+            if filters:
+                matching = len(chroma_manager.sqlite_db_manager.resolve_filters(filters)[0])
+            expected = min(k, matching)
+
+            methods = {'pushdown': lambda prompt: chroma_manager._search(prompt, k, filters=filters)}
+            if filters:
+                pages = filters.get('page_range', (None, None))
+
+                def post_filter(prompt):
+                    hits = chroma_manager._search(prompt, k * overfetch)
+                    return [
+                        hit for hit in hits
+                        if ('sources' not in filters or hit['source'] in filters['sources'])
+                        and (pages[0] is None or hit['page'] >= pages[0])
+                    ][:k]
+                methods['post-filter'] = post_filter
+
+            for method, search in methods.items():
+                latencies = []
+                full = 0
+                for prompt in prompts:
+                    start = time.perf_counter()
+                    hits = search(prompt)
+                    latencies.append(time.perf_counter() - start)
+                    full += len(hits) == expected
+                print(f"{name:>14} {method:>12} {matching / len(rows):>9.1%} {percentile(latencies, 0.5) * 1e3:>8.2f} "
+                      f"{percentile(latencies, 0.95) * 1e3:>8.2f} {full / num_queries:>7.1%}")
+
+
+def benchmark_packing(tokenizer_path, database='my_database.db', vector_database='./chroma_db', num_queries=100,
+                      k=10, max_seq_len=4096, reserved_gen_len=512, seed=0):
+    """
+    Compare prompt sizes of pasting every hit into the system prompt with the packed context.
+
+    :param tokenizer_path: The path to the Llama tokenizer model.
+    :param database: The SQLite database of the index.
+    :param vector_database: The vector store directory of the index.
+    :param num_queries: The number of queries, sampled from stored chunks.
+    :param k: The number of hits retrieved per query.
+    :param max_seq_len: The model context length.
+    :param reserved_gen_len: The number of tokens reserved for the answer.
+    :param seed: The random seed used to sample queries.
+    """
+    from llama.tokenizer import Tokenizer
+
+    from context_packer import ContextPacker, dialog_prompt_tokens
+    from database import ChromaDBManager, format_hits
+    from main import format_query_results_to_dialogs
+
+    tokenizer = Tokenizer(model_path=tokenizer_path)
+    packer = ContextPacker(tokenizer)
+    budget = max_seq_len - reserved_gen_len
+    rng = random.Random(seed)
+    with ChromaDBManager(database, vector_database) as chroma_manager:
+        with chroma_manager.sqlite_db_manager.pool.connection() as conn:
+            rows = conn.execute('SELECT Content FROM documents').fetchall()
+
+        plain_tokens, packed_tokens, over_budget, pack_seconds = [], [], 0, 0.0
+        for _ in range(num_queries):
+            words = chroma_manager.sqlite_db_manager.codec.decode(rng.choice(rows)[0]).split()
+            start = rng.randint(0, max(0, len(words) - 12))
+            prompt = ' '.join(words[start:start + 12])
+            hits = chroma_manager.query(prompt, num_result=k)
+
+            def build_dialog(spans):
+                return format_query_results_to_dialogs(format_hits(spans), prompt)[0]
+
+            plain = dialog_prompt_tokens(tokenizer, build_dialog(hits))
+            started = time.perf_counter()
+            dialog, _ = packer.pack(hits, build_dialog, budget)
+            pack_seconds += time.perf_counter() - started
+            plain_tokens.append(plain)
+            packed_tokens.append(dialog_prompt_tokens(tokenizer, dialog))
+            over_budget += plain > budget
+
+    print(f"budget {budget} tokens, k={k}")
+    print(f"{'unpacked':>10}: mean {sum(plain_tokens) / num_queries:>8.1f} tokens, "
+          f"max {max(plain_tokens)}, {over_budget / num_queries:.1%} over budget")
+    print(f"{'packed':>10}: mean {sum(packed_tokens) / num_queries:>8.1f} tokens, "
+          f"max {max(packed_tokens)}, {pack_seconds / num_queries * 1e3:.2f} ms per query")
+
+
+def make_vectors(num_vectors, dim=384, seed=0):
+    """
+    Build unit-length random vectors shaped like all-MiniLM-L6-v2 embeddings.
+    """
+    import numpy as np
+
+    vectors = np.random.default_rng(seed).standard_normal((num_vectors, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark_vector_backends(num_vectors=100000, dim=384, num_queries=200, k=10, batch_size=5000, seed=0):
+    """
+    Compare the Chroma (HNSW) and NumPy (exact) vector stores on build time, cold start,
+    query latency and recall@k against exact search.
+
+    :param num_vectors: The number of stored vectors.
+    :param dim: The dimension of the vectors.
+    :param num_queries: The number of queries.
+    :param k: The number of neighbours per query.
+    :param batch_size: The number of vectors upserted per call.
+    :param seed: The random seed.
+    """
+    from vector_store import ChromaVectorStore, NumpyVectorStore
+
+    vectors = make_vectors(num_vectors, dim, seed)
+    # Queries are perturbed stored vectors, so every query has meaningful near neighbours
+    queries = vectors[:num_queries] + 0.05 * make_vectors(num_queries, dim, seed + 1)
+    ids = [str(i) for i in range(num_vectors)]
+    metadatas = [{'source': f"/corpus/paper_{i // 20:06d}.pdf", 'page': i % 20} for i in range(num_vectors)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        backends = {
+            'numpy': lambda: NumpyVectorStore(os.path.join(tmp_dir, 'numpy')),
+            'chroma': lambda: ChromaVectorStore(os.path.join(tmp_dir, 'chroma'), None),
+        }
+        exact = None
+        print(f"{'backend':>8} {'build s':>8} {'open s':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall@' + str(k):>10}")
+        for name, open_store in backends.items():
+            store = open_store()
+            start = time.perf_counter()
+            for i in range(0, num_vectors, batch_size):
+                store.upsert(ids[i:i + batch_size], vectors[i:i + batch_size].tolist(), metadatas[i:i + batch_size])
+            build = time.perf_counter() - start
+            store.close()
+
+            start = time.perf_counter()
+            store = open_store()
+            store.query(queries[:1].tolist(), k)
+            cold_start = time.perf_counter() - start
+
+            latencies = []
+            results = []
+            for query in queries:
+                start = time.perf_counter()
+                results.append(store.query([query.tolist()], k)['ids'][0])
+                latencies.append(time.perf_counter() - start)
+            store.close()
+
+            if exact is None:
+                exact = results
+            recall = sum(len(set(got) & set(want)) for got, want in zip(results, exact)) / (k * num_queries)
+            print(f"{name:>8} {build:>8.2f} {cold_start:>8.3f} {percentile(latencies, 0.5) * 1e3:>8.2f} "
+                  f"{percentile(latencies, 0.95) * 1e3:>8.2f} {recall:>10.3f}")
+
+
+def benchmark_quantization(num_vectors=100000, dim=384, num_queries=200, k=10, rescore_factor=4, batch_size=5000, seed=0):
+    """
+    Compare exact search with int8 and binary quantized search on in-memory bytes per million
+    chunks, query latency and recall@k against exact search.
+
+    :param num_vectors: The number of stored vectors.
+    :param dim: The dimension of the vectors.
+    :param num_queries: The number of queries.
+    :param k: The number of neighbours per query.
+    :param rescore_factor: The number of candidates per result rescored at full precision.
+    :param batch_size: The number of vectors upserted per call.
+    :param seed: The random seed.
+    """
+    from vector_store import NumpyVectorStore
+
+    vectors = make_vectors(num_vectors, dim, seed)
+    queries = vectors[:num_queries] + 0.05 * make_vectors(num_queries, dim, seed + 1)
+    ids = [str(i) for i in range(num_vectors)]
+    metadatas = [{'source': f"/corpus/paper_{i // 20:06d}.pdf", 'page': i % 20} for i in range(num_vectors)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # All modes share one matrix file; only the in-memory representation differs
+        directory = os.path.join(tmp_dir, 'numpy')
+        store = NumpyVectorStore(directory)
+        for i in range(0, num_vectors, batch_size):
+            store.upsert(ids[i:i + batch_size], vectors[i:i + batch_size].tolist(), metadatas[i:i + batch_size])
+        store.close()
+
+        exact = None
+        print(f"{'mode':>8} {'MB per 1M':>10} {'p50 ms':>8} {'p95 ms':>8} {'recall@' + str(k):>10}")
+        for quantization in (None, 'int8', 'binary'):
+            store = NumpyVectorStore(directory, quantization=quantization, rescore_factor=rescore_factor)
+            store.query(queries[:1].tolist(), k)
+
+            latencies = []
+            results = []
+            for query in queries:
+                start = time.perf_counter()
+                results.append(store.query([query.tolist()], k)['ids'][0])
+                latencies.append(time.perf_counter() - start)
+            megabytes = store.memory_bytes() / num_vectors * 1e6 / 2 ** 20
+            store.close()
+
+            if exact is None:
+                exact = results
+            recall = sum(len(set(got) & set(want)) for got, want in zip(results, exact)) / (k * num_queries)
+            print(f"{quantization or 'float32':>8} {megabytes:>10.1f} {percentile(latencies, 0.5) * 1e3:>8.2f} "
+                  f"{percentile(latencies, 0.95) * 1e3:>8.2f} {recall:>10.3f}")
+
+
+STARTUP_ENTRY_POINTS = {
+    'import database': 'import database',
+    'import pdfloader': 'import pdfloader',
+    'import main': 'import main',
+    'SQLiteDBManager()': 'import database; database.SQLiteDBManager(DB_PATH).close()',
+    'ChromaDBManager()': 'import database; database.ChromaDBManager(DB_PATH, CHROMA_PATH).close()',
+    'ChromaDBManager.count_document()': 'import database; database.ChromaDBManager(DB_PATH, CHROMA_PATH).count_document()',
+}
+
+
+def benchmark_startup(repeats=5):
+    """
+    Measure import time and peak memory of each entry point in a fresh interpreter.
+
+    :param repeats: The number of runs per entry point; the median time is reported.
+    """
+    import subprocess
+    import sys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'entry point':>34} {'median s':>9} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label, statement in STARTUP_ENTRY_POINTS.items():
+            script = (
+                "import resource, time\n"
+                f"DB_PATH = {os.path.join(tmp_dir, 'startup.db')!r}\n"
+                f"CHROMA_PATH = {os.path.join(tmp_dir, 'chroma')!r}\n"
+                "start = time.perf_counter()\n"
+                f"{statement}\n"
+                "print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+            )
+            times = []
+            peak = 0
+            for _ in range(repeats):
+                output = subprocess.run(
+                    [sys.executable, '-c', script], cwd=here, capture_output=True, text=True, check=True
+                ).stdout.split()
+                times.append(float(output[-2]))
+                peak = max(peak, int(output[-1]))
+            # ru_maxrss is reported in kilobytes on Linux
+            print(f"{label:>34} {percentile(times, 0.5):>9.3f} {peak / 1024:>12.1f}")
+
+
+def make_llama_checkpoint(path, num_shards=8, n_layers=4, dim=512, n_heads=64, n_kv_heads=8, hidden_dim=1024,
+                          vocab_size=256, seed=0):
+    """
+    Write a random bfloat16 checkpoint with the layout of the model parallel Llama 2 70B shards,
+    small enough to convert in memory.
+
+    :param path: The directory to write params.json and the consolidated.NN.pth shards to.
+    :param num_shards: The number of model parallel shards.
+    :param n_heads: The number of attention heads, which like 70B should be num_shards * n_kv_heads
+        for convert_to_llama_70b_1 to read the key and value heads.
+    :return: The parameters written to params.json.
+    """
+    import torch
+
+    params = {'dim': dim, 'n_layers': n_layers, 'n_heads': n_heads, 'n_kv_heads': n_kv_heads,
+              'multiple_of': 256, 'norm_eps': 1e-5, 'vocab_size': -1}
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'params.json'), 'w') as f:
+        json.dump(params, f)
+
+    generator = torch.Generator().manual_seed(seed)
+
+    def full(*shape):
+        return torch.randn(*shape, generator=generator).to(torch.bfloat16)
+
+    kv_dim = n_kv_heads * (dim // n_heads)
+    # Tensors split across shards are generated whole and chunked like the released checkpoints
+    splits = {'tok_embeddings.weight': (full(vocab_size, dim), 1), 'output.weight': (full(vocab_size, dim), 0)}
+    for layer_i in range(n_layers):
+        prefix = f"layers.{layer_i}."
+        splits[prefix + 'attention.wq.weight'] = (full(dim, dim), 0)
+        splits[prefix + 'attention.wk.weight'] = (full(kv_dim, dim), 0)
+        splits[prefix + 'attention.wv.weight'] = (full(kv_dim, dim), 0)
+        splits[prefix + 'attention.wo.weight'] = (full(dim, dim), 1)
+        splits[prefix + 'feed_forward.w1.weight'] = (full(hidden_dim, dim), 0)
+        splits[prefix + 'feed_forward.w2.weight'] = (full(dim, hidden_dim), 1)
+        splits[prefix + 'feed_forward.w3.weight'] = (full(hidden_dim, dim), 0)
+    replicated = {'norm.weight': full(dim), 'rope.freqs': full(dim // n_heads // 2)}
+    for layer_i in range(n_layers):
+        replicated[f"layers.{layer_i}.attention_norm.weight"] = full(dim)
+        replicated[f"layers.{layer_i}.ffn_norm.weight"] = full(dim)
+
+    for shard_i in range(num_shards):
+        shard = {key: tensor.chunk(num_shards, dim=axis)[shard_i].clone() for key, (tensor, axis) in splits.items()}
+        shard.update({key: tensor.clone() for key, tensor in replicated.items()})
+        torch.save(shard, os.path.join(path, f"consolidated.{shard_i:02d}.pth"))
+    return params
+
+
+def benchmark_reshard(input_shards=8, output_shards=2, n_layers=4, dim=512, hidden_dim=1024, vocab_size=256):
+    """
+    Reshard a synthetic Llama-shaped checkpoint with the consolidating conversion of convert.py
+    and with reshard_streaming, each in a fresh interpreter, check that both write identical
+    files, and report their time and peak memory.
+
+    :param input_shards: The number of shards of the synthetic checkpoint.
+    :param output_shards: The number of shards to convert it to.
+    """
+    import filecmp
+    import subprocess
+    import sys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_dir = os.path.join(tmp_dir, 'input')
+        make_llama_checkpoint(input_dir, input_shards, n_layers, dim, n_heads=8 * input_shards, n_kv_heads=8,
+                              hidden_dim=hidden_dim, vocab_size=vocab_size)
+        size = sum(os.path.getsize(os.path.join(input_dir, name)) for name in os.listdir(input_dir))
+        print(f"Checkpoint of {size / 2 ** 20:.1f} MB in {input_shards} shards, converting to {output_shards}.")
+
+        conversions = {
+            'consolidate': (
+                "state_dict = convert.convert_to_llama_70b_1(INPUT, num_shards={input_shards})\n"
+                "convert.convert_to_llama_70b_2(state_dict, INPUT, OUTPUT, num_shards={output_shards})\n"
+            ),
+            'streaming': "convert.reshard_streaming(INPUT, OUTPUT, {input_shards}, {output_shards})\n",
+        }
+        print(f"{'conversion':>12} {'s':>8} {'peak RSS MB':>12}")
+        for label, statement in conversions.items():
+            output_dir = os.path.join(tmp_dir, label)
+            os.makedirs(output_dir)
+            script = (
+                "import resource, time\n"
+                "import convert\n"
+                f"INPUT = {input_dir!r}\n"
+                f"OUTPUT = {output_dir!r}\n"
+                "start = time.perf_counter()\n"
+                + statement.format(input_shards=input_shards, output_shards=output_shards)
+                + "print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+            )
+            output = subprocess.run(
+                [sys.executable, '-c', script], cwd=here, capture_output=True, text=True, check=True
+            ).stdout.split()
+            # ru_maxrss is reported in kilobytes on Linux
+            print(f"{label:>12} {float(output[-2]):>8.2f} {int(output[-1]) / 1024:>12.1f}")
+
+        for shard_i in range(output_shards):
+            name = f"consolidated.0{shard_i}.pth"
+            assert filecmp.cmp(
+                os.path.join(tmp_dir, 'consolidate', name), os.path.join(tmp_dir, 'streaming', name), shallow=False
+            ), f"{name} differs between the two conversions"
+        print(f"All {output_shards} output shards are identical.")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'ingest': benchmark_ingest,
+        'parsing': benchmark_parsing,
+        'rechunk': benchmark_rechunk,
+        'splitters': benchmark_splitters,
+        'retrieval': benchmark_retrieval,
+        'compression': benchmark_compression,
+        'incremental_add': benchmark_incremental_add,
+        'streaming_ingest': benchmark_streaming_ingest,
+        'watch': benchmark_watch,
+        'query_many': benchmark_query_many,
+        'filters': benchmark_filters,
+        'server': benchmark_server,
+        'batch_queries': benchmark_batch_queries,
+        'answer_cache': benchmark_answer_cache,
+        'packing': benchmark_packing,
+        'startup': benchmark_startup,
+        'vector_backends': benchmark_vector_backends,
+        'quantization': benchmark_quantization,
+        'reshard': benchmark_reshard,
+    })
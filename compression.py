@@ -0,0 +1,120 @@
+import struct
+import threading
+import zlib
+
+# Compressed chunks are stored as BLOBs that start with a one-byte codec ID and a four-byte
+# dictionary ID (0 when no dictionary was used). Plain chunks stay TEXT, so databases can hold
+# a mix of both and are readable whatever compression mode they are opened with.
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+HEADER = struct.Struct('<BI')
+
+CODECS = {'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the zstandard package: pip install zstandard")
+    return zstandard
+
+
+class ChunkCodec:
+    """
+    Encode chunk text for the documents.Content column and decode it back.
+    """
+
+    def __init__(self, compression=None, level=None, dictionary_loader=None):
+        """
+        :param compression: None to store plain text, 'zlib' or 'zstd'.
+        :param level: The compression level. Defaults to the default level of the codec.
+        :param dictionary_loader: A callable returning the bytes of a stored dictionary by ID,
+            used to decode chunks compressed with a dictionary this codec has not seen yet.
+        """
+        if compression is not None and compression not in CODECS:
+            raise ValueError(f"Unknown compression {compression!r}, expected None, 'zlib' or 'zstd'.")
+        if compression == 'zstd':
+            _import_zstandard()
+        self.compression = compression
+        self.level = level
+        self.dictionary_loader = dictionary_loader
+        self.dictionaries = {}
+        self.dictionary_id = 0
+        self._local = threading.local()
+
+    def use_dictionary(self, dictionary_id, data):
+        """
+        Compress new chunks with a trained zstd dictionary.
+
+        :param dictionary_id: The ID under which the dictionary is stored.
+        :param data: The bytes of the dictionary.
+        """
+        self.dictionaries[dictionary_id] = data
+        self.dictionary_id = dictionary_id
+        self._local = threading.local()
+
+    def encode(self, text):
+        """
+        :param text: The chunk text.
+        :return: The text itself when compression is off, otherwise the compressed BLOB.
+        """
+        if self.compression is None:
+            return text
+        data = text.encode('utf-8')
+        if self.compression == 'zlib':
+            level = -1 if self.level is None else self.level
+            return HEADER.pack(CODEC_ZLIB, 0) + zlib.compress(data, level)
+        return HEADER.pack(CODEC_ZSTD, self.dictionary_id) + self._compressor().compress(data)
+
+    def decode(self, value):
+        """
+        :param value: A value read from documents.Content.
+        :return: The chunk text.
+        """
+        if value is None or isinstance(value, str):
+            return value
+        codec, dictionary_id = HEADER.unpack_from(value)
+        payload = memoryview(value)[HEADER.size:]
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(payload).decode('utf-8')
+        if codec == CODEC_ZSTD:
+            return self._decompressor(dictionary_id).decompress(payload).decode('utf-8')
+        raise ValueError(f"Unknown codec ID {codec} in stored chunk.")
+
+    def _compressor(self):
+        # zstd compression contexts are not thread-safe, so every thread gets its own
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            zstandard = _import_zstandard()
+            kwargs = {'level': 3 if self.level is None else self.level}
+            if self.dictionary_id:
+                kwargs['dict_data'] = zstandard.ZstdCompressionDict(self.dictionaries[self.dictionary_id])
+            compressor = self._local.compressor = zstandard.ZstdCompressor(**kwargs)
+        return compressor
+
+    def _decompressor(self, dictionary_id):
+        decompressors = getattr(self._local, 'decompressors', None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        if dictionary_id not in decompressors:
+            zstandard = _import_zstandard()
+            kwargs = {}
+            if dictionary_id:
+                if dictionary_id not in self.dictionaries:
+                    self.dictionaries[dictionary_id] = self.dictionary_loader(dictionary_id)
+                kwargs['dict_data'] = zstandard.ZstdCompressionDict(self.dictionaries[dictionary_id])
+            decompressors[dictionary_id] = zstandard.ZstdDecompressor(**kwargs)
+        return decompressors[dictionary_id]
+
+
+def train_dictionary(samples, dict_size=16384):
+    """
+    Train a zstd dictionary on sample chunks, which lets small chunks compress well on their own.
+
+    :param samples: A list of chunk texts.
+    :param dict_size: The target size of the dictionary in bytes.
+    :return: The bytes of the dictionary.
+    """
+    zstandard = _import_zstandard()
+    return zstandard.train_dictionary(dict_size, [sample.encode('utf-8') for sample in samples]).as_bytes()
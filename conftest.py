@@ -0,0 +1,69 @@
+import hashlib
+
+import pytest
+
+
+class FakeEmbeddings:
+    """
+    A deterministic embedding function that counts the texts it embeds.
+    """
+
+    model_name = 'fake'
+
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+    @staticmethod
+    def _vector(text):
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        return [byte / 255 for byte in digest[:8]]
+
+
+class LineProcessor:
+    """
+    Stand in for PDFProcessor, turning every line of a text file into a chunk.
+    """
+
+    def iter_files(self, paths, num_workers=None, file_hashes=None):
+        from langchain.schema import Document
+
+        for path in paths:
+            try:
+                with open(path) as f:
+                    lines = f.read().splitlines()
+            except OSError as e:
+                yield path, [], f"{type(e).__name__}: {e}"
+                continue
+            yield path, [Document(page_content=line, metadata={'source': path, 'page': i})
+                         for i, line in enumerate(lines)], None
+
+
+@pytest.fixture
+def embeddings():
+    return FakeEmbeddings()
+
+
+@pytest.fixture
+def processor():
+    return LineProcessor()
+
+
+@pytest.fixture
+def manager(tmp_path, embeddings):
+    """
+    A ChromaDBManager on the NumPy backend with the fake embeddings, so no model is loaded.
+    """
+    pytest.importorskip('numpy')
+    pytest.importorskip('langchain.schema')
+    from database import ChromaDBManager
+
+    with ChromaDBManager(str(tmp_path / 'db.db'), str(tmp_path / 'vectors'), embeddings,
+                         vector_backend='numpy') as chroma_manager:
+        yield chroma_manager
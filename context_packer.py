@@ -0,0 +1,153 @@
+import re
+
+# The Llama 2 chat template, as applied by Llama.chat_completion
+B_INST, E_INST = "[INST]", "[/INST]"
+B_SYS, E_SYS = "<<SYS>>\n", "\n<</SYS>>\n\n"
+
+
+def dialog_prompt_tokens(tokenizer, dialog):
+    """
+    Count the prompt tokens of a dialog exactly as Llama.chat_completion encodes it.
+
+    :param tokenizer: A Llama tokenizer with an encode(s, bos, eos) method.
+    :param dialog: A list of {'role', 'content'} messages ending with a user message.
+    :return: The number of prompt tokens.
+    """
+    if dialog[0]['role'] == 'system':
+        dialog = [{
+            'role': dialog[1]['role'],
+            'content': B_SYS + dialog[0]['content'] + E_SYS + dialog[1]['content'],
+        }] + dialog[2:]
+    tokens = 0
+    for prompt, answer in zip(dialog[:-1:2], dialog[1::2]):
+        tokens += len(tokenizer.encode(
+            f"{B_INST} {prompt['content'].strip()} {E_INST} {answer['content'].strip()} ", bos=True, eos=True
+        ))
+    tokens += len(tokenizer.encode(f"{B_INST} {dialog[-1]['content'].strip()} {E_INST}", bos=True, eos=False))
+    return tokens
+
+
+def _overlap(left, right, min_overlap, max_overlap):
+    # The length of the longest suffix of left that is also a prefix of right
+    for size in range(min(len(left), len(right), max_overlap), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _shingles(text, size=3):
+    words = re.findall(r'\w+', text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+class ContextPacker:
+    """
+    Turn retrieved hits into the smallest context that still carries their evidence.
+
+    Chunks of the same page that overlap, as consecutive splitter chunks do, are merged into
+    one span; spans mostly contained in a better scored span are dropped; and the remaining
+    spans are added best first for as long as the prompt stays within a token budget counted
+    with the model's own tokenizer.
+    """
+
+    def __init__(self, tokenizer, min_overlap=20, max_overlap=500, duplicate_threshold=0.9):
+        """
+        :param tokenizer: A Llama tokenizer with encode(s, bos, eos) and decode(tokens) methods.
+        :param min_overlap: The minimum number of shared characters for two chunks to be merged.
+        :param max_overlap: The maximum overlap looked for, at least the splitter's chunk_overlap.
+        :param duplicate_threshold: The fraction of a span's word 3-grams found in a better span
+            above which it is dropped as a near-duplicate.
+        """
+        self.tokenizer = tokenizer
+        self.min_overlap = min_overlap
+        self.max_overlap = max_overlap
+        self.duplicate_threshold = duplicate_threshold
+
+    def merge_spans(self, hits):
+        """
+        Merge overlapping chunks and drop near-duplicates.
+
+        :param hits: A list of hit dictionaries with 'id', 'content', 'source', 'page' and 'score' keys.
+        :return: A list of spans ordered by score, best first. Spans are hit dictionaries with an
+            extra 'ids' key listing the chunks they cover, and the best score among them.
+        """
+        spans = [dict(hit, ids=[hit['id']]) for hit in hits if hit.get('content')]
+
+        merged = True
+        while merged:
+            merged = False
+            for i, left in enumerate(spans):
+                for j, right in enumerate(spans):
+                    if i == j or (left['source'], left['page']) != (right['source'], right['page']):
+                        continue
+                    size = _overlap(left['content'], right['content'], self.min_overlap, self.max_overlap)
+                    if size:
+                        best = left if left['score'] >= right['score'] else right
+                        left.update(
+                            id=best['id'],
+                            content=left['content'] + right['content'][size:],
+                            score=best['score'],
+                            ids=left['ids'] + right['ids'],
+                        )
+                        del spans[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        spans.sort(key=lambda span: span['score'], reverse=True)
+        kept = []
+        kept_shingles = []
+        for span in spans:
+            shingles = _shingles(span['content'])
+            if any(len(shingles & other) >= self.duplicate_threshold * len(shingles) for other in kept_shingles):
+                continue
+            kept.append(span)
+            kept_shingles.append(shingles)
+        return kept
+
+    def pack(self, hits, build_dialog, max_prompt_tokens):
+        """
+        Build the dialog with as much context as fits in the prompt budget.
+
+        :param hits: A list of hit dictionaries, see merge_spans.
+        :param build_dialog: A callable taking a list of spans and returning the dialog that carries them.
+        :param max_prompt_tokens: The maximum number of prompt tokens, usually max_seq_len minus the
+            tokens reserved for the answer.
+        :return: A (dialog, spans) tuple with the packed dialog and the spans it includes.
+        """
+        packed = []
+        skipped = []
+        for span in self.merge_spans(hits):
+            if self._fits(build_dialog, packed + [span], max_prompt_tokens):
+                packed.append(span)
+            else:
+                skipped.append(span)
+
+        if skipped:
+            # Fill what is left of the budget with the start of the best span that did not fit
+            span = self._truncate(skipped[0], lambda candidate: self._fits(build_dialog, packed + [candidate], max_prompt_tokens))
+            if span is not None:
+                packed.append(span)
+
+        packed.sort(key=lambda span: span['score'], reverse=True)
+        return build_dialog(packed), packed
+
+    def _fits(self, build_dialog, spans, max_prompt_tokens):
+        return dialog_prompt_tokens(self.tokenizer, build_dialog(spans)) <= max_prompt_tokens
+
+    def _truncate(self, span, fits):
+        """
+        :return: The span cut to the longest token prefix for which fits holds, or None.
+        """
+        tokens = self.tokenizer.encode(span['content'], bos=False, eos=False)
+        low, high = 0, len(tokens)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(dict(span, content=self.tokenizer.decode(tokens[:middle]))):
+                low = middle
+            else:
+                high = middle - 1
+        if low == 0:
+            return None
+        return dict(span, content=self.tokenizer.decode(tokens[:low]))
@@ -3,6 +3,7 @@ import gc
 import json
 import os
 import shutil
+import tempfile
 import warnings
 import torch
 
@@ -218,14 +219,196 @@ def convert_to_llama_70b_2(state_dict, input_base_path, output_llama_dir, num_sh
         path = os.path.join(output_llama_dir, f"consolidated.0{i}.pth")
         torch.save(shard, path)
 
+def _chunk_bounds(size, chunks, unit=1):
+    """
+    Mirror torch.chunk along one dimension.
+
+    :param size: The length of the dimension.
+    :param chunks: The number of chunks asked for.
+    :param unit: The number of rows or columns that stay together, e.g. the rows of one head.
+    :return: A list of (start, end) ranges, which like torch.chunk may hold fewer than chunks.
+    """
+    units = size // unit
+    split = -(-units // chunks)
+    return [(start * unit, min(start + split, units) * unit) for start in range(0, units, split)]
+
+
+def _shard_keys(n_layers):
+    # The order in which convert_to_llama_70b_2 saves the tensors of every shard
+    for layer_i in range(n_layers):
+        for name in ("attention.wq", "attention.wk", "attention.wv", "attention.wo",
+                     "feed_forward.w1", "feed_forward.w2", "feed_forward.w3", "attention_norm", "ffn_norm"):
+            yield f"layers.{layer_i}.{name}.weight"
+    yield "tok_embeddings.weight"
+    yield "norm.weight"
+    yield "output.weight"
+
+
+def _split_layout(key, dims_per_head):
+    """
+    :return: The dimension a tensor is split along across shards and the number of rows or
+        columns that stay together, or None for tensors that are replicated in every shard.
+    """
+    if "norm" in key:
+        return None
+    if "wq" in key or "wk" in key or "wv" in key:
+        # Split by whole heads
+        return 0, dims_per_head
+    if "wo" in key or "w2" in key or "tok_embeddings" in key:
+        return 1, 1
+    return 0, 1
+
+
+def reshard_streaming(input_base_path, output_llama_dir, input_shards=8, output_shards=4, scratch_dir=None):
+    """
+    Reshard a checkpoint from input_shards to output_shards files without consolidating it.
+
+    The inputs are memory-mapped and every output tensor is a file-backed buffer in
+    scratch_dir, filled by copying the slices of the input shards that fall into it, one
+    tensor at a time. Nothing is allocated on the heap beyond the tensor being copied, and the
+    pages of both sides are file-backed, so the kernel writes them back and reclaims them as
+    needed instead of holding the whole model in RAM. The output files are saved from those
+    buffers and are byte-for-byte the files convert_to_llama_70b_1 and convert_to_llama_70b_2
+    write, which --verify checks on small checkpoints.
+
+    Requires torch 2.1 or later for memory-mapped loading.
+
+    :param input_base_path: The directory with params.json and consolidated.NN.pth input shards.
+    :param output_llama_dir: The directory the consolidated.0N.pth output shards are written to.
+    :param input_shards: The number of input shards.
+    :param output_shards: The number of output shards.
+    :param scratch_dir: The directory in which a temporary directory for the output buffers is
+        created and removed when done, needing as much free space as the model. Defaults to
+        output_llama_dir.
+    """
+    params = read_json(os.path.join(input_base_path, "params.json"))
+    n_layers = params["n_layers"]
+    n_heads = params["n_heads"]
+    dim = params["dim"]
+    dims_per_head = dim // n_heads
+
+    base = params.get("rope_theta", 10000.0)
+    inv_freq = 1.0 / (base ** (torch.arange(0, dims_per_head, 2).float() / dims_per_head))
+
+    print(f"Mapping {input_shards} shards of the checkpoint at {input_base_path}.")
+    loaded = [
+        torch.load(os.path.join(input_base_path, f"consolidated.{i:02d}.pth"), map_location="cpu", mmap=True)
+        for i in range(input_shards)
+    ]
+
+    # The buffers go to a private directory, so a scratch_dir given by the caller is never removed
+    scratch_parent = scratch_dir or output_llama_dir
+    os.makedirs(scratch_parent, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix=".reshard-", dir=scratch_parent)
+
+    def buffer(shard_i, key, shape, dtype):
+        # An empty tensor backed by its own file, so it is saved with its own storage like a clone
+        path = os.path.join(scratch_dir, f"{shard_i:02d}.{key}")
+        numel = 1
+        for size in shape:
+            numel *= size
+        with open(path, "wb") as f:
+            f.truncate(numel * torch.empty(0, dtype=dtype).element_size())
+        return torch.from_file(path, shared=True, size=numel, dtype=dtype).view(shape)
+
+    weight_shards = [{} for _ in range(output_shards)]
+    try:
+        for key in _shard_keys(n_layers):
+            parts = [shard[key] for shard in loaded]
+            layout = _split_layout(key, dims_per_head)
+            if layout is None:
+                # Norms are taken from the first input shard and replicated
+                for shard_i in range(output_shards):
+                    weight_shards[shard_i][key] = buffer(shard_i, key, parts[0].shape, parts[0].dtype)
+                    weight_shards[shard_i][key].copy_(parts[0])
+                continue
+
+            axis, unit = layout
+            offsets = [0]
+            for part in parts:
+                offsets.append(offsets[-1] + part.shape[axis])
+            bounds = _chunk_bounds(offsets[-1], output_shards, unit)
+            if len(bounds) != output_shards:
+                raise ValueError(f"{key} cannot be split into {output_shards} shards along dimension {axis}.")
+
+            for shard_i, (start, end) in enumerate(bounds):
+                shape = list(parts[0].shape)
+                shape[axis] = end - start
+                out = buffer(shard_i, key, shape, parts[0].dtype)
+                for part, offset in zip(parts, offsets):
+                    # The part of this input shard that falls into the output shard
+                    low = max(start, offset)
+                    high = min(end, offset + part.shape[axis])
+                    if low < high:
+                        out.narrow(axis, low - start, high - low).copy_(part.narrow(axis, low - offset, high - low))
+                weight_shards[shard_i][key] = out
+
+        for shard_i in range(output_shards):
+            weight_shards[shard_i]["rope.freqs"] = inv_freq.to(torch.bfloat16).clone()
+
+        for shard_i, shard in enumerate(weight_shards):
+            # torch.save names the archive after the file, so the file is saved under its final name
+            # in the scratch directory and moved into place once complete
+            name = f"consolidated.0{shard_i}.pth"
+            torch.save(shard, os.path.join(scratch_dir, name))
+            os.replace(os.path.join(scratch_dir, name), os.path.join(output_llama_dir, name))
+            print(f"Saved {name}.")
+    finally:
+        del weight_shards, loaded
+        gc.collect()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def verify_against_legacy(input_base_path, output_llama_dir, input_shards=8, output_shards=4):
+    """
+    Run the consolidating conversion into a temporary directory and compare its files with
+    those in output_llama_dir byte for byte. It holds the whole model in memory several times,
+    so it is meant for small checkpoints.
+
+    :return: True if every output shard is identical.
+    """
+    import filecmp
+
+    with tempfile.TemporaryDirectory(dir=output_llama_dir) as legacy_dir:
+        state_dict = convert_to_llama_70b_1(input_base_path, num_shards=input_shards)
+        convert_to_llama_70b_2(state_dict, input_base_path, legacy_dir, num_shards=output_shards)
+        del state_dict
+        identical = True
+        for shard_i in range(output_shards):
+            name = f"consolidated.0{shard_i}.pth"
+            same = filecmp.cmp(os.path.join(legacy_dir, name), os.path.join(output_llama_dir, name), shallow=False)
+            print(f"{name}: {'identical' if same else 'DIFFERENT'}")
+            identical = identical and same
+    return identical
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_llama_path", help="Path to input llama.")
     parser.add_argument("--input_shards", type=int, default=8)
     parser.add_argument("--output_llama_path", help="Path to save the converted LLaMA model.")
     parser.add_argument("--output_shards", type=int, default=4)
+    parser.add_argument("--streaming", action="store_true",
+                        help="Reshard tensor by tensor from memory-mapped inputs instead of consolidating the model in RAM.")
+    parser.add_argument("--scratch_dir", help="Where --streaming creates its temporary directory of output buffers, defaults to the output directory.")
+    parser.add_argument("--verify", action="store_true",
+                        help="After --streaming, compare the output with the consolidating conversion. Small models only.")
     args = parser.parse_args()
     os.makedirs(args.output_llama_path, exist_ok=True)
+
+    if args.streaming:
+        reshard_streaming(
+            args.input_llama_path,
+            args.output_llama_path,
+            input_shards=args.input_shards,
+            output_shards=args.output_shards,
+            scratch_dir=args.scratch_dir,
+        )
+        if args.verify and not verify_against_legacy(
+            args.input_llama_path, args.output_llama_path, args.input_shards, args.output_shards
+        ):
+            raise SystemExit("The streamed shards differ from the consolidating conversion.")
+        return
     
     state_dict1 = convert_to_llama_70b_1(
         args.input_llama_path,
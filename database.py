@@ -1,281 +1,1890 @@
+import concurrent.futures
+import datetime
+import hashlib
+import itertools
+import queue
+import re
 import sqlite3
 import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# langchain, chromadb and the embedding model are imported on first use, so processes that only
+# touch SQLite (deleting a source, counting documents) start without paying for them
+from compression import ChunkCodec, train_dictionary
+from page_cache import file_hash
+from query_cache import QueryCache
+from pdfloader import PDFProcessor
+
 
+def content_hash(content):
+    """
+    Hash the content of a document chunk for duplicate detection.
+
+    :param content: The text of the chunk.
+    :return: The hex SHA-256 digest of the text.
+    """
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _timestamp_ns(value, end=False):
+    """
+    Convert a date filter bound to nanoseconds since the epoch, the unit of the manifest MTime.
+
+    :param value: A datetime, a date or a POSIX timestamp in seconds.
+    :param end: Whether this is the upper bound, in which case a date covers the whole day.
+    """
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp() * 1e9)
+    if isinstance(value, datetime.date):
+        if end:
+            value += datetime.timedelta(days=1)
+        midnight = datetime.datetime.combine(value, datetime.time())
+        return int(midnight.timestamp() * 1e9) - (1 if end else 0)
+    return int(value * 1e9)
+
+
+def embed_queries(embedding_function, texts):
+    """
+    Embed query texts with the query side of an embedding model.
+
+    Models may embed queries and documents differently, so queries never go through
+    embed_documents unless the function says it is equivalent by providing embed_queries.
+
+    :param embedding_function: A langchain Embeddings object.
+    :param texts: A list of query texts.
+    :return: A list of vectors aligned with texts, from one batched call when the function
+        has an embed_queries method and one embed_query call per text otherwise.
+    """
+    embed_many = getattr(embedding_function, 'embed_queries', None)
+    if embed_many is not None:
+        return embed_many(texts)
+    return [embedding_function.embed_query(text) for text in texts]
+
+
+def format_hits(hits):
+    """
+    Render query hits as numbered text with their sources, the format of the LLM context.
+
+    :param hits: A list of hit dictionaries as returned by ChromaDBManager.query.
+    :return: The formatted string.
+    """
+    result_string = ""
+    for i, hit in enumerate(hits, start=1):
+        result_string += f"{i}: {hit['content']}\nSource: {hit['source']}\n\n"
+    return result_string
+
+
+def reciprocal_rank_fusion(ranked_lists, k=60):
+    """
+    Fuse several ranked lists of hits with reciprocal-rank fusion.
+
+    :param ranked_lists: A list of hit lists, each ordered best first.
+    :param k: The rank offset that damps the weight of the top ranks.
+    :return: The fused hits, best first, with 'score' replaced by the fused score.
+    """
+    scores = {}
+    hits = {}
+    for ranked in ranked_lists:
+        for rank, hit in enumerate(ranked, start=1):
+            scores[hit['id']] = scores.get(hit['id'], 0.0) + 1.0 / (k + rank)
+            hits.setdefault(hit['id'], hit)
+    fused = sorted(scores, key=scores.get, reverse=True)
+    return [dict(hits[id_], score=scores[id_]) for id_ in fused]
+
+
+def prefetch(iterable, maxsize=4):
+    """
+    Iterate over an iterable in a background thread that runs at most maxsize items ahead.
+
+    Chaining generators through prefetch turns them into pipeline stages that work
+    concurrently. A stage blocks once maxsize items wait for the next one, so a slow stage
+    applies backpressure instead of letting memory grow. Exceptions are re-raised in the
+    consumer, and closing the consumer stops the background thread.
+
+    :param iterable: The iterable to consume, e.g. a generator.
+    :param maxsize: The maximum number of items buffered between the two threads.
+    :return: A generator over the items of iterable.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            # Generators are closed in the thread that runs them
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class SQLiteConnectionPool:
+    """
+    A thread-safe pool of SQLite connections opened in WAL mode.
+
+    In WAL mode readers never block the writer and the writer never blocks readers, so any
+    number of threads can read through connection() while a single ingest writer holds
+    transaction(). Writers are serialized in-process with a lock instead of spinning on
+    "database is locked". Every connection keeps its own prepared statement cache, so
+    statements issued with the same SQL text are compiled once per connection.
+    """
+
+    def __init__(self, db_path, pool_size=4, timeout=30.0, cached_statements=256, on_connect=None):
+        """
+        :param db_path: The path to the SQLite database file.
+        :param pool_size: The maximum number of open connections.
+        :param timeout: Seconds to wait for a free connection or for a lock held by another process.
+        :param cached_statements: The size of the prepared statement cache of each connection.
+        :param on_connect: An optional callable run on every new connection, e.g. to register functions.
+        """
+        self.db_path = db_path
+        self.on_connect = on_connect
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')
+        conn.execute('PRAGMA mmap_size=268435456')
+        if self.on_connect is not None:
+            self.on_connect(conn)
+        return conn
+
+    def _acquire(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError('Cannot use a closed connection pool.')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.pool_size:
+                conn = self._connect()
+                self._all.append(conn)
+                return conn
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f'No free connection to {self.db_path} after {self.timeout}s.')
 
-import chromadb
+    def _release(self, conn):
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
 
-from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
-from langchain.vectorstores import Chroma
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for reading. Statements run in autocommit mode.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Borrow a connection and hold the single writer slot for one write transaction.
+        The transaction is committed on success and rolled back if the block raises.
+        """
+        with self._write_lock:
+            with self.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield conn
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+
+    def close(self):
+        """
+        Close every connection. Connections still borrowed are closed when they are returned.
+        """
+        with self._lock:
+            self._closed = True
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._all = []
 
-from pdfloader import PDFProcessor
 
 class SQLiteDBManager:
-    def __init__(self, db_path='my_database.db'):
+    def __init__(self, db_path='my_database.db', pool_size=4, compression=None, compression_level=None):
+        """
+        :param db_path: The path to the SQLite database file.
+        :param pool_size: The maximum number of pooled connections.
+        :param compression: None to store chunks as plain text, or 'zlib' / 'zstd' to store newly
+            inserted chunks compressed. Databases may mix both; chunks are decompressed on read.
+        :param compression_level: The compression level passed to the codec.
+        """
         self.db_path = db_path
+        self.codec = ChunkCodec(compression, compression_level, dictionary_loader=self._load_dictionary)
+        self.pool = SQLiteConnectionPool(db_path, pool_size=pool_size)
         self._initialize_db()
 
-    def _initialize_db(self):
-        # Check if the database file exists
-        db_exists = os.path.exists(self.db_path)
+        if compression == 'zstd' and self.codec.dictionaries:
+            # Compress with the most recently trained dictionary, if any
+            dictionary_id = max(self.codec.dictionaries)
+            self.codec.use_dictionary(dictionary_id, self.codec.dictionaries[dictionary_id])
 
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+    def _load_dictionary(self, dictionary_id):
+        # Dictionaries are loaded when the database is opened; one trained since by another process
+        # is read on a private connection, so decoding never waits for a pooled one
+        conn = sqlite3.connect(self.db_path, timeout=self.pool.timeout)
+        try:
+            row = conn.execute('SELECT Data FROM compression_dictionaries WHERE ID = ?', (dictionary_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            raise ValueError(f"Compression dictionary {dictionary_id} is missing from {self.db_path}.")
+        return row[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close all pooled connections to the SQLite database.
+        """
+        self.pool.close()
 
-        if not db_exists:
-            # Create table if database does not exist
-            c.execute('''
+    def _initialize_db(self):
+        with self.pool.transaction() as conn:
+            # Create table if it does not exist yet
+            conn.execute('''
             CREATE TABLE IF NOT EXISTS documents (
                 ID INTEGER PRIMARY KEY,
                 Content TEXT,
                 Source TEXT,
-                Page INTEGER
+                Page INTEGER,
+                ContentHash TEXT
             )
             ''')
-            conn.commit()
 
-        conn.close()
-    
+            # Trained zstd dictionaries, referenced by ID from compressed chunks. They are all loaded
+            # now, so chunks can be decoded without going back to the database
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS compression_dictionaries (
+                ID INTEGER PRIMARY KEY,
+                Data BLOB,
+                CreatedAt REAL
+            )
+            ''')
+            for dictionary_id, data in conn.execute('SELECT ID, Data FROM compression_dictionaries'):
+                self.codec.dictionaries[dictionary_id] = data
+
+            self._initialize_keyword_index(conn)
+
+            # Bring databases created before the ContentHash column up to date
+            self._migrate_db(conn)
+
+            # IDs of rows removed by a migration whose vectors are still in the vector store,
+            # purged by ChromaDBManager the next time it opens the store
+            conn.execute('CREATE TABLE IF NOT EXISTS orphaned_vectors (ID INTEGER PRIMARY KEY)')
+            index_exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_documents_source_page_hash'"
+            ).fetchone()
+            if index_exists is None:
+                self._dedupe_documents(conn)
+
+            # Duplicate chunks are detected through this index instead of scanning the table
+            conn.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_documents_source_page_hash
+            ON documents (Source, Page, ContentHash)
+            ''')
+            # Serves page range filters that do not name a source
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_documents_page ON documents (Page)')
+
+            # Manifest of ingested source files, used to skip unchanged files on re-ingestion
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS sources (
+                Source TEXT PRIMARY KEY,
+                Size INTEGER,
+                MTime INTEGER,
+                FileHash TEXT,
+                IngestedAt REAL
+            )
+            ''')
+            # Serves date range filters
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sources_mtime ON sources (MTime)')
+
+    # Schema objects must not call functions registered in Python, so that any SQLite client can
+    # still write to the documents table
+    KEYWORD_INDEX_TRIGGERS = {
+        # Compressed chunks are BLOBs, _insert_staged_documents indexes their text itself
+        'documents_fts_insert': '''
+        CREATE TRIGGER documents_fts_insert AFTER INSERT ON documents WHEN typeof(new.Content) = 'text' BEGIN
+            INSERT INTO documents_fts (rowid, Content) VALUES (new.ID, new.Content);
+        END''',
+        'documents_fts_delete': '''
+        CREATE TRIGGER documents_fts_delete AFTER DELETE ON documents BEGIN
+            DELETE FROM documents_fts WHERE rowid = old.ID;
+        END''',
+        # Compressing a chunk in place leaves its text, and so its index entry, unchanged
+        'documents_fts_update': '''
+        CREATE TRIGGER documents_fts_update AFTER UPDATE OF Content ON documents
+        WHEN typeof(new.Content) = 'text' BEGIN
+            DELETE FROM documents_fts WHERE rowid = old.ID;
+            INSERT INTO documents_fts (rowid, Content) VALUES (new.ID, new.Content);
+        END''',
+    }
+
+    def _initialize_keyword_index(self, conn, batch_size=1000):
+        """
+        Create the FTS5 keyword index over the chunk text, or bring an older one up to date.
+
+        The index keeps its own plain-text copy of every chunk, so compressed chunks are
+        searchable without decompressing anything in SQL.
+
+        :param conn: A connection with an open write transaction.
+        :param batch_size: The number of chunks indexed per statement when the index is rebuilt.
+        """
+        fts_sql = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'documents_fts'"
+        ).fetchone()
+        if fts_sql is not None and 'content=' in fts_sql[0]:
+            # Indexes created before read the text from documents or through a decompress() view
+            for trigger in self.KEYWORD_INDEX_TRIGGERS:
+                conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            conn.execute('DROP TABLE documents_fts')
+            conn.execute('DROP VIEW IF EXISTS documents_text')
+            fts_sql = None
+
+        existing = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"))
+        for name, sql in self.KEYWORD_INDEX_TRIGGERS.items():
+            if existing.get(name) != sql.strip():
+                conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+                conn.execute(sql)
+
+        if fts_sql is None:
+            conn.execute('CREATE VIRTUAL TABLE documents_fts USING fts5(Content)')
+            # Index the documents stored before the keyword index existed
+            count = 0
+            last_id = 0
+            while True:
+                rows = conn.execute(
+                    'SELECT ID, Content FROM documents WHERE ID > ? ORDER BY ID LIMIT ?', (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                conn.executemany(
+                    'INSERT INTO documents_fts (rowid, Content) VALUES (?, ?)',
+                    [(id_, self.codec.decode(content)) for id_, content in rows],
+                )
+                count += len(rows)
+                last_id = rows[-1][0]
+            if count:
+                print(f"Indexed {count} chunks of {self.db_path} for keyword search.")
+
+    def _migrate_db(self, conn):
+        """
+        Add and backfill the ContentHash column on databases created by older versions.
+
+        :param conn: A connection with an open write transaction.
+        """
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(documents)')]
+        if 'ContentHash' in columns:
+            return
+
+        print(f"Migrating {self.db_path}: adding content hashes to existing documents.")
+        conn.create_function('content_hash', 1, content_hash, deterministic=True)
+        conn.execute('ALTER TABLE documents ADD COLUMN ContentHash TEXT')
+        conn.execute('UPDATE documents SET ContentHash = content_hash(Content)')
+
+    def _dedupe_documents(self, conn):
+        """
+        Keep only the oldest copy of every (Source, Page, ContentHash) chunk, so the unique index
+        can be created on databases filled before it existed.
+
+        :param conn: A connection with an open write transaction.
+        """
+        # GROUP BY treats NULL pages as equal, unlike the unique index
+        rows = conn.execute('''
+        DELETE FROM documents WHERE ID NOT IN (
+            SELECT MIN(ID) FROM documents GROUP BY Source, Page, ContentHash
+        ) RETURNING ID
+        ''').fetchall()
+        if rows:
+            print(f"Migrating {self.db_path}: removed {len(rows)} duplicate chunks.")
+            conn.executemany('INSERT OR IGNORE INTO orphaned_vectors (ID) VALUES (?)', rows)
+
+    def get_orphaned_vector_ids(self):
+        """
+        :return: The list of IDs of rows removed by a migration whose vectors may still be stored.
+        """
+        with self.pool.connection() as conn:
+            return [row[0] for row in conn.execute('SELECT ID FROM orphaned_vectors')]
+
+    def clear_orphaned_vector_ids(self, ids):
+        """
+        :param ids: The IDs whose vectors have been deleted from the vector store.
+        """
+        with self.pool.transaction() as conn:
+            conn.executemany('DELETE FROM orphaned_vectors WHERE ID = ?', [(id_,) for id_ in ids])
+
     def insert_documents(self, documents):
         """
         Insert multiple documents into the SQLite database if they do not already exist.
         Do not insert if the document already exists.
 
         :param documents: A list of Document objects.
-        :param db_path: The path to the SQLite database file.
         :return: Two dictionaries with sources as keys and lists of IDs as values.
         """
-        # Connect to the SQLite database
-        db_path = self.db_path
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
+        document_ids = self.insert_documents_bulk(documents)
+        if document_ids is None:
+            return {}, {}
 
         # Dictionaries to store the IDs of the documents grouped by source
         new_document_ids_by_source = {}
         existing_document_ids_by_source = {}
 
-        try:
-            # Begin a transaction
-            conn.execute('BEGIN TRANSACTION;')
+        for document, (document_id, is_new) in zip(documents, document_ids):
+            source = document.metadata['source']
+            if is_new:
+                new_document_ids_by_source.setdefault(source, []).append(document_id)
+            else:
+                existing_document_ids_by_source.setdefault(source, []).append(document_id)
+
+        # Remove duplicates from lists and return
+        for source in existing_document_ids_by_source:
+            existing_document_ids_by_source[source] = list(set(existing_document_ids_by_source[source]))
+        for source in new_document_ids_by_source:
+            new_document_ids_by_source[source] = list(set(new_document_ids_by_source[source]))
+        return new_document_ids_by_source, existing_document_ids_by_source
 
-            for document in documents:
-                source = document.metadata['source']
-                page = document.metadata['page']
-                content = document.page_content
+    def insert_documents_bulk(self, documents, sync_vectors=None):
+        """
+        Insert a batch of documents with a handful of set-based statements.
 
-                # Check if the document already exists
-                c.execute('SELECT ID FROM documents WHERE Source = ? AND Page = ? AND Content = ?', (source, page, content))
-                existing_doc_id = c.fetchone()
+        The batch is staged in a temporary table, inserted with a single INSERT that skips chunks
+        already stored under the same (Source, Page, ContentHash) key, and resolved back to IDs
+        with one indexed join, so the cost grows linearly with the size of the batch. Chunks
+        without a page number are deduplicated like the others.
 
-                if existing_doc_id:
-                    # Document already exists, skip insertion and add to existing_document_ids_by_source
-                    existing_document_ids_by_source.setdefault(source, []).append(existing_doc_id[0])
-                else:
-                    # Insert a new document
-                    c.execute('''
-                    INSERT INTO documents (Content, Source, Page) VALUES (?, ?, ?)
-                    ''', (content, source, page))
-                    new_document_id = c.lastrowid
-                    new_document_ids_by_source.setdefault(source, []).append(new_document_id)
+        :param documents: A list of Document objects.
+        :param sync_vectors: An optional callable taking the list of (ID, is_new) tuples, called
+            before the commit so the vector store can be updated; if it raises, the insert is rolled back.
+        :return: A list of (ID, is_new) tuples aligned with documents, or None on error.
+            Chunks repeated within the batch share the same ID.
+        """
+        if not documents:
+            return []
 
-            # Commit the changes to the database
-            conn.commit()
+        try:
+            with self.pool.transaction() as conn:
+                document_ids = self._insert_staged_documents(conn, documents)
+                if sync_vectors is not None:
+                    sync_vectors(document_ids)
+                return document_ids
 
         except sqlite3.Error as e:
-            # Rollback on any error
-            conn.rollback()
             print(f"An error occurred: {e}")
-            return {}, {}
+            return None
 
-        finally:
-            # Close the connection
-            conn.close()
+    def _insert_staged_documents(self, conn, documents):
+        """
+        Stage, insert and resolve a batch of documents inside an open write transaction.
 
-        # Remove duplicates from lists and return
-        for source in existing_document_ids_by_source:
-            existing_document_ids_by_source[source] = list(set(existing_document_ids_by_source[source]))
-        for source in new_document_ids_by_source:
-            new_document_ids_by_source[source] = list(set(new_document_ids_by_source[source]))
-        return new_document_ids_by_source, existing_document_ids_by_source
+        :param conn: A connection with an open write transaction.
+        :param documents: A list of Document objects.
+        :return: A list of (ID, is_new) tuples aligned with documents.
+        """
+        c = conn.cursor()
+        c.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS staged_documents (
+            Seq INTEGER PRIMARY KEY,
+            Content TEXT,
+            Source TEXT,
+            Page INTEGER,
+            ContentHash TEXT
+        )
+        ''')
+        c.execute('DELETE FROM staged_documents')
+        c.executemany(
+            'INSERT INTO staged_documents (Seq, Content, Source, Page, ContentHash) VALUES (?, ?, ?, ?, ?)',
+            (
+                (seq, self.codec.encode(document.page_content), document.metadata['source'],
+                 document.metadata['page'], content_hash(document.page_content))
+                for seq, document in enumerate(documents)
+            ),
+        )
 
-    def delete_single_document_by_source(self, source):
+        # Rows are assigned IDs above the current maximum, which tells new rows from existing ones
+        c.execute('SELECT COALESCE(MAX(ID), 0) FROM documents')
+        max_existing_id = c.fetchone()[0]
+
+        # The unique index treats NULL pages as distinct, so stored chunks and repeats within the
+        # batch are skipped explicitly, matching pages with IS
+        c.execute('''
+        INSERT OR IGNORE INTO documents (Content, Source, Page, ContentHash)
+        SELECT Content, Source, Page, ContentHash FROM staged_documents s
+        WHERE Seq IN (SELECT MIN(Seq) FROM staged_documents GROUP BY Source, Page, ContentHash)
+        AND NOT EXISTS (
+            SELECT 1 FROM documents d
+            WHERE d.Source = s.Source AND d.Page IS s.Page AND d.ContentHash = s.ContentHash
+        )
+        ORDER BY Seq
+        ''')
+
+        c.execute('''
+        SELECT s.Seq, d.ID FROM staged_documents s
+        JOIN documents d ON d.Source = s.Source AND d.Page IS s.Page AND d.ContentHash = s.ContentHash
+        ''')
+        ids_by_seq = dict(c.fetchall())
+        # Every staged chunk resolves to exactly one row, so the IDs line up with documents
+        document_ids = [(ids_by_seq[seq], ids_by_seq[seq] > max_existing_id) for seq in range(len(documents))]
+
+        if self.codec.compression is not None:
+            # The insert trigger only indexes plain-text chunks
+            indexed = set()
+            rows = []
+            for document, (document_id, is_new) in zip(documents, document_ids):
+                if is_new and document_id not in indexed:
+                    indexed.add(document_id)
+                    rows.append((document_id, document.page_content))
+            c.executemany('INSERT INTO documents_fts (rowid, Content) VALUES (?, ?)', rows)
+
+        c.execute('DELETE FROM staged_documents')
+        return document_ids
+
+    def get_stored_documents(self, documents):
         """
-        Delete documents from the SQLite database based on the document source.
+        Find which documents are already stored, without writing to the database.
 
-        :param source: The source of the documents to be deleted.
-        :param db_path: The path to the SQLite database file.
-        :return: The IDs of the deleted documents.
+        :param documents: A list of Document objects.
+        :return: A set with the positions in documents of the chunks that are already stored.
         """
-        # Connect to the SQLite database
-        db_path = self.db_path
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
+        with self.pool.connection() as conn:
+            conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS probed_documents (
+                Seq INTEGER PRIMARY KEY,
+                Source TEXT,
+                Page INTEGER,
+                ContentHash TEXT
+            )
+            ''')
+            conn.execute('DELETE FROM probed_documents')
+            conn.executemany(
+                'INSERT INTO probed_documents (Seq, Source, Page, ContentHash) VALUES (?, ?, ?, ?)',
+                (
+                    (seq, document.metadata['source'], document.metadata['page'], content_hash(document.page_content))
+                    for seq, document in enumerate(documents)
+                ),
+            )
+            rows = conn.execute('''
+            SELECT p.Seq FROM probed_documents p
+            JOIN documents d ON d.Source = p.Source AND d.Page IS p.Page AND d.ContentHash = p.ContentHash
+            ''').fetchall()
+            conn.execute('DELETE FROM probed_documents')
+        return {row[0] for row in rows}
+
+    def search_keywords(self, query, limit=10, filters=None):
+        """
+        Rank documents against the terms of a query with BM25 over the keyword index.
+
+        :param query: The free-text query. Every word is matched as a quoted term, so
+            punctuation and FTS5 operators in the query are never interpreted.
+        :param limit: The maximum number of results.
+        :param filters: Optional filters on the matching documents, see resolve_filters.
+        :return: A list of (ID, BM25 score) tuples, best first. Lower scores are better.
+        """
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return []
+        match = ' OR '.join(f'"{term}"' for term in terms)
+
+        with self.pool.connection() as conn:
+            if not filters:
+                rows = conn.execute(
+                    '''
+                    SELECT rowid, bm25(documents_fts) FROM documents_fts
+                    WHERE documents_fts MATCH ? ORDER BY bm25(documents_fts) LIMIT ?
+                    ''',
+                    (match, limit),
+                ).fetchall()
+            else:
+                condition, params = self._filter_condition(conn, filters)
+                rows = conn.execute(
+                    f'''
+                    SELECT documents_fts.rowid, bm25(documents_fts) FROM documents_fts
+                    JOIN documents d ON d.ID = documents_fts.rowid
+                    WHERE documents_fts MATCH ? AND {condition} ORDER BY bm25(documents_fts) LIMIT ?
+                    ''',
+                    (match, *params, limit),
+                ).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def _filter_condition(self, conn, filters):
+        """
+        Translate query filters into a SQL condition on the documents table, aliased d.
+
+        :param conn: A pooled connection, on which the source filter is staged.
+        :param filters: A dictionary of filters, see resolve_filters.
+        :return: A (condition, params) tuple.
+        """
+        unknown = set(filters) - {'sources', 'page_range', 'date_range'}
+        if unknown:
+            raise ValueError(f"Unknown filters {sorted(unknown)}, expected 'sources', 'page_range' or 'date_range'.")
+
+        conditions = []
+        params = []
+        sources = filters.get('sources')
+        if sources is not None:
+            if isinstance(sources, str):
+                sources = [sources]
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS filter_sources (Source TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM filter_sources')
+            conn.executemany('INSERT OR IGNORE INTO filter_sources (Source) VALUES (?)', ((source,) for source in sources))
+            conditions.append('d.Source IN (SELECT Source FROM filter_sources)')
+
+        first_page, last_page = filters.get('page_range') or (None, None)
+        if first_page is not None:
+            conditions.append('d.Page >= ?')
+            params.append(first_page)
+        if last_page is not None:
+            conditions.append('d.Page <= ?')
+            params.append(last_page)
+
+        start, end = filters.get('date_range') or (None, None)
+        if start is not None or end is not None:
+            bounds = []
+            if start is not None:
+                bounds.append('MTime >= ?')
+                params.append(_timestamp_ns(start))
+            if end is not None:
+                bounds.append('MTime <= ?')
+                params.append(_timestamp_ns(end, end=True))
+            conditions.append(f"d.Source IN (SELECT Source FROM sources WHERE {' AND '.join(bounds)})")
+
+        return ' AND '.join(conditions) or '1', params
+
+    def resolve_filters(self, filters):
+        """
+        Find the documents matching query filters with indexed lookups.
+
+        :param filters: A dictionary with any of the keys 'sources', a list of source paths;
+            'page_range', an inclusive (first, last) tuple of page numbers; and 'date_range', an
+            inclusive (start, end) tuple of datetimes, dates or POSIX timestamps, compared with the
+            modification time of the source file recorded in the manifest. Either end of a range
+            may be None.
+        :return: A (ids, sources) tuple with the set of matching document IDs and the set of
+            their sources.
+        """
+        with self.pool.connection() as conn:
+            condition, params = self._filter_condition(conn, filters)
+            rows = conn.execute(f'SELECT d.ID, d.Source FROM documents d WHERE {condition}', params).fetchall()
+        return {row[0] for row in rows}, {row[1] for row in rows}
+
+    def resolve_filter_sources(self, filters):
+        """
+        Check whether any document matches query filters without loading the matching IDs.
+
+        :param filters: A dictionary of filters, see resolve_filters.
+        :return: A (matched, sources) tuple, where matched tells whether any document matches and
+            sources is the set of sources with matching documents, or None if filters restrict
+            neither sources nor dates.
+        """
+        with self.pool.connection() as conn:
+            condition, params = self._filter_condition(conn, filters)
+            if filters.get('sources') is None and filters.get('date_range') is None:
+                row = conn.execute(f'SELECT 1 FROM documents d WHERE {condition} LIMIT 1', params).fetchone()
+                return row is not None, None
+            rows = conn.execute(f'SELECT DISTINCT d.Source FROM documents d WHERE {condition}', params).fetchall()
+        return bool(rows), {row[0] for row in rows}
+
+    def get_documents_by_ids(self, ids):
+        """
+        Fetch stored chunks by ID, decompressing only the chunks that are requested.
+
+        :param ids: A list of document IDs.
+        :return: A dictionary with IDs as keys and (content, source, page) tuples as values.
+        """
+        ids = list(ids)
+        documents = {}
+        with self.pool.connection() as conn:
+            # Stay well below the SQLite limit on bound parameters
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                placeholders = ', '.join('?' * len(batch))
+                rows = conn.execute(
+                    f'SELECT ID, Content, Source, Page FROM documents WHERE ID IN ({placeholders})', batch
+                ).fetchall()
+                documents.update((row[0], (self.codec.decode(row[1]), row[2], row[3])) for row in rows)
+        return documents
+
+    def train_compression_dictionary(self, samples=None, sample_size=2000, dict_size=16384):
+        """
+        Train a zstd dictionary and compress newly inserted chunks with it.
+
+        :param samples: A list of chunk texts to train on. Defaults to a random sample of stored chunks.
+        :param sample_size: The number of stored chunks sampled when samples is not given.
+        :param dict_size: The target size of the dictionary in bytes.
+        :return: The ID of the stored dictionary.
+        """
+        if self.codec.compression != 'zstd':
+            raise ValueError("Compression dictionaries require compression='zstd'.")
+        if samples is None:
+            with self.pool.connection() as conn:
+                rows = conn.execute(
+                    'SELECT Content FROM documents ORDER BY RANDOM() LIMIT ?', (sample_size,)
+                ).fetchall()
+            samples = [self.codec.decode(row[0]) for row in rows]
+
+        data = train_dictionary(samples, dict_size)
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO compression_dictionaries (Data, CreatedAt) VALUES (?, ?)', (data, time.time())
+            )
+            dictionary_id = cursor.lastrowid
+        self.codec.use_dictionary(dictionary_id, data)
+        return dictionary_id
+
+    def compress_existing_documents(self, batch_size=1000):
+        """
+        Re-encode stored chunks with the current compression mode, one transaction per batch.
+
+        :param batch_size: The number of chunks re-encoded per transaction.
+        :return: The number of re-encoded chunks.
+        """
+        count = 0
+        last_id = 0
+        while True:
+            with self.pool.transaction() as conn:
+                rows = conn.execute(
+                    'SELECT ID, Content FROM documents WHERE ID > ? ORDER BY ID LIMIT ?', (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    return count
+                conn.executemany(
+                    'UPDATE documents SET Content = ? WHERE ID = ?',
+                    [(self.codec.encode(self.codec.decode(content)), id_) for id_, content in rows],
+                )
+            count += len(rows)
+            last_id = rows[-1][0]
+
+    def get_source_manifest(self):
+        """
+        Read the manifest of ingested source files.
+
+        :return: A dictionary with sources as keys and (size, mtime_ns, file hash) tuples as values.
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute('SELECT Source, Size, MTime, FileHash FROM sources').fetchall()
+        return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+    def seed_source_manifest(self):
+        """
+        Add a manifest entry without stat data for every source that has documents but no entry,
+        e.g. sources ingested before the manifest existed. Syncing then treats them as modified
+        if they still exist on disk, and purges them if they do not.
+
+        :return: The number of added entries.
+        """
+        with self.pool.transaction() as conn:
+            return conn.execute('''
+            INSERT OR IGNORE INTO sources (Source)
+            SELECT DISTINCT Source FROM documents WHERE Source IS NOT NULL
+            AND Source NOT IN (SELECT Source FROM sources)
+            ''').rowcount
+
+    def update_source_manifest(self, entries):
+        """
+        Record the stat data and hash of source files without touching their documents.
 
-        # Prepare the SQL query to select IDs of documents with the given source
-        select_query = 'SELECT ID FROM documents WHERE Source = ?'
-        delete_query = 'DELETE FROM documents WHERE Source = ?'
-        deleted_ids = []
+        :param entries: A list of (source, size, mtime_ns, file hash) tuples.
+        """
+        with self.pool.transaction() as conn:
+            self._upsert_manifest_entries(conn, entries)
+
+    def _upsert_manifest_entries(self, conn, entries):
+        conn.executemany(
+            '''
+            INSERT INTO sources (Source, Size, MTime, FileHash, IngestedAt) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(Source) DO UPDATE SET
+                Size = excluded.Size, MTime = excluded.MTime,
+                FileHash = excluded.FileHash, IngestedAt = excluded.IngestedAt
+            ''',
+            [(source, size, mtime, hash_, time.time()) for source, size, mtime, hash_ in entries],
+        )
 
+    def replace_source_documents(self, source, documents, manifest_entry=None, sync_vectors=None):
+        """
+        Atomically replace the stored chunks of one source with a freshly parsed set.
+
+        Chunks that are unchanged keep their IDs, chunks that disappeared are deleted and new
+        chunks are inserted, all in one transaction together with the manifest entry. If
+        sync_vectors is given it is called before the commit so the vector store can be
+        updated; if it raises, the SQLite changes are rolled back.
+
+        :param source: The source whose documents are replaced.
+        :param documents: A list of Document objects, all from the given source.
+        :param manifest_entry: An optional (size, mtime_ns, file hash) tuple recorded for the source.
+        :param sync_vectors: An optional callable taking (document_ids, deleted_ids).
+        :return: A (document_ids, deleted_ids) tuple, where document_ids is a list of (ID, is_new)
+            tuples aligned with documents, or None on error.
+        """
         try:
-            # Begin a transaction
-            conn.execute('BEGIN TRANSACTION;')
+            with self.pool.transaction() as conn:
+                document_ids = self._insert_staged_documents(conn, documents)
 
-            # Select the document IDs with the given source
-            c.execute(select_query, (source,))
-            rows = c.fetchall()
-            deleted_ids = [row[0] for row in rows]
+                # Everything stored for the source that is not part of the new parse is stale
+                kept_ids = {document_id for document_id, _ in document_ids}
+                rows = conn.execute('SELECT ID FROM documents WHERE Source = ?', (source,)).fetchall()
+                deleted_ids = [row[0] for row in rows if row[0] not in kept_ids]
+                conn.executemany('DELETE FROM documents WHERE ID = ?', [(id_,) for id_ in deleted_ids])
 
-            # If there are documents to delete, execute the delete query
-            if deleted_ids:
-                c.execute(delete_query, (source,))
+                if manifest_entry is not None:
+                    self._upsert_manifest_entries(conn, [(source,) + tuple(manifest_entry)])
 
-            # Commit the changes to the database
-            conn.commit()
+                if sync_vectors is not None:
+                    sync_vectors(document_ids, deleted_ids)
 
-            # Return the IDs of the deleted documents
-            return deleted_ids
+            return document_ids, deleted_ids
 
         except sqlite3.Error as e:
-            # Rollback on any error
-            conn.rollback()
             print(f"An error occurred: {e}")
             return None
 
-        finally:
-            # Close the connection
-            conn.close()
+    def _stage_sources(self, conn, sources):
+        """
+        Load a list of sources into a temporary table so they can be matched in one statement.
 
+        :param conn: A pooled connection.
+        :param sources: A list of sources.
+        """
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS staged_sources (Source TEXT PRIMARY KEY)')
+        conn.execute('DELETE FROM staged_sources')
+        conn.executemany('INSERT OR IGNORE INTO staged_sources (Source) VALUES (?)', ((source,) for source in sources))
+
+    def get_document_ids_by_sources(self, sources):
+        """
+        Resolve the document IDs of many sources with one indexed join.
+
+        :param sources: A list of sources.
+        :return: A dictionary with sources as keys and lists of document IDs as values.
+        """
+        document_ids = {}
+        with self.pool.connection() as conn:
+            self._stage_sources(conn, sources)
+            # The (Source, Page, ContentHash) index serves the lookup by Source
+            rows = conn.execute('''
+            SELECT d.Source, d.ID FROM staged_sources s JOIN documents d ON d.Source = s.Source
+            ''').fetchall()
+            conn.execute('DELETE FROM staged_sources')
+        for source, document_id in rows:
+            document_ids.setdefault(source, []).append(document_id)
+        return document_ids
+
+    def delete_documents_by_ids(self, ids, sources=()):
+        """
+        Delete documents by ID, and the manifest entries of sources left without documents.
+
+        :param ids: A list of document IDs.
+        :param sources: The sources the IDs belong to, whose manifest entries are dropped once empty.
+        :return: The number of deleted documents, or None on error.
+        """
+        try:
+            with self.pool.transaction() as conn:
+                conn.execute('CREATE TEMP TABLE IF NOT EXISTS staged_ids (ID INTEGER PRIMARY KEY)')
+                conn.execute('DELETE FROM staged_ids')
+                conn.executemany('INSERT OR IGNORE INTO staged_ids (ID) VALUES (?)', ((id_,) for id_ in ids))
+                deleted = conn.execute('DELETE FROM documents WHERE ID IN (SELECT ID FROM staged_ids)').rowcount
+                conn.execute('DELETE FROM staged_ids')
+
+                self._stage_sources(conn, sources)
+                conn.execute('''
+                DELETE FROM sources WHERE Source IN (SELECT Source FROM staged_sources)
+                AND NOT EXISTS (SELECT 1 FROM documents d WHERE d.Source = sources.Source)
+                ''')
+                conn.execute('DELETE FROM staged_sources')
+
+            return deleted
+
+        except sqlite3.Error as e:
+            print(f"An error occurred: {e}")
+            return None
+
+    def rename_sources(self, renames, sync_vectors=None):
+        """
+        Move the documents and manifest entries of sources to new paths, in one transaction.
+
+        Chunks keep their IDs, so nothing needs to be parsed or embedded again. Renames whose new
+        source already has documents or a manifest entry are skipped. If sync_vectors is given it
+        is called before the commit; if it raises, the SQLite changes are rolled back.
+
+        :param renames: A dictionary with old sources as keys and new sources as values.
+        :param sync_vectors: An optional callable taking a dictionary with new sources as keys and
+            the lists of their document IDs as values.
+        :return: A dictionary with the renamed new sources as keys and lists of their document
+            IDs as values, or None on error.
+        """
+        try:
+            with self.pool.transaction() as conn:
+                renamed = {}
+                for old, new in renames.items():
+                    taken = conn.execute(
+                        'SELECT 1 FROM documents WHERE Source = ? UNION ALL SELECT 1 FROM sources WHERE Source = ?',
+                        (new, new),
+                    ).fetchone()
+                    if taken is not None:
+                        continue
+                    rows = conn.execute(
+                        'UPDATE documents SET Source = ? WHERE Source = ? RETURNING ID', (new, old)
+                    ).fetchall()
+                    moved = conn.execute('UPDATE sources SET Source = ? WHERE Source = ?', (new, old)).rowcount
+                    if rows or moved:
+                        renamed[new] = [row[0] for row in rows]
+
+                if sync_vectors is not None:
+                    sync_vectors(renamed)
+
+            return renamed
+
+        except sqlite3.Error as e:
+            print(f"An error occurred: {e}")
+            return None
+
+    def delete_single_document_by_source(self, source):
+        """
+        Delete documents from the SQLite database based on the document source.
+
+        :param source: The source of the documents to be deleted.
+        :return: The IDs of the deleted documents.
+        """
+        deleted_documents = self.delete_multiple_documents_by_sources([source])
+        if deleted_documents is None:
+            return None
+        return deleted_documents.get(source, [])
 
     def delete_multiple_documents_by_sources(self, sources):
         """
         Delete documents from the SQLite database based on a list of document sources.
 
+        The sources are staged in a temporary table and all their documents are deleted with a
+        single indexed DELETE ... RETURNING, together with their manifest entries.
+
         :param sources: A list of sources of the documents to be deleted.
-        :param db_path: The path to the SQLite database file.
         :return: A dictionary with sources as keys and the list of deleted document IDs for each source as values.
         """
-        # Connect to the SQLite database
-        db_path = self.db_path
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-
         # Dictionary to store the sources and their corresponding deleted document IDs
         deleted_documents = {}
 
         try:
-            # Begin a transaction
-            conn.execute('BEGIN TRANSACTION;')
-
-            for source in sources:
-                # Select the document IDs with the given source
-                c.execute('SELECT ID FROM documents WHERE Source = ?', (source,))
-                rows = c.fetchall()
-                deleted_ids = [row[0] for row in rows]
-
-                # If there are documents to delete, execute the delete query
-                if deleted_ids:
-                    c.execute('DELETE FROM documents WHERE Source = ?', (source,))
-                    deleted_documents[source] = deleted_ids
-
-            # Commit the changes to the database
-            conn.commit()
+            with self.pool.transaction() as conn:
+                self._stage_sources(conn, sources)
+                rows = conn.execute('''
+                DELETE FROM documents WHERE Source IN (SELECT Source FROM staged_sources) RETURNING Source, ID
+                ''').fetchall()
+                conn.execute('DELETE FROM sources WHERE Source IN (SELECT Source FROM staged_sources)')
+                conn.execute('DELETE FROM staged_sources')
 
         except sqlite3.Error as e:
-            # Rollback on any error
-            conn.rollback()
             print(f"An error occurred: {e}")
             return None
 
-        finally:
-            # Close the connection
-            conn.close()
-
+        for source, document_id in rows:
+            deleted_documents.setdefault(source, []).append(document_id)
         return deleted_documents
 
+    def has_documents(self):
+        """
+        :return: Whether any document is stored.
+        """
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT 1 FROM documents LIMIT 1').fetchone() is not None
+
+    def iter_documents(self, batch_size=1000):
+        """
+        Read every stored chunk in ID order, one batch at a time.
+
+        :param batch_size: The number of chunks read per query.
+        :return: An iterator of lists of (ID, content, source, page) tuples.
+        """
+        last_id = 0
+        while True:
+            with self.pool.connection() as conn:
+                rows = conn.execute(
+                    'SELECT ID, Content, Source, Page FROM documents WHERE ID > ? ORDER BY ID LIMIT ?',
+                    (last_id, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            yield [(id_, self.codec.decode(content), source, page) for id_, content, source, page in rows]
+            last_id = rows[-1][0]
 
     def check_document_exists(self, source):
         """
-        Check if a document exists in the SQLite database based on its source and page.
+        Check if a document exists in the SQLite database based on its source.
 
         :param source: The source of the document to check.
-        :param page: The page number of the document to check.
-        :param db_path: The path to the SQLite database file.
-        :return: True if the document exists, False otherwise.
+        :return: The IDs of the chunks stored for the source.
         """
-        # Connect to the SQLite database
-        db_path = self.db_path
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-
-        # Check if the document exists
-        c.execute('SELECT ID FROM documents WHERE Source = ?', (source,))
-        exists = c.fetchall()
-        exists_id = [row[0] for row in exists]
+        with self.pool.connection() as conn:
+            # Check if the document exists
+            exists = conn.execute('SELECT ID FROM documents WHERE Source = ?', (source,)).fetchall()
 
-        # Close the connection
-        conn.close()
+        return [row[0] for row in exists]
 
-        return exists_id
+    def get_stored_sources(self, sources):
+        """
+        :param sources: A list of sources.
+        :return: The set of those sources that have chunks stored.
+        """
+        sources = list(sources)
+        stored = set()
+        with self.pool.connection() as conn:
+            # Stay well below the SQLite limit on bound parameters
+            for start in range(0, len(sources), 500):
+                batch = sources[start:start + 500]
+                placeholders = ', '.join('?' * len(batch))
+                rows = conn.execute(
+                    f'SELECT DISTINCT Source FROM documents WHERE Source IN ({placeholders})', batch
+                ).fetchall()
+                stored.update(row[0] for row in rows)
+        return stored
+
+
+class LazySentenceTransformerEmbeddings:
+    """
+    SentenceTransformerEmbeddings that import langchain and load the model on the first embedding call.
+    """
+
+    def __init__(self, model_name="all-MiniLM-L6-v2"):
+        self.model_name = model_name
+        self._embeddings = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._embeddings is None:
+                from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+                self._embeddings = SentenceTransformerEmbeddings(model_name=self.model_name)
+        return self._embeddings
+
+    def embed_documents(self, texts):
+        return self._load().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self._load().embed_query(text)
+
+    def embed_queries(self, texts):
+        # SentenceTransformerEmbeddings embeds a query exactly like a document, so a batch of
+        # queries can share one forward pass
+        return self._load().embed_documents(texts)
 
 
 class ChromaDBManager:
-    def __init__(self, db_path='my_database.db', chroma_save_path='./chroma_db', embedding_function=SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")):
+    def __init__(self, db_path='my_database.db', chroma_save_path=None, embedding_function=None, compression=None, embedding_cache_dir=None, query_cache_size=1024, vector_backend='chroma', vector_quantization=None, answer_cache=None):
+        if vector_backend not in ('chroma', 'numpy'):
+            raise ValueError(f"Unknown vector backend {vector_backend!r}, expected 'chroma' or 'numpy'.")
+        if vector_quantization is not None and vector_backend != 'numpy':
+            raise ValueError("vector_quantization requires vector_backend='numpy'.")
+        if chroma_save_path is None:
+            # Each backend gets its own directory, so switching backends never mixes their files
+            chroma_save_path = './chroma_db' if vector_backend == 'chroma' else './numpy_db'
+
+        self.vector_backend = vector_backend
+        self.vector_quantization = vector_quantization
         self.chroma_save_path = chroma_save_path
-        self.sqlite_db_manager = SQLiteDBManager(db_path)
+        self.sqlite_db_manager = SQLiteDBManager(db_path, compression=compression)
         self.db_path = db_path
+        if embedding_function is None:
+            embedding_function = LazySentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+        self.embedding_cache = None
+        if embedding_cache_dir is not None:
+            from embedding_cache import CachedEmbeddings
+
+            # Chunks embedded before, e.g. before rebuilding chroma_db, are served from disk
+            embedding_function = self.embedding_cache = CachedEmbeddings(embedding_function, embedding_cache_dir)
         self.embedding_function = embedding_function
-        self.chroma_instance = Chroma(persist_directory=chroma_save_path, embedding_function=embedding_function)
+        self._vector_store = None
+        self._vector_store_lock = threading.Lock()
+        self._search_executor = None
+        # Every add and delete bumps the generation of this cache so stale results are never served
+        self.query_cache = QueryCache(max_embeddings=query_cache_size, max_results=query_cache_size)
+        if isinstance(answer_cache, str):
+            from answer_cache import AnswerCache
+
+            answer_cache = AnswerCache(answer_cache)
+        # Answers built on a source are dropped whenever that source is deleted, replaced or renamed
+        self.answer_cache = answer_cache
+
+    @property
+    def vector_store(self):
+        """
+        The VectorStore holding the embeddings, opened on first use.
+        """
+        with self._vector_store_lock:
+            if self._vector_store is None:
+                from vector_store import ChromaVectorStore, NumpyVectorStore
 
-    def add_documents_to_chroma(self, documents):
-        # Insert documents into the SQL database and get the new and existing IDs
-        new_document_ids_by_source, existing_document_ids_by_source = self.sqlite_db_manager.insert_documents(documents)
+                if self.vector_backend == 'numpy':
+                    self._vector_store = NumpyVectorStore(self.chroma_save_path, quantization=self.vector_quantization)
+                else:
+                    self._vector_store = ChromaVectorStore(self.chroma_save_path, self.embedding_function)
+
+                # Duplicates removed by a migration would otherwise still be returned by searches
+                orphaned = self.sqlite_db_manager.get_orphaned_vector_ids()
+                if orphaned:
+                    self._vector_store.delete([str(id_) for id_ in orphaned])
+                    self.sqlite_db_manager.clear_orphaned_vector_ids(orphaned)
+
+                if not self._vector_store.count() and self.sqlite_db_manager.has_documents():
+                    # Deduplication finds every chunk in SQLite, so adding documents never fills
+                    # a new store, e.g. after switching backends
+                    print(f"The {self.vector_backend} vector store at {self.chroma_save_path} is empty but "
+                          f"{self.db_path} holds documents, call backfill_vectors() to embed them.")
+        return self._vector_store
+
+    @property
+    def chroma_instance(self):
+        """
+        The langchain Chroma instance, when the Chroma backend is used.
+        """
+        return self.vector_store.chroma_instance
 
-        # For the purpose of adding to Chroma, we only care about new documents
-        new_ids = [str(item) for sublist in list(new_document_ids_by_source.values()) for item in sublist]
+    def __enter__(self):
+        return self
 
-        new_documents = [doc for doc in documents if new_document_ids_by_source.get(doc.metadata['source'])]
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        # Add the new documents and their embeddings to the Chroma vector database
+    def close(self):
+        """
+        Release the SQLite connection pool, search threads, embedding and answer caches and
+        vector store held by this manager.
+        """
+        if self._search_executor is not None:
+            self._search_executor.shutdown(wait=False)
+            self._search_executor = None
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
+        if self.answer_cache is not None:
+            self.answer_cache.close()
+        if self._vector_store is not None:
+            self._vector_store.close()
+            self._vector_store = None
+        self.sqlite_db_manager.close()
+
+    def add_documents_to_chroma(self, documents, batch_size=256):
+        """
+        Add documents to both the SQLite database and the Chroma vector database.
 
-        self.chroma_instance = Chroma.from_documents(
-            documents=new_documents,
-            ids=new_ids,
-            embedding=self.embedding_function,  
-            # collection_name="my_collection",
-            persist_directory=self.chroma_save_path
-        )
+        Only chunks that are not stored yet are embedded. They are appended to the existing
+        collection in batches, each inserted into SQLite in a transaction that commits once its
+        vectors are in Chroma, so a failure never leaves chunks in SQLite without embeddings.
+        If the commit itself fails, the vectors of the batch are deleted again.
+
+        :param documents: An iterable of Document objects, consumed one batch at a time.
+        :param batch_size: The number of chunks inserted, embedded and upserted at a time.
+        :return: The list of IDs that were added.
+        """
+        added_ids = []
+        documents = iter(documents)
+        while True:
+            batch = list(itertools.islice(documents, batch_size))
+            if not batch:
+                break
+
+            batch_ids = []
+
+            def sync_vectors(document_ids, batch=batch):
+                batch_ids.extend(self._add_new_chunks(batch, document_ids, batch_size))
+
+            try:
+                result = self.sqlite_db_manager.insert_documents_bulk(batch, sync_vectors)
+            except Exception as e:
+                print(f"Failed to add documents to Chroma: {e}")
+                result = None
+            if result is None:
+                # The rows were rolled back, their vectors must go too
+                if batch_ids:
+                    self.vector_store.delete(batch_ids)
+                break
+            # Only IDs whose rows were committed are reported
+            added_ids.extend(batch_ids)
+
+        self.query_cache.bump_generation()
+        print(f'successfully add {len(added_ids)} new chunks')
+        return added_ids
+
+    def _add_new_chunks(self, documents, document_ids, batch_size=256, embeddings=None):
+        """
+        Embed and upsert the chunks that SQLite reported as newly inserted.
+
+        :param documents: A list of Document objects.
+        :param document_ids: A list of (ID, is_new) tuples aligned with documents.
+        :param batch_size: The number of chunks embedded and upserted per call.
+        :param embeddings: An optional dictionary of vectors computed ahead of the insert, keyed
+            by _chunk_key. Chunks missing from it are embedded here.
+        :return: The list of IDs that were added.
+        """
+        new_documents = []
+        new_ids = []
+        seen = set()
+        for document, (document_id, is_new) in zip(documents, document_ids):
+            if is_new and document_id not in seen:
+                seen.add(document_id)
+                new_documents.append(document)
+                new_ids.append(str(document_id))
+
+        # Compressed databases serve chunk text from SQLite, so the vector store keeps only vectors and metadata
+        store_text = self.sqlite_db_manager.codec.compression is None
+        vector_store = self.vector_store
+        added = []
+        try:
+            for start in range(0, len(new_documents), batch_size):
+                batch = new_documents[start:start + batch_size]
+                ids = new_ids[start:start + batch_size]
+                texts = [document.page_content for document in batch]
+                if embeddings is None:
+                    vectors = self.embedding_function.embed_documents(texts)
+                else:
+                    vectors = [embeddings.get(self._chunk_key(document)) for document in batch]
+                    missing = [i for i, vector in enumerate(vectors) if vector is None]
+                    if missing:
+                        computed = self.embedding_function.embed_documents([texts[i] for i in missing])
+                        for i, vector in zip(missing, computed):
+                            vectors[i] = vector
+                vector_store.upsert(ids, vectors, [document.metadata for document in batch], texts if store_text else None)
+                added.extend(ids)
+        except Exception:
+            # Leave no vectors behind for rows that are about to be rolled back
+            if added:
+                vector_store.delete(added)
+            raise
+        return new_ids
+
+    def backfill_vectors(self, batch_size=256, remove_stale=True):
+        """
+        Embed the chunks stored in SQLite that have no vector, e.g. after switching to a new
+        vector backend or losing the vector store directory.
 
-        print('successfully add')
+        Adding documents cannot do this, since deduplication reports every stored chunk as
+        present. Chunks already in the store are skipped, so an interrupted backfill resumes
+        where it stopped.
+
+        :param batch_size: The number of chunks embedded and upserted at a time.
+        :param remove_stale: Whether to also delete vectors whose chunks are no longer in SQLite.
+        :return: A (added, removed) tuple with the numbers of vectors added and deleted.
+        """
+        vector_store = self.vector_store
+        stored_ids = set(vector_store.get_ids())
+        store_text = self.sqlite_db_manager.codec.compression is None
+        added = 0
+        seen = set()
+        try:
+            for rows in self.sqlite_db_manager.iter_documents(batch_size):
+                seen.update(str(row[0]) for row in rows)
+                missing = [row for row in rows if str(row[0]) not in stored_ids]
+                if not missing:
+                    continue
+                texts = [content for _, content, _, _ in missing]
+                vector_store.upsert(
+                    [str(id_) for id_, _, _, _ in missing],
+                    self.embedding_function.embed_documents(texts),
+                    [{'source': source, 'page': page} for _, _, source, page in missing],
+                    texts if store_text else None,
+                )
+                added += len(missing)
+                print(f"Backfilled {added} vectors.")
+
+            stale = list(stored_ids - seen) if remove_stale else []
+            if stale:
+                vector_store.delete(stale)
+        finally:
+            self.query_cache.bump_generation()
+        return added, len(stale)
+
+    @staticmethod
+    def _chunk_key(document):
+        return document.metadata['source'], document.metadata['page'], document.page_content
+
+    def ingest_files(self, pdf_processor, paths, manifest_entries=None, batch_size=256, queue_size=4):
+        """
+        Stream PDF files into SQLite and the vector store.
+
+        Parsing and splitting, deduplication against SQLite and embedding, and writing run as
+        pipeline stages connected by bounded queues. Memory therefore stays flat whatever the
+        number of files, and the model embeds one batch while the next files are parsed. Each
+        batch is committed to SQLite and the vector store together, and a file is recorded in
+        the manifest once all its chunks are committed. An interrupted ingest therefore resumes
+        from the last committed batch: sync_directory skips the completed files, and committed
+        chunks of the others are found by deduplication and never embedded again.
+
+        :param pdf_processor: The PDFProcessor used to parse the files.
+        :param paths: A list of file paths.
+        :param manifest_entries: An optional dictionary with paths as keys and (size, mtime_ns,
+            file hash) tuples as values, recorded for each file once it is fully committed.
+        :param batch_size: The number of chunks deduplicated, embedded and written at a time.
+        :param queue_size: The number of files or batches a stage may run ahead of the next.
+        :return: A dictionary with the lists of 'ingested' and 'failed' sources and the list of
+            'added' chunk IDs.
+        """
+        manifest_entries = manifest_entries or {}
+        summary = {'ingested': [], 'failed': [], 'added': []}
+
+        def batches(files):
+            # Group chunks into batches, tagging each with the files it completes
+            batch, completed = [], []
+            for path, documents, error in files:
+                if error is not None:
+                    print(f"Failed to load {path}: {error}")
+                    summary['failed'].append(path)
+                    continue
+                for document in documents:
+                    batch.append(document)
+                    if len(batch) == batch_size:
+                        yield batch, completed
+                        batch, completed = [], []
+                completed.append(path)
+            if batch or completed:
+                yield batch, completed
+
+        def embedded(batches):
+            # Only chunks that are not stored yet are embedded, ahead of the write
+            for batch, completed in batches:
+                stored = self.sqlite_db_manager.get_stored_documents(batch)
+                new = {self._chunk_key(document): document.page_content
+                       for i, document in enumerate(batch) if i not in stored}
+                vectors = self.embedding_function.embed_documents(list(new.values())) if new else []
+                yield batch, completed, dict(zip(new, vectors))
+
+        # The manifest hashes key the page text cache, so files are not hashed a second time
+        file_hashes = {path: entry[2] for path, entry in manifest_entries.items()}
+        files = prefetch(pdf_processor.iter_files(paths, file_hashes=file_hashes), queue_size)
+        pipeline = prefetch(embedded(batches(files)), queue_size)
+        try:
+            for batch, completed, embeddings in pipeline:
+                batch_ids = []
+
+                def sync_vectors(document_ids):
+                    batch_ids.extend(self._add_new_chunks(batch, document_ids, batch_size, embeddings))
+
+                result = None
+                try:
+                    result = self.sqlite_db_manager.insert_documents_bulk(batch, sync_vectors) if batch else []
+                finally:
+                    if result is None and batch_ids:
+                        # The rows were rolled back, their vectors must go too
+                        self.vector_store.delete(batch_ids)
+                if result is None:
+                    break
+                # Only IDs whose rows were committed are reported
+                summary['added'].extend(batch_ids)
+                entries = [(path, *manifest_entries[path]) for path in completed if path in manifest_entries]
+                if entries:
+                    self.sqlite_db_manager.update_source_manifest(entries)
+                summary['ingested'].extend(completed)
+        except Exception as e:
+            print(f"Ingest stopped, committed batches are kept: {e}")
+        finally:
+            pipeline.close()
+            files.close()
+            self.query_cache.bump_generation()
+
+        print(f"Ingested {len(summary['ingested'])} files, {len(summary['added'])} new chunks, "
+              f"{len(summary['failed'])} failed.")
+        return summary
+
+    def replace_source(self, source, documents, manifest_entry=None):
+        """
+        Replace the chunks of one source in both SQLite and Chroma.
+
+        Only chunks that actually changed are embedded or deleted. The SQLite transaction is
+        committed after Chroma has been updated, and rolled back if updating Chroma fails.
+
+        :param source: The source whose documents are replaced.
+        :param documents: A list of Document objects parsed from the source.
+        :param manifest_entry: An optional (size, mtime_ns, file hash) tuple recorded for the source.
+        :return: A (added_ids, deleted_ids) tuple of lists of IDs as strings, like the vector store
+            IDs, or None on error.
+        """
+        changes = {}
+
+        def sync_vectors(document_ids, deleted_ids):
+            changes['added'] = self._add_new_chunks(documents, document_ids)
+            try:
+                if deleted_ids:
+                    self.vector_store.delete([str(id_) for id_ in deleted_ids])
+            except Exception:
+                # Undo the add so Chroma matches the rolled back SQLite state
+                if changes['added']:
+                    self.vector_store.delete(changes['added'])
+                raise
+
+        try:
+            result = self.sqlite_db_manager.replace_source_documents(source, documents, manifest_entry, sync_vectors)
+        except Exception as e:
+            print(f"Failed to replace {source}: {e}")
+            return None
+        finally:
+            self.query_cache.bump_generation()
+
+        if result is None:
+            return None
+        self._invalidate_answers([source])
+        _, deleted_ids = result
+        return changes['added'], [str(id_) for id_ in deleted_ids]
+
+    def sync_directory(self, pdf_processor, directory='', batch_size=256):
+        """
+        Bring SQLite and Chroma in line with the PDF files of a directory.
+
+        Every PDF of the directory is passed to sync_files, and sources from the directory that
+        no longer exist on disk are purged.
+
+        :param pdf_processor: The PDFProcessor used to parse changed files.
+        :param directory: The directory to scan. Defaults to the directory of the processor.
+        :param batch_size: The number of chunks embedded and written at a time when ingesting new files.
+        :return: A dictionary with lists of 'added', 'modified', 'removed', 'unchanged' and 'failed' sources.
+        """
+        if directory == '':
+            directory = pdf_processor.pdf_directory
+        self.sqlite_db_manager.seed_source_manifest()
+        manifest = self.sqlite_db_manager.get_source_manifest()
+        paths = pdf_processor.list_pdf_files(directory)
+
+        # Only purge sources that belong to the scanned directory
+        prefix = os.path.join(str(Path(directory)), '')
+        present = set(paths)
+        removed = [source for source in manifest if source.startswith(prefix) and source not in present]
+
+        summary = self.sync_files(pdf_processor, paths, removed, batch_size, manifest)
+        print(f"Synced {directory}: {len(summary['added'])} added, {len(summary['modified'])} modified, "
+              f"{len(summary['removed'])} removed, {len(summary['unchanged'])} unchanged, "
+              f"{len(summary['failed'])} failed.")
+        return summary
+
+    def sync_files(self, pdf_processor, paths, removed=(), batch_size=256, manifest=None):
+        """
+        Bring SQLite and Chroma in line with a set of changed files.
+
+        Files whose size and modification time match the manifest are skipped without being
+        opened. Files whose stat data changed are hashed, and only parsed if their content
+        changed. New files are streamed in through ingest_files. Modified files, and files with
+        stored chunks but no manifest entry, are replaced one at a time. Files are parsed by the
+        workers of the processor; files that fail to parse are reported and left out of the
+        manifest, so the next sync retries them.
+
+        :param pdf_processor: The PDFProcessor used to parse changed files.
+        :param paths: A list of paths of existing PDF files.
+        :param removed: A list of sources that no longer exist on disk and are purged.
+        :param batch_size: The number of chunks embedded and written at a time when ingesting new files.
+        :param manifest: The source manifest, if already read.
+        :return: A dictionary with lists of 'added', 'modified', 'removed', 'unchanged' and 'failed' sources.
+        """
+        if manifest is None:
+            manifest = self.sqlite_db_manager.get_source_manifest()
+        summary = {'added': [], 'modified': [], 'removed': [], 'unchanged': [], 'failed': []}
+
+        touched = []
+        added = {}
+        modified = {}
+        for path in paths:
+            entry = manifest.get(path)
+            try:
+                stat = os.stat(path)
+                if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                    summary['unchanged'].append(path)
+                    continue
+                hash_ = file_hash(path)
+            except OSError as e:
+                # The file vanished or cannot be read, the next sync retries it
+                print(f"Failed to read {path}: {e}")
+                summary['failed'].append(path)
+                continue
+
+            if entry is not None and entry[2] == hash_:
+                # Touched but not modified, only the stat data needs refreshing
+                touched.append((path, stat.st_size, stat.st_mtime_ns, hash_))
+                summary['unchanged'].append(path)
+                continue
+
+            if entry is None:
+                added[path] = (stat.st_size, stat.st_mtime_ns, hash_)
+            else:
+                modified[path] = (stat.st_size, stat.st_mtime_ns, hash_)
+
+        # Files ingested before the manifest existed have rows but no entry, and are replaced so
+        # their stale chunks are removed
+        for path in self.sqlite_db_manager.get_stored_sources(added):
+            modified[path] = added.pop(path)
+
+        file_hashes = {path: entry[2] for path, entry in modified.items()}
+        for path, documents, error in pdf_processor.iter_files(list(modified), file_hashes=file_hashes):
+            if error is not None:
+                print(f"Failed to load {path}: {error}")
+                summary['failed'].append(path)
+                continue
+            if self.replace_source(path, documents, modified[path]) is not None:
+                summary['modified'].append(path)
+
+        if added:
+            ingested = self.ingest_files(pdf_processor, list(added), added, batch_size)
+            summary['added'] = ingested['ingested']
+            summary['failed'].extend(ingested['failed'])
+
+        if touched:
+            self.sqlite_db_manager.update_source_manifest(touched)
+
+        if removed:
+            deleted_documents = self.delete_documents_from_chroma(list(removed))
+            summary['removed'] = [source for source in removed if source in deleted_documents]
+
+        return summary
+
+    def rename_sources(self, renames):
+        """
+        Move sources to new paths in both SQLite and Chroma, without parsing or embedding them again.
+
+        The 'source' metadata of the vectors is updated before the SQLite transaction commits,
+        and the SQLite changes are rolled back if that fails.
+
+        :param renames: A dictionary with old sources as keys and new sources as values.
+        :return: A dictionary with the renamed new sources as keys and lists of their document IDs
+            as values. Renames left out of it were not applied.
+        """
+        def sync_vectors(renamed):
+            ids = [(str(id_), source) for source, document_ids in renamed.items() for id_ in document_ids]
+            self.vector_store.update_metadatas([id_ for id_, _ in ids], [{'source': source} for _, source in ids])
+
+        try:
+            renamed = self.sqlite_db_manager.rename_sources(renames, sync_vectors)
+        except Exception as e:
+            print(f"Failed to rename sources: {e}")
+            return {}
+        finally:
+            self.query_cache.bump_generation()
+        renamed = renamed or {}
+        # Cached answers cite the old paths
+        self._invalidate_answers([old for old, new in renames.items() if new in renamed])
+        return renamed
+
+    def _invalidate_answers(self, sources):
+        if self.answer_cache is not None and sources:
+            self.answer_cache.invalidate_sources(sources)
 
     def delete_document_from_chroma(self, document_source):
         """
         Delete a document from both the SQLite database and the Chroma vector database based on the document source.
 
         :param document_source: The source of the document to be deleted.
-        :param chroma_instance: The instance of the Chroma vector database.
-        :param db_path: The path to the SQLite database file.
         """
-        # Delete the document from the SQL database and get the deleted document IDs
-        deleted_ids = [str(id) for id in self.sqlite_db_manager.delete_single_document_by_source(document_source)]
+        deleted_ids = self.delete_documents_from_chroma([document_source]).get(document_source, [])
 
         if deleted_ids:
-            # Delete the documents from the Chroma vector database
-            self.chroma_instance._collection.delete(ids=deleted_ids)
             print(f"Deleted documents with IDs {deleted_ids} from the Chroma vector database.")
         else:
             print(f"No documents found for source {document_source} to delete.")
 
-    def query(self, prompt, num_result=3):
-        docs = self.chroma_instance.similarity_search(prompt, k=num_result)
-        result_string = ""
-        for i, (page_content_tuple, metadata_tuple) in enumerate(docs, start=1):
-            _, page_content = page_content_tuple
-            _, metadata = metadata_tuple
-            source = metadata.get('source', 'Unknown source')
-            result_string += f"{i}: {page_content}\nSource: {source}\n\n"
-        return result_string
+    def delete_documents_from_chroma(self, document_sources, batch_size=5000):
+        """
+        Delete the documents of many sources from both the SQLite database and the Chroma vector database.
+
+        All IDs are resolved with one set-based lookup and removed from Chroma in chunks. Rows are
+        only deleted from SQLite once their vectors are gone, so if a Chroma call fails partway
+        the two stores still agree and the call can simply be repeated for the remaining sources.
+
+        :param document_sources: A list of sources of the documents to be deleted.
+        :param batch_size: The maximum number of IDs per Chroma delete call.
+        :return: A dictionary with sources as keys and the list of deleted document IDs for each source as values.
+        """
+        document_ids = self.sqlite_db_manager.get_document_ids_by_sources(document_sources)
+        pending = [(source, id_) for source, ids in document_ids.items() for id_ in ids]
+
+        deleted = []
+        try:
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                self.vector_store.delete([str(id_) for _, id_ in batch])
+                deleted.extend(batch)
+        except Exception as e:
+            print(f"Deleted {len(deleted)} of {len(pending)} documents from Chroma before an error occurred: {e}")
+
+        # Sources without any stored chunk only need their manifest entry removed
+        done_sources = set(document_sources) - set(document_ids)
+        if len(deleted) == len(pending):
+            done_sources.update(document_ids)
+        result = self.sqlite_db_manager.delete_documents_by_ids([id_ for _, id_ in deleted], done_sources)
+        self.query_cache.bump_generation()
+        if result is None:
+            return {}
+
+        deleted_documents = {source: [] for source in done_sources}
+        for source, id_ in deleted:
+            deleted_documents.setdefault(source, []).append(id_)
+        self._invalidate_answers(list(deleted_documents))
+        return deleted_documents
+
+    def query(self, prompt, num_result=3, mode='vector', latency_budget=None, filters=None):
+        """
+        Retrieve the chunks most relevant to a prompt.
+
+        :param prompt: The query text.
+        :param num_result: The number of chunks to return.
+        :param mode: 'vector' for dense similarity search only, or 'hybrid' to fuse BM25 keyword
+            search and vector search with reciprocal-rank fusion.
+        :param latency_budget: In hybrid mode, the number of seconds to wait for both searches.
+            Searches that have not finished by then are left out of the fusion.
+        :param filters: An optional dictionary restricting the search to chunks by 'sources',
+            'page_range' or 'date_range', see SQLiteDBManager.resolve_filters. Filters are applied
+            inside the searches, so num_result chunks are returned whenever that many match.
+        :return: A list of dictionaries with 'id', 'content', 'source', 'page' and 'score' keys,
+            best first. Higher scores are better. format_hits renders them as numbered text.
+        """
+        return self._search(prompt, num_result, mode, latency_budget, filters)
+
+    def _search(self, prompt, num_result=3, mode='vector', latency_budget=None, filters=None):
+        """
+        Run a query and return structured hits, served from the result cache when the index
+        has not changed since the same query was last answered.
+
+        :return: A list of dictionaries with 'id', 'content', 'source', 'page' and 'score' keys,
+            best first. Higher scores are better.
+        """
+        if mode not in ('vector', 'hybrid'):
+            raise ValueError(f"Unknown query mode {mode!r}, expected 'vector' or 'hybrid'.")
+        return self.query_cache.get_results(
+            prompt,
+            (num_result, mode, self._filter_key(filters)),
+            lambda: self._run_search(prompt, num_result, mode, latency_budget, filters),
+        )
+
+    @staticmethod
+    def _filter_key(filters):
+        # A hashable form of the filters for the result cache key
+        if not filters:
+            return None
+        key = []
+        for name, value in sorted(filters.items()):
+            if name == 'sources' and not isinstance(value, str):
+                value = tuple(sorted(value))
+            elif isinstance(value, list):
+                value = tuple(value)
+            key.append((name, value))
+        return tuple(key)
+
+    def _resolve_filters(self, filters):
+        """
+        Resolve query filters in SQLite into the restriction passed to the vector store.
+
+        :return: None without filters, otherwise an (allowed_ids, where) tuple with the set of
+            matching IDs as strings, or None for backends that filter on metadata, and the
+            equivalent Chroma metadata filter. allowed_ids is an empty set if nothing matches.
+        """
+        if not filters:
+            return None
+        if self.vector_store.filters_by_ids:
+            ids, sources = self.sqlite_db_manager.resolve_filters(filters)
+            allowed_ids = {str(id_) for id_ in ids}
+        else:
+            # Loading every matching ID would cost as much as the search itself for broad filters
+            matched, sources = self.sqlite_db_manager.resolve_filter_sources(filters)
+            allowed_ids = None if matched else set()
+
+        # Date ranges are resolved to the sources whose files match, so both become a source filter
+        conditions = []
+        if filters.get('sources') is not None or filters.get('date_range') is not None:
+            conditions.append({'source': {'$in': sorted(sources)}})
+        first_page, last_page = filters.get('page_range') or (None, None)
+        if first_page is not None:
+            conditions.append({'page': {'$gte': first_page}})
+        if last_page is not None:
+            conditions.append({'page': {'$lte': last_page}})
+        where = conditions[0] if len(conditions) == 1 else {'$and': conditions} if conditions else None
+        return allowed_ids, where
+
+    @staticmethod
+    def _matches_nothing(restriction):
+        return restriction is not None and restriction[0] is not None and not restriction[0]
+
+    def _run_search(self, prompt, num_result, mode, latency_budget, filters=None):
+        """
+        :return: A (hits, complete) tuple, where complete is False if the latency budget cut a search short.
+        """
+        restriction = self._resolve_filters(filters)
+        if self._matches_nothing(restriction):
+            return [], True
+        if mode == 'vector':
+            return self._vector_search(prompt, num_result, restriction), True
+
+        # Over-fetch from each retriever so fusion has candidates to re-rank
+        depth = max(num_result * 4, 20)
+        futures = [
+            self._executor.submit(self._keyword_search, prompt, depth, filters),
+            self._executor.submit(self._vector_search, prompt, depth, restriction),
+        ]
+        done, _ = concurrent.futures.wait(futures, timeout=latency_budget)
+        if not done:
+            # Nothing finished within the budget, fall back to whichever search finishes first
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        ranked_lists = [future.result() for future in futures if future in done]
+        return reciprocal_rank_fusion(ranked_lists)[:num_result], len(done) == len(futures)
+
+    def cache_stats(self):
+        """
+        :return: Hit rates and seconds saved of the query caches, plus the embedding cache statistics if enabled.
+        """
+        stats = self.query_cache.stats()
+        if self.embedding_cache is not None:
+            stats['embedding_cache'] = self.embedding_cache.stats()
+        return stats
+
+    @property
+    def _executor(self):
+        if self._search_executor is None:
+            self._search_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        return self._search_executor
+
+    def query_many(self, prompts, num_result=3, batch_size=64, filters=None):
+        """
+        Retrieve the chunks most relevant to many prompts at once.
+
+        Prompts are embedded in one batched forward pass per batch and searched with a single
+        multi-vector query to the collection, instead of one model call and one index round-trip
+        per prompt. Results already in the query cache are served from it.
+
+        :param prompts: A list of query texts.
+        :param num_result: The number of chunks to return per prompt.
+        :param batch_size: The number of prompts embedded and searched per call.
+        :param filters: Optional filters applied to every prompt, see query.
+        :return: A list aligned with prompts of hit lists, each a list of dictionaries with 'id',
+            'content', 'source', 'page' and 'score' keys, best first.
+        """
+        params = (num_result, 'vector', self._filter_key(filters))
+        keys = [self.query_cache.result_key(prompt, params) for prompt in prompts]
+        results = [self.query_cache.results.get(key) for key in keys]
+        missing = [i for i, hits in enumerate(results) if hits is None]
+
+        restriction = self._resolve_filters(filters) if missing else None
+        if self._matches_nothing(restriction):
+            for i in missing:
+                results[i] = []
+            missing = []
+
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            started = time.perf_counter()
+            batch_hits = self._vector_search_many([prompts[i] for i in batch], num_result, restriction)
+            seconds = (time.perf_counter() - started) / len(batch)
+            for i, hits in zip(batch, batch_hits):
+                self.query_cache.results.put(keys[i], hits, seconds)
+                results[i] = hits
+
+        return [[dict(hit) for hit in hits] for hits in results]
+
+    def embed_queries(self, prompts):
+        """
+        :param prompts: A list of query texts.
+        :return: A list of query embeddings aligned with prompts, served from the query cache for
+            prompts that were just searched.
+        """
+        return self.query_cache.get_embeddings(prompts, lambda texts: embed_queries(self.embedding_function, texts))
+
+    def _vector_search(self, prompt, num_result, restriction=None):
+        return self._vector_search_many([prompt], num_result, restriction)[0]
+
+    def _vector_search_many(self, prompts, num_result, restriction=None):
+        embeddings = self.embed_queries(prompts)
+        allowed_ids, where = restriction or (None, None)
+        results = self.vector_store.query(embeddings, num_result, allowed_ids=allowed_ids, where=where)
+        all_hits = []
+        for ids, contents, metadatas, distances in zip(
+            results['ids'], results['documents'], results['metadatas'], results['distances']
+        ):
+            all_hits.append([
+                {
+                    'id': int(id_),
+                    'content': content,
+                    'source': metadata.get('source', 'Unknown source'),
+                    'page': metadata.get('page'),
+                    'score': -distance,
+                }
+                for id_, content, metadata, distance in zip(ids, contents, metadatas, distances)
+            ])
+
+        # Chunks stored without text in the vector store are read, and decompressed, from SQLite
+        missing = {hit['id'] for hits in all_hits for hit in hits if hit['content'] is None}
+        if missing:
+            documents = self.sqlite_db_manager.get_documents_by_ids(missing)
+            for hits in all_hits:
+                for hit in hits:
+                    if hit['content'] is None and hit['id'] in documents:
+                        hit['content'] = documents[hit['id']][0]
+        return all_hits
+
+    def _keyword_search(self, prompt, num_result, filters=None):
+        ranked = self.sqlite_db_manager.search_keywords(prompt, limit=num_result, filters=filters)
+        documents = self.sqlite_db_manager.get_documents_by_ids([id_ for id_, _ in ranked])
+        hits = []
+        for id_, bm25 in ranked:
+            if id_ not in documents:
+                continue
+            content, source, page = documents[id_]
+            hits.append({'id': id_, 'content': content, 'source': source, 'page': page, 'score': -bm25})
+        return hits
 
     def count_document(self):
-        count = self.chroma_instance._collection.count()
+        count = self.vector_store.count()
         return count
         
 def main():
@@ -313,7 +1922,7 @@ def main():
     # Query documents from Chroma database
     query_prompt = "I’m writing a paper related to Prostate Cancer Localization, give me some paper about it"
     queried_docs = chroma_manager.query(query_prompt, num_result=3)
-    print(queried_docs)
+    print(format_hits(queried_docs))
 
     # Count the number of documents in Chroma database
     doc_count = chroma_manager.count_document()
@@ -0,0 +1,323 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    A disk-backed store of embeddings keyed by (model name, content hash).
+
+    Vectors live in memory-mapped float32 matrices, one per embedding dimension so models of
+    different sizes can share a directory, with one row per entry. A small SQLite index maps
+    every key and dimension to its row. Each matrix grows by doubling up to max_entries rows;
+    once full, the least recently used entries of that dimension are evicted and their rows
+    reused. Lookups only record recency in memory; it is written to the index in batches.
+    """
+
+    def __init__(self, cache_dir='./embedding_cache', max_entries=1000000, recency_flush_interval=60.0,
+                 recency_flush_size=4096):
+        """
+        :param cache_dir: The directory holding the vector files and their index.
+        :param max_entries: The maximum number of cached embeddings per dimension.
+        :param recency_flush_interval: The number of seconds lookups may go without their
+            recency being written to the index.
+        :param recency_flush_size: The number of looked up entries that triggers writing their recency.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.recency_flush_interval = recency_flush_interval
+        self.recency_flush_size = recency_flush_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._vectors = {}
+        # Entries looked up since recency was last written, with the time of their last lookup
+        self._touched = {}
+        self._last_flush = time.monotonic()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (Name TEXT PRIMARY KEY, Value INTEGER)')
+        self._migrate()
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS entries (
+            Key TEXT,
+            Dim INTEGER,
+            Slot INTEGER,
+            LastUsed REAL,
+            PRIMARY KEY (Key, Dim),
+            UNIQUE (Dim, Slot)
+        )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_dim_last_used ON entries (Dim, LastUsed)')
+        self.conn.commit()
+
+        meta = dict(self.conn.execute('SELECT Name, Value FROM meta'))
+        self.capacity = {int(name.split(':')[1]): value for name, value in meta.items() if name.startswith('capacity:')}
+        self.next_slot = {int(name.split(':')[1]): value for name, value in meta.items() if name.startswith('next_slot:')}
+        for dim, capacity in self.capacity.items():
+            if capacity:
+                self._vectors[dim] = np.memmap(self._vectors_path(dim), dtype=np.float32, mode='r+', shape=(capacity, dim))
+
+    def _vectors_path(self, dim):
+        return os.path.join(self.cache_dir, f'vectors-{dim}.f32')
+
+    def _migrate(self):
+        # Caches written before vectors were split by dimension hold a single vectors.f32 matrix
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(entries)')]
+        if not columns or 'Dim' in columns:
+            return
+        meta = dict(self.conn.execute('SELECT Name, Value FROM meta'))
+        dim = meta.get('dim')
+        self.conn.execute('ALTER TABLE entries RENAME TO entries_old')
+        self.conn.execute('DROP INDEX IF EXISTS idx_entries_last_used')
+        self.conn.execute('''
+        CREATE TABLE entries (
+            Key TEXT,
+            Dim INTEGER,
+            Slot INTEGER,
+            LastUsed REAL,
+            PRIMARY KEY (Key, Dim),
+            UNIQUE (Dim, Slot)
+        )
+        ''')
+        if dim is not None:
+            self.conn.execute('INSERT INTO entries SELECT Key, ?, Slot, LastUsed FROM entries_old', (dim,))
+            for name in ('capacity', 'next_slot'):
+                if name in meta:
+                    self._set_meta(f'{name}:{dim}', meta[name])
+            old_path = os.path.join(self.cache_dir, 'vectors.f32')
+            if os.path.exists(old_path):
+                os.replace(old_path, self._vectors_path(dim))
+        self.conn.execute('DROP TABLE entries_old')
+        self.conn.execute("DELETE FROM meta WHERE Name IN ('dim', 'capacity', 'next_slot')")
+        self.conn.commit()
+
+    @staticmethod
+    def key(model_name, text):
+        """
+        :return: The cache key of a text embedded by a model.
+        """
+        return f"{model_name}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get_many(self, keys, dim=None):
+        """
+        Look up cached embeddings.
+
+        :param keys: A list of cache keys.
+        :param dim: The dimension of the vectors to return, if known. Otherwise the vectors of
+            any dimension stored for a key are returned.
+        :return: A list aligned with keys holding a vector for every hit and None for every miss.
+        """
+        with self._lock:
+            slots = self._lookup_slots(keys, dim)
+
+            now = time.time()
+            for key, (slot_dim, _) in slots.items():
+                self._touched[(key, slot_dim)] = now
+            if (len(self._touched) >= self.recency_flush_size
+                    or time.monotonic() - self._last_flush >= self.recency_flush_interval):
+                self._flush_recency()
+
+            results = []
+            for key in keys:
+                if key in slots:
+                    slot_dim, slot = slots[key]
+                    results.append(np.array(self._vectors[slot_dim][slot]))
+                else:
+                    results.append(None)
+            hits = sum(result is not None for result in results)
+            self.hits += hits
+            self.misses += len(keys) - hits
+            return results
+
+    def _flush_recency(self):
+        if self._touched:
+            self.conn.executemany(
+                'UPDATE entries SET LastUsed = ? WHERE Key = ? AND Dim = ?',
+                [(last_used, key, dim) for (key, dim), last_used in self._touched.items()],
+            )
+            self.conn.commit()
+            self._touched = {}
+        self._last_flush = time.monotonic()
+
+    def put_many(self, keys, vectors):
+        """
+        Store embeddings, evicting the least recently used entries of their dimension when full.
+
+        :param keys: A list of cache keys.
+        :param vectors: A list of vectors aligned with keys.
+        """
+        # Keys repeated in one call are stored once
+        entries = dict(zip(keys, vectors))
+        if not entries:
+            return
+
+        with self._lock:
+            by_dim = {}
+            for key, vector in entries.items():
+                by_dim.setdefault(len(vector), {})[key] = vector
+
+            now = time.time()
+            for dim, dim_entries in by_dim.items():
+                existing = self._lookup_slots(list(dim_entries), dim)
+                new_keys = [key for key in dim_entries if key not in existing][:self.max_entries]
+                slots = self._allocate(dim, len(new_keys))
+
+                if new_keys:
+                    matrix = self._vectors[dim]
+                    for key, slot in zip(new_keys, slots):
+                        matrix[slot] = dim_entries[key]
+                    matrix.flush()
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO entries (Key, Dim, Slot, LastUsed) VALUES (?, ?, ?, ?)',
+                    [(key, dim, slot, now) for key, slot in zip(new_keys, slots)],
+                )
+            self._flush_recency()
+            # The flush only commits when lookups are pending, the new entries must be committed regardless
+            self.conn.commit()
+
+    def _lookup_slots(self, keys, dim=None):
+        """
+        :return: A dictionary with the keys found as keys and (dim, slot) tuples as values.
+        """
+        slots = {}
+        # Stay well below the SQLite limit on bound parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ', '.join('?' * len(batch))
+            if dim is None:
+                rows = self.conn.execute(
+                    f'SELECT Key, Dim, Slot FROM entries WHERE Key IN ({placeholders})', batch
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    f'SELECT Key, Dim, Slot FROM entries WHERE Dim = ? AND Key IN ({placeholders})', [dim] + batch
+                ).fetchall()
+            slots.update((key, (row_dim, slot)) for key, row_dim, slot in rows)
+        return slots
+
+    def _allocate(self, dim, count):
+        """
+        Hand out rows of the vector matrix of a dimension, growing it or evicting entries as needed.
+        """
+        slots = []
+        next_slot = self.next_slot.get(dim, 0)
+        fresh = min(count, self.max_entries - next_slot)
+        if fresh > 0:
+            self._grow(dim, next_slot + fresh)
+            slots.extend(range(next_slot, next_slot + fresh))
+            self.next_slot[dim] = next_slot + fresh
+            self._set_meta(f'next_slot:{dim}', next_slot + fresh)
+
+        evict = count - len(slots)
+        if evict > 0:
+            # Evict by the latest recency, including lookups not written yet
+            self._flush_recency()
+            rows = self.conn.execute(
+                'SELECT Key, Slot FROM entries WHERE Dim = ? ORDER BY LastUsed LIMIT ?', (dim, evict)
+            ).fetchall()
+            self.conn.executemany('DELETE FROM entries WHERE Key = ? AND Dim = ?', [(row[0], dim) for row in rows])
+            slots.extend(row[1] for row in rows)
+            self.evictions += len(rows)
+        return slots
+
+    def _grow(self, dim, rows):
+        capacity = self.capacity.get(dim, 0)
+        if rows <= capacity:
+            return
+        capacity = min(self.max_entries, max(rows, capacity * 2, 1024))
+        vectors = self._vectors.pop(dim, None)
+        if vectors is not None:
+            vectors.flush()
+            del vectors
+        with open(self._vectors_path(dim), 'ab') as f:
+            f.truncate(capacity * dim * 4)
+        self._vectors[dim] = np.memmap(self._vectors_path(dim), dtype=np.float32, mode='r+', shape=(capacity, dim))
+        self.capacity[dim] = capacity
+        self._set_meta(f'capacity:{dim}', capacity)
+
+    def _set_meta(self, name, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (Name, Value) VALUES (?, ?)', (name, value))
+
+    def stats(self):
+        """
+        :return: A dictionary with the hit and miss counts, hit rate, evictions and number of entries.
+        """
+        with self._lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_recency()
+            self.conn.commit()
+            for vectors in self._vectors.values():
+                vectors.flush()
+            self._vectors = {}
+            self.conn.close()
+
+
+class CachedEmbeddings:
+    """
+    Wrap an embedding function so that texts embedded before are served from an EmbeddingCache.
+    Cache hits skip the model entirely. Only documents are cached; queries are passed through.
+    """
+
+    def __init__(self, embedding_function, cache_dir='./embedding_cache', max_entries=1000000, model_name=None):
+        """
+        :param embedding_function: The embedding function to wrap, e.g. SentenceTransformerEmbeddings.
+        :param cache_dir: The directory of the cache.
+        :param max_entries: The maximum number of cached embeddings.
+        :param model_name: The model name used in cache keys. Defaults to the model_name of the
+            wrapped function, so different models never share entries.
+        """
+        self.embedding_function = embedding_function
+        self.model_name = model_name or getattr(embedding_function, 'model_name', type(embedding_function).__name__)
+        self.cache = EmbeddingCache(cache_dir, max_entries=max_entries)
+        # Learned from the first vector, so lookups only match vectors of this model's size
+        self.dim = None
+
+    def embed_documents(self, texts):
+        keys = [EmbeddingCache.key(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys, self.dim)
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self.embedding_function.embed_documents([texts[i] for i in missing])
+            self.cache.put_many([keys[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        if self.dim is None and vectors:
+            self.dim = len(vectors[0])
+
+        return [np.asarray(vector, dtype=np.float32).tolist() for vector in vectors]
+
+    def embed_query(self, text):
+        # Queries are not chunk content, they are left out of the cache
+        return self.embedding_function.embed_query(text)
+
+    def embed_queries(self, texts):
+        embed_many = getattr(self.embedding_function, 'embed_queries', None)
+        if embed_many is not None:
+            return embed_many(texts)
+        return [self.embedding_function.embed_query(text) for text in texts]
+
+    def stats(self):
+        return self.cache.stats()
+
+    def close(self):
+        self.cache.close()
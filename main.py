@@ -1,12 +1,20 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
+import importlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from typing import List, Optional
 
 import fire
-from llama import Llama, Dialog
 from pdfloader import PDFProcessor
-from database import ChromaDBManager
+from database import ChromaDBManager, format_hits
+from context_packer import ContextPacker, dialog_prompt_tokens
+from startup import PhaseTimer, prefetch_checkpoint
 
 
 
@@ -20,10 +28,122 @@ def format_query_results_to_dialogs(query_results, query):
     
     return [dialog]
 
+def answer_queries_file(
+    chroma_manager,
+    generator,
+    build_dialog,
+    queries_file,
+    output_file,
+    num_result=3,
+    max_seq_len=4096,
+    max_batch_size=6,
+    max_gen_len=None,
+    reserved_gen_len=512,
+    temperature=0.6,
+    top_p=0.9,
+    query_key='query',
+    window_size=None,
+    group_by_length=True,
+    answer_params=None,
+):
+    """
+    Answer every query of a JSONL file with batched retrieval and batched generation.
+
+    Queries are read in windows of window_size records. The chunks of a whole window are
+    retrieved with query_many, each dialog is packed into the prompt budget, and the dialogs
+    are sorted by prompt length before being cut into chat_completion batches of up to
+    max_batch_size, so each batch pads its prompts as little as possible. Every batch is
+    written out as soon as it is generated, so answers appear in the order they were
+    generated rather than in input order; each carries the 'index' of its input record.
+    Queries answered by the answer cache of chroma_manager are written out before generating.
+
+    :param chroma_manager: The ChromaDBManager used for retrieval.
+    :param generator: An object with a tokenizer attribute and a chat_completion method.
+    :param build_dialog: A callable taking a hit list and a query and returning the dialog.
+    :param queries_file: The input JSONL file, one JSON object per line.
+    :param output_file: The output JSONL file. Each line is the input object with 'index',
+        'answer' and 'sources' keys added.
+    :param query_key: The key of the query in input objects.
+    :param window_size: The number of queries retrieved and sorted together. Defaults to
+        16 batches.
+    :param group_by_length: Whether to sort dialogs by prompt length before batching.
+    :param answer_params: The generation settings cached answers must match, see AnswerCache.
+    :return: The number of answered queries.
+    """
+    packer = ContextPacker(generator.tokenizer)
+    answer_len = max_gen_len if max_gen_len is not None else reserved_gen_len
+    window_size = window_size or max_batch_size * 16
+    cache = chroma_manager.answer_cache
+    answered = 0
+    cached = 0
+    padding = 0
+    padded_tokens = 0
+    start = time.perf_counter()
+
+    with open(queries_file) as f_in, open(output_file, 'w') as f_out:
+        records = enumerate(json.loads(line) for line in f_in if line.strip())
+        def write(index, record, answer, sources):
+            f_out.write(json.dumps(dict(
+                record,
+                index=index,
+                answer=answer,
+                sources=[
+                    {'id': span['id'], 'source': span['source'], 'page': span['page'], 'score': span['score']}
+                    for span in sources
+                ],
+            )) + '\n')
+
+        for window in iter(lambda: list(islice(records, window_size)), []):
+            queries = [record[query_key] for _, record in window]
+            hits = chroma_manager.query_many(queries, num_result=num_result)
+            embeddings = chroma_manager.embed_queries(queries) if cache is not None else [None] * len(window)
+
+            prepared = []
+            for (index, record), query, record_hits, embedding in zip(window, queries, hits, embeddings):
+                hit = cache.lookup(embedding, answer_params, record_hits) if cache is not None else None
+                if hit is not None:
+                    write(index, record, *hit)
+                    answered += 1
+                    cached += 1
+                    continue
+                dialog, spans = packer.pack(
+                    record_hits, lambda spans, query=query: build_dialog(spans, query), max_seq_len - answer_len
+                )
+                prepared.append((dialog_prompt_tokens(generator.tokenizer, dialog), index, record, dialog, spans,
+                                 record_hits, embedding))
+            f_out.flush()
+            if group_by_length:
+                prepared.sort(key=lambda item: item[0])
+
+            for batch_start in range(0, len(prepared), max_batch_size):
+                batch = prepared[batch_start:batch_start + max_batch_size]
+                results = generator.chat_completion(
+                    [item[3] for item in batch],
+                    max_gen_len=max_gen_len,
+                    temperature=temperature,
+                    top_p=top_p,
+                )
+                longest = max(item[0] for item in batch)
+                padding += sum(longest - item[0] for item in batch)
+                padded_tokens += longest * len(batch)
+
+                for (_, index, record, _, spans, record_hits, embedding), result in zip(batch, results):
+                    answer = result['generation']['content']
+                    write(index, record, answer, spans)
+                    if cache is not None:
+                        cache.put(record[query_key], embedding, answer_params, record_hits, answer, spans)
+                f_out.flush()
+                answered += len(batch)
+
+    elapsed = time.perf_counter() - start
+    print(f"Answered {answered} queries in {elapsed:.1f} s ({answered / max(elapsed, 1e-9):.2f} queries/s), "
+          f"{cached} from the answer cache, {padding / max(padded_tokens, 1):.1%} of prompt tokens were padding.")
+    return answered
+
 def main(
     ckpt_dir: str,
     tokenizer_path: str,
-    query: str,
+    query: str = None,
     temperature: float = 0.6,
     top_p: float = 0.9,
     max_seq_len: int = 4096,
@@ -36,49 +156,188 @@ def main(
     database: str = 'my_database.db',
     vector_database: str = './chroma_db',
     num_result: int = 3,
+    embedding_cache_dir: str = None,
+    reserved_gen_len: int = 512,
+    num_workers: int = 1,
+    page_cache_dir: str = None,
+    chunk_tokens: int = None,
+    chunk_overlap_tokens: int = 32,
+    serve: bool = False,
+    host: str = '127.0.0.1',
+    port: int = 8000,
+    unix_socket: str = None,
+    stub_generator: bool = False,
+    queue_size: int = 64,
+    queries_file: str = None,
+    output_file: str = 'answers.jsonl',
+    query_key: str = 'query',
+    answer_cache: bool = False,
+    answer_cache_threshold: float = 0.95,
+    answer_cache_ttl: float = 7 * 24 * 3600,
+    answer_cache_size: int = 10000,
 ):
+    timer = PhaseTimer()
+    rank = int(os.environ.get('RANK', 0))
+    warmups = []
+    prefetch_stop = threading.Event()
+    if not stub_generator:
+        # Import torch and read the checkpoint into the page cache on worker threads while PDFs
+        # are ingested and chunks retrieved. Llama.build itself runs after they are joined,
+        # because it changes the default tensor type of the whole process.
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup')
+        warmups.append(executor.submit(timer.run, 'import llama', importlib.import_module, 'llama'))
+        warmups.append(executor.submit(
+            timer.run, 'checkpoint prefetch', prefetch_checkpoint, ckpt_dir, rank, stop=prefetch_stop
+        ))
+        executor.shutdown(wait=False)
+
+    def load_generator():
+        for warmup in warmups:
+            try:
+                warmup.result()
+            except Exception as e:
+                print(f"Startup warm-up failed, loading without it: {e}")
+
+        with timer.phase('model build'):
+            if stub_generator:
+                from server import StubGenerator
+
+                # Lets the server be load-tested without a GPU or checkpoint
+                return StubGenerator()
+
+            # Import torch only once a generator is actually needed
+            from llama import Llama
+
+            return Llama.build(
+                ckpt_dir=ckpt_dir,
+                tokenizer_path=tokenizer_path,
+                max_seq_len=max_seq_len,
+                max_batch_size=max_batch_size
+            )
+
     # Initialize PDFProcessor, SQLiteDBManager, and ChromaDBManager
-    pdf_processor = PDFProcessor(pdf_directory)
-    chroma_manager = ChromaDBManager(database, vector_database)
+    text_splitter = None
+    if chunk_tokens:
+        from token_splitter import TokenTextSplitter
+
+        # Size chunks in tokens of the embedding model instead of characters
+        text_splitter = TokenTextSplitter(chunk_tokens, chunk_overlap_tokens)
+    pdf_processor = PDFProcessor(pdf_directory, text_splitter, num_workers=num_workers, page_cache_dir=page_cache_dir)
+    cache = None
+    if answer_cache and not serve and int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        # Ranks must generate the same batches, which separate cache lookups cannot guarantee
+        print("The answer cache is only used in server mode with model parallel checkpoints.")
+        answer_cache = False
+    if answer_cache:
+        from answer_cache import AnswerCache, answer_cache_path
+
+        # Answers to earlier paraphrases of a question are kept next to the database, where the
+        # watcher finds them to invalidate
+        cache = AnswerCache(answer_cache_path(database), answer_cache_threshold, answer_cache_ttl, answer_cache_size)
+    chroma_manager = ChromaDBManager(database, vector_database, embedding_cache_dir=embedding_cache_dir,
+                                     answer_cache=cache)
+    # A cached answer is only reused if it was generated with the same settings
+    answer_params = {
+        'ckpt_dir': ckpt_dir, 'stub_generator': stub_generator, 'max_seq_len': max_seq_len, 'max_gen_len': max_gen_len,
+        'reserved_gen_len': reserved_gen_len, 'temperature': temperature, 'top_p': top_p, 'num_result': num_result,
+    }
+
+    with timer.phase('ingest'):
+        if load_pdf_file_name:
+            path = pdf_directory + load_pdf_file_name
+            document_chunks = pdf_processor.load_and_split_document_by_title(path)
+            chroma_manager.add_documents_to_chroma(document_chunks)
 
-    if load_pdf_file_name:
-        path = pdf_directory + load_pdf_file_name
-        document_chunks = pdf_processor.load_and_split_document_by_title(path)
-        chroma_manager.add_documents_to_chroma(document_chunks)
+        if load_pdf_file_path:
+            document_chunks = pdf_processor.load_and_split_document_by_title(load_pdf_file_path)
+            chroma_manager.add_documents_to_chroma(document_chunks)
 
-    if load_pdf_file_path:
-        document_chunks = pdf_processor.load_and_split_document_by_title(load_pdf_file_path)
-        chroma_manager.add_documents_to_chroma(document_chunks)
+        if load_pdf_directory_path:
+            # Only new, modified and removed PDFs are parsed or purged
+            chroma_manager.sync_directory(pdf_processor, load_pdf_directory_path)
 
-    if load_pdf_directory_path:
-        document_splits = pdf_processor.load_from_directory(load_pdf_directory_path)
-        chroma_manager.add_documents_to_chroma(document_splits)
+    def build_dialog(spans, query):
+        return format_query_results_to_dialogs(format_hits(spans), query)[0]
+
+    if serve:
+        # Keep the retriever and generator loaded and answer questions over HTTP
+        from server import RAGService, serve as serve_forever
+
+        service = RAGService(
+            chroma_manager, load_generator, build_dialog, num_result=num_result, max_seq_len=max_seq_len,
+            max_batch_size=max_batch_size, max_gen_len=max_gen_len, reserved_gen_len=reserved_gen_len,
+            temperature=temperature, top_p=top_p, queue_size=queue_size, answer_params=answer_params,
+        )
+        if rank != 0:
+            # Model parallel ranks only run the generator in lockstep with rank 0
+            service.follow()
+        else:
+            serve_forever(service, host, port, unix_socket)
+        return
+
+    if queries_file:
+        # Answer a JSONL file of queries in batches of up to max_batch_size dialogs
+        generator = load_generator()
+        # Every model parallel rank generates, only rank 0 writes the answers
+        if rank != 0:
+            output_file = os.devnull
+        with timer.phase('answer queries'):
+            answer_queries_file(
+                chroma_manager, generator, build_dialog, queries_file, output_file, num_result=num_result,
+                max_seq_len=max_seq_len, max_batch_size=max_batch_size, max_gen_len=max_gen_len,
+                reserved_gen_len=reserved_gen_len, temperature=temperature, top_p=top_p, query_key=query_key,
+                answer_params=answer_params,
+            )
+        timer.report()
+        return
 
     # Prompt user for query
     # query = input("Please enter you query:")
     # query = "how MRI is used in biology?"
     # print('this is your query: ', query)    
     # Perform a query
-    query_results = chroma_manager.query(query, num_result=num_result)
-    # print('here is the related information: ', query_results)
-    # Prepare dialogs for Llama2 based on query results
-    dialogs = format_query_results_to_dialogs(query_results, query)
+    with timer.phase('retrieval'):
+        hits = chroma_manager.query(query, num_result=num_result)
+    # print('here is the related information: ', format_hits(hits))
+
+    if cache is not None:
+        embedding = chroma_manager.embed_queries([query])[0]
+        cached = cache.lookup(embedding, answer_params, hits)
+        if cached is not None:
+            # A paraphrase was answered from the same chunks before, the model is not needed
+            prefetch_stop.set()
+            answer, sources = cached
+            print(f"User: {query}\n")
+            print(f"> Assistant (cached): {answer}")
+            print("Sources: " + ', '.join(f"{source['source']} p. {source['page']}" for source in sources))
+            print("\n==================================\n")
+            timer.report()
+            return
 
     # Initialize Llama2
-    generator = Llama.build(
-        ckpt_dir=ckpt_dir,
-        tokenizer_path=tokenizer_path,
-        max_seq_len=max_seq_len,
-        max_batch_size=max_batch_size
+    generator = load_generator()
+
+    # Prepare dialogs for Llama2, packing deduplicated hits into the prompt budget left after
+    # reserving room for the answer (reserved_gen_len when max_gen_len is not set)
+    packer = ContextPacker(generator.tokenizer)
+    answer_len = max_gen_len if max_gen_len is not None else reserved_gen_len
+    dialog, spans = packer.pack(
+        hits,
+        lambda spans: build_dialog(spans, query),
+        max_seq_len - answer_len,
     )
+    dialogs = [dialog]
 
     # Generate chat completions with Llama2
-    results = generator.chat_completion(
-        dialogs,  # type: ignore
-        max_gen_len=max_gen_len,
-        temperature=temperature,
-        top_p=top_p,
-    )
+    with timer.phase('generation'):
+        results = generator.chat_completion(
+            dialogs,  # type: ignore
+            max_gen_len=max_gen_len,
+            temperature=temperature,
+            top_p=top_p,
+        )
+    if cache is not None:
+        cache.put(query, embedding, answer_params, hits, results[0]['generation']['content'], spans)
 
     # Print results
     for dialog, result in zip(dialogs, results):
@@ -86,6 +345,7 @@ def main(
             print(f"{msg['role'].capitalize()}: {msg['content']}\n")
         print(f"> {result['generation']['role'].capitalize()}: {result['generation']['content']}")
         print("\n==================================\n")
+    timer.report()
 
 if __name__ == "__main__":
     fire.Fire(main)
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+# Bump when the layout of cache files changes
+CACHE_FORMAT = 1
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Hash the bytes of a source file, to key the cache and to tell real modifications from touched files.
+
+    :param path: The path to the file.
+    :param block_size: The number of bytes read at a time.
+    :return: The hex SHA-256 digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def extractor_version():
+    """
+    :return: A string naming the PDF text extractor and its version. Text extracted by another
+        version may differ, so it is part of every cache key.
+    """
+    from importlib import metadata
+
+    for package in ('pypdf', 'PyPDF2'):
+        try:
+            return f"{package}-{metadata.version(package)}"
+        except metadata.PackageNotFoundError:
+            continue
+    return 'unknown'
+
+
+class PageTextCache:
+    """
+    A disk cache of the page text extracted from PDF files, keyed by file content hash and
+    extractor version.
+
+    Every file is stored as one zlib-compressed JSON list of pages, so re-chunking a corpus
+    with different splitter settings only re-runs the splitter. Files are written to a
+    temporary name and renamed into place, so concurrent workers never see partial entries.
+    """
+
+    def __init__(self, cache_dir='./page_cache', version=None):
+        """
+        :param cache_dir: The directory holding the cache files.
+        :param version: The extractor version in cache keys. Defaults to extractor_version().
+        """
+        self.cache_dir = cache_dir
+        self.version = version or extractor_version()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, file_hash):
+        """
+        :return: The path of the cache file of a PDF with the given content hash.
+        """
+        return os.path.join(self.cache_dir, file_hash[:2], f"{file_hash}-{self.version}-{CACHE_FORMAT}.json.z")
+
+    def get(self, file_hash):
+        """
+        :param file_hash: The content hash of a PDF file.
+        :return: A list of (text, metadata) page tuples, or None on a miss. Metadata holds every
+            key the extractor produced except 'source', which depends on where the file lives.
+        """
+        try:
+            with open(self.path(file_hash), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return [(text, metadata) for text, metadata in json.loads(zlib.decompress(data))]
+
+    def put(self, file_hash, pages):
+        """
+        :param file_hash: The content hash of a PDF file.
+        :param pages: A list of (text, metadata) page tuples.
+        """
+        path = self.path(file_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = zlib.compress(json.dumps([[text, metadata] for text, metadata in pages]).encode('utf-8'))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def load(self, path, extract, digest=None):
+        """
+        Return the pages of a PDF as Documents, extracting them only on a cache miss.
+
+        :param path: The path of the PDF file, set as the 'source' of the returned pages.
+        :param extract: A callable taking the path and returning its pages as a list of Documents.
+        :param digest: The content hash of the file, if already known, e.g. from the source manifest.
+        :return: A list of Document objects, one per page.
+        """
+        from langchain.schema import Document
+
+        if digest is None:
+            digest = file_hash(path)
+        pages = self.get(digest)
+        if pages is None:
+            documents = extract(path)
+            self.put(digest, [
+                (document.page_content, {key: value for key, value in document.metadata.items() if key != 'source'})
+                for document in documents
+            ])
+            return documents
+        return [Document(page_content=text, metadata=dict(metadata, source=path)) for text, metadata in pages]
@@ -1,37 +1,252 @@
+import os
+from collections import deque
+from pathlib import Path
 
 
-from langchain.document_loaders import PyPDFLoader
-from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.document_loaders import TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.document_loaders import PyPDFDirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+def _extract_pages(path):
+    from langchain.document_loaders import PyPDFLoader
 
-import os
+    return PyPDFLoader(path).load()
+
+
+def _load_pages(path, page_cache_dir=None, cache_version=None, digest=None):
+    """
+    Extract the pages of one PDF, served from the page text cache when one is configured.
+
+    :param cache_version: The extractor version in cache keys, see PageTextCache.
+    :param digest: The content hash of the file, if already known.
+    """
+    if page_cache_dir is None:
+        return _extract_pages(path)
+    from page_cache import PageTextCache
+
+    return PageTextCache(page_cache_dir, cache_version).load(path, _extract_pages, digest)
+
+
+def _load_and_split(path, text_splitter, page_cache_dir=None, cache_version=None, digest=None):
+    """
+    Parse and split one PDF, in a worker process when loading in parallel.
+
+    :return: A (documents, error) tuple. Failures are returned as a message instead of raised,
+        so one broken file does not abort the others.
+    """
+    try:
+        return text_splitter.split_documents(_load_pages(path, page_cache_dir, cache_version, digest)), None
+    except Exception as e:
+        return [], f"{type(e).__name__}: {e}"
 
 
 class PDFProcessor:
-    def __init__(self, pdf_directory = '/gpfs/scratch/yh2563/ExamplePDFsForLLM/', text_splitter= RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=100)):
-        self.text_splitter = text_splitter
+    def __init__(self, pdf_directory = '/gpfs/scratch/yh2563/ExamplePDFsForLLM/', text_splitter=None, num_workers=1,
+                 page_cache_dir=None):
+        """
+        :param pdf_directory: The default directory of the PDF files.
+        :param text_splitter: The splitter applied to every parsed page. Defaults to a
+            RecursiveCharacterTextSplitter with 2000-character chunks and 100 characters of overlap.
+        :param num_workers: The number of processes parsing files in parallel, or None for one per CPU.
+            With 1, files are parsed in this process.
+        :param page_cache_dir: An optional directory caching extracted page text by file content
+            hash, so changing the splitter does not re-run PDF extraction.
+        """
+        # The default splitter is built on first use so that importing this module stays cheap
+        self._text_splitter = text_splitter
         self.pdf_directory = pdf_directory
+        self.num_workers = num_workers
+        self.page_cache_dir = page_cache_dir
+        self._cache_version = None
+        self.failures = {}
+
+    @property
+    def text_splitter(self):
+        if self._text_splitter is None:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+            self._text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=100)
+        return self._text_splitter
+
+    @text_splitter.setter
+    def text_splitter(self, text_splitter):
+        self._text_splitter = text_splitter
+
+    @property
+    def cache_version(self):
+        """
+        The extractor version in page cache keys, looked up once rather than in every worker for every file.
+        """
+        if self._cache_version is None and self.page_cache_dir is not None:
+            from page_cache import extractor_version
+            self._cache_version = extractor_version()
+        return self._cache_version
+
+    def _load_args(self, path, text_splitter, file_hashes=None):
+        # The arguments of _load_and_split for one file
+        return path, text_splitter, self.page_cache_dir, self.cache_version, (file_hashes or {}).get(path)
 
     def get_file_path(self, filename):
         return os.path.join(self.pdf_directory, filename)
 
+    def list_pdf_files(self, path=''):
+        """
+        List the PDF files that load_from_directory would load, with the same source paths.
+
+        :param path: The directory to scan. Defaults to the directory of the processor.
+        :return: A sorted list of file paths.
+        """
+        if path == '':
+            path = self.pdf_directory
+        root = Path(path)
+        return sorted(
+            str(p) for p in root.glob('**/[!.]*.pdf')
+            if p.is_file() and not any(part.startswith('.') for part in p.relative_to(root).parts)
+        )
+
+    def load_pages(self, path):
+        """
+        Extract the pages of one PDF without splitting them, through the page text cache if configured.
+
+        :param path: The path of the PDF file.
+        :return: A list of Document objects, one per page.
+        """
+        return _load_pages(path, self.page_cache_dir, self.cache_version)
+
     def load_and_split_document_by_title(self, title):
         path = self.get_file_path(title)
-        loader = PyPDFLoader(path)
-        document = loader.load()
+        document = self.load_pages(path)
         doc_chucks = self.text_splitter.split_documents(document)
         return doc_chucks
 
-    def load_from_directory(self, path=''):
+    def iter_files(self, paths, num_workers=None, file_hashes=None):
+        """
+        Parse and split PDF files across a process pool, yielding results in the order of paths.
+
+        At most a few files per worker are in flight, so memory stays bounded however many
+        files are loaded. A file that crashes its worker process is reported as failed and the
+        pool is replaced, so the other files still load.
+
+        :param paths: A list of file paths.
+        :param num_workers: The number of worker processes. Defaults to the num_workers of the processor.
+        :param file_hashes: An optional dictionary with paths as keys and content hashes as values,
+            used as page cache keys instead of hashing the files again.
+        :return: An iterator of (path, documents, error) tuples, where error is None on success
+            and a message describing the failure otherwise.
+        """
+        if num_workers is None:
+            num_workers = self.num_workers or os.cpu_count()
+        text_splitter = self.text_splitter
+
+        if num_workers <= 1 or len(paths) <= 1:
+            for path in paths:
+                yield (path, *_load_and_split(*self._load_args(path, text_splitter, file_hashes)))
+            return
+
+        import concurrent.futures
+        from concurrent.futures.process import BrokenProcessPool
+
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+        remaining = iter(paths)
+        pending = deque()
+
+        def submit(path):
+            try:
+                future = executor.submit(_load_and_split, *self._load_args(path, text_splitter, file_hashes))
+            except BrokenProcessPool as e:
+                # The pool broke before the file was queued; it is resubmitted once the pool is replaced
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+            pending.append((path, future))
+
+        def submit_next():
+            path = next(remaining, None)
+            if path is not None:
+                submit(path)
+
+        try:
+            for _ in range(num_workers * 4):
+                submit_next()
+            while pending:
+                path, future = pending.popleft()
+                try:
+                    documents, error = future.result()
+                except BrokenProcessPool:
+                    # A worker died, e.g. a parser crash took the process down, and every unfinished
+                    # file of the pool failed with it. This file is retried alone to tell whether it
+                    # is the culprit, and the other unfinished files are resubmitted to a new pool.
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    documents, error = self._load_isolated(self._load_args(path, text_splitter, file_hashes))
+                    executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+                    retry = list(pending)
+                    pending.clear()
+                    for retry_path, retry_future in retry:
+                        if retry_future.done() and not retry_future.cancelled() and retry_future.exception() is None:
+                            pending.append((retry_path, retry_future))
+                        else:
+                            submit(retry_path)
+                except Exception as e:
+                    documents, error = [], f"{type(e).__name__}: {e}"
+                # Keep the workers busy while the caller handles this file
+                submit_next()
+                yield path, documents, error
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _load_isolated(self, load_args):
+        """
+        Parse and split one PDF in a process of its own, so a crash only fails this file.
+
+        :param load_args: The arguments of _load_and_split.
+        :return: A (documents, error) tuple, see _load_and_split.
+        """
+        import concurrent.futures
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                return executor.submit(_load_and_split, *load_args).result()
+            except Exception as e:
+                return [], f"{type(e).__name__}: {e}"
+
+    def load_files(self, paths, num_workers=None):
+        """
+        Parse and split PDF files, in parallel when the processor has more than one worker.
+
+        :param paths: A list of file paths.
+        :param num_workers: The number of worker processes. Defaults to the num_workers of the processor.
+        :return: A (documents, failures) tuple with the chunks of all files that loaded, in the order
+            of paths, and a dictionary with the paths that failed as keys and error messages as values.
+        """
+        documents = []
+        failures = {}
+        for path, file_documents, error in self.iter_files(paths, num_workers):
+            if error is not None:
+                failures[path] = error
+            documents.extend(file_documents)
+        return documents, failures
+
+    def load_from_directory(self, path='', num_workers=None):
+        """
+        Parse and split every PDF file of a directory.
+
+        With more than one worker or a page cache, files are loaded one by one through load_files,
+        in parallel with more than one worker, and files that fail to load are skipped, reported,
+        and recorded in the failures attribute instead of aborting the load.
+
+        :param path: The directory to load. Defaults to the directory of the processor.
+        :param num_workers: The number of worker processes. Defaults to the num_workers of the processor.
+        :return: A list of Document chunks, ordered by file path.
+        """
         if path == '':
             path = self.pdf_directory
-        loader = PyPDFDirectoryLoader(path)
-        doc_chunks = loader.load_and_split(self.text_splitter)
+        if num_workers is None:
+            num_workers = self.num_workers
+
+        if num_workers == 1 and self.page_cache_dir is None:
+            from langchain.document_loaders import PyPDFDirectoryLoader
+
+            loader = PyPDFDirectoryLoader(path)
+            doc_chunks = loader.load_and_split(self.text_splitter)
+            return doc_chunks
+
+        doc_chunks, self.failures = self.load_files(self.list_pdf_files(path), num_workers)
+        for failed_path, error in self.failures.items():
+            print(f"Failed to load {failed_path}: {error}")
         return doc_chunks
 
 def main():
@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A thread-safe least-recently-used cache that remembers how long each value took to compute.
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: The maximum number of entries. A size of 0 disables the cache.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: A hashable key.
+        :return: The cached value, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.seconds_saved += entry[1]
+            return entry[0]
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value for key, or compute, store and return it.
+
+        :param key: A hashable key.
+        :param compute: A callable without arguments that computes the value on a miss.
+        :return: The value.
+        """
+        value = self.get(key)
+        if value is None:
+            start = time.perf_counter()
+            value = compute()
+            self.put(key, value, time.perf_counter() - start)
+        return value
+
+    def put(self, key, value, seconds=0.0):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'seconds_saved': self.seconds_saved,
+            'entries': len(self._entries),
+        }
+
+
+class QueryCache:
+    """
+    Caches for the query path: prompt embeddings, and top-k results per index generation.
+
+    Results are keyed on the generation counter, which every add and delete bumps, so results
+    computed against an older state of the index are never served again and simply age out.
+    """
+
+    def __init__(self, max_embeddings=1024, max_results=1024):
+        """
+        :param max_embeddings: The maximum number of cached prompt embeddings.
+        :param max_results: The maximum number of cached result lists.
+        """
+        self.embeddings = LRUCache(max_embeddings)
+        self.results = LRUCache(max_results)
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(prompt):
+        """
+        :return: The prompt lower-cased with runs of whitespace collapsed, so trivially different
+            spellings of the same question share entries.
+        """
+        return ' '.join(prompt.lower().split())
+
+    def bump_generation(self):
+        """
+        Invalidate all cached results after the index changed.
+        """
+        with self._lock:
+            self.generation += 1
+
+    def get_embedding(self, prompt, compute):
+        """
+        :param prompt: The query text.
+        :param compute: A callable taking the prompt and returning its embedding.
+        :return: The embedding of the prompt.
+        """
+        return self.embeddings.get_or_compute(self.normalize(prompt), lambda: compute(prompt))
+
+    def get_embeddings(self, prompts, compute_many):
+        """
+        :param prompts: A list of query texts.
+        :param compute_many: A callable taking a list of prompts and returning their embeddings,
+            called once with all the prompts that miss the cache.
+        :return: A list of embeddings aligned with prompts.
+        """
+        keys = [self.normalize(prompt) for prompt in prompts]
+        embeddings = [self.embeddings.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            start = time.perf_counter()
+            computed = compute_many([prompts[i] for i in missing])
+            seconds = (time.perf_counter() - start) / len(missing)
+            for i, embedding in zip(missing, computed):
+                self.embeddings.put(keys[i], embedding, seconds)
+                embeddings[i] = embedding
+        return embeddings
+
+    def result_key(self, prompt, params):
+        """
+        :return: The result cache key of a query against the current generation of the index.
+        """
+        return (self.normalize(prompt), params, self.generation)
+
+    def get_results(self, prompt, params, compute):
+        """
+        :param prompt: The query text.
+        :param params: A hashable tuple of the other parameters the results depend on, e.g. k and the mode.
+        :param compute: A callable returning a (hits, cacheable) tuple. Incomplete results, e.g. when
+            a latency budget cut a search short, are returned but not cached.
+        :return: A copy of the hits, so callers may modify them freely.
+        """
+        key = self.result_key(prompt, params)
+        hits = self.results.get(key)
+        if hits is None:
+            start = time.perf_counter()
+            hits, cacheable = compute()
+            if cacheable:
+                self.results.put(key, hits, time.perf_counter() - start)
+        return [dict(hit) for hit in hits]
+
+    def stats(self):
+        """
+        :return: Hit rates and seconds saved of the embedding and result caches, and the generation.
+        """
+        return {
+            'generation': self.generation,
+            'embeddings': self.embeddings.stats(),
+            'results': self.results.stats(),
+        }
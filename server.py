@@ -0,0 +1,462 @@
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from context_packer import ContextPacker, dialog_prompt_tokens
+
+
+class StubTokenizer:
+    """
+    A word-level tokenizer with the encode and decode methods of the Llama tokenizer.
+
+    Every whitespace-prefixed word is one token, so decode(encode(s)) == s and token counts are
+    close enough to the real tokenizer's to exercise prompt packing.
+    """
+
+    def __init__(self):
+        self.bos_id = 1
+        self.eos_id = 2
+        self._ids = {}
+        self._pieces = [None, None, None]
+        self._lock = threading.Lock()
+
+    def encode(self, s, bos, eos):
+        with self._lock:
+            tokens = [self.bos_id] if bos else []
+            for piece in re.findall(r'\s*\S+|\s+', s):
+                if piece not in self._ids:
+                    self._ids[piece] = len(self._pieces)
+                    self._pieces.append(piece)
+                tokens.append(self._ids[piece])
+            if eos:
+                tokens.append(self.eos_id)
+            return tokens
+
+    def decode(self, tokens):
+        return ''.join(self._pieces[token] for token in tokens if token > self.eos_id)
+
+
+class StubGenerator:
+    """
+    Stand in for Llama on machines without a GPU, to load-test the server.
+
+    chat_completion sleeps as long as Llama.generate would take if time were spent per token:
+    the batch is prefilled up to its shortest prompt, then decoded one position at a time up
+    to its longest prompt plus the answer, so batches of unequal prompts pay for padding. It
+    answers with the start of the context it was given.
+    """
+
+    def __init__(self, prefill_seconds_per_token=0.00005, decode_seconds_per_token=0.02, answer_tokens=32):
+        """
+        :param prefill_seconds_per_token: The simulated time to encode one prompt token.
+        :param decode_seconds_per_token: The simulated time of one decoding step of the whole batch.
+        :param answer_tokens: The number of tokens generated per answer.
+        """
+        self.tokenizer = StubTokenizer()
+        self.prefill_seconds_per_token = prefill_seconds_per_token
+        self.decode_seconds_per_token = decode_seconds_per_token
+        self.answer_tokens = answer_tokens
+
+    def chat_completion(self, dialogs, temperature=0.6, top_p=0.9, max_gen_len=None, logprobs=False):
+        prompts = [' '.join(message['content'] for message in dialog) for dialog in dialogs]
+        lengths = [dialog_prompt_tokens(self.tokenizer, dialog) for dialog in dialogs]
+        gen_len = self.answer_tokens if max_gen_len is None else min(self.answer_tokens, max_gen_len)
+        time.sleep(
+            len(lengths) * min(lengths) * self.prefill_seconds_per_token
+            + (max(lengths) - min(lengths) + gen_len) * self.decode_seconds_per_token
+        )
+        return [
+            {'generation': {'role': 'assistant', 'content': ' '.join(prompt.split()[:gen_len])}}
+            for prompt in prompts
+        ]
+
+
+class RAGService:
+    """
+    Answer questions with a retriever and a generator that are loaded once and shared.
+
+    Requests are put on a bounded queue and served by a single worker thread, which owns the
+    generator. The worker takes up to max_batch_size waiting requests at a time, retrieves
+    their chunks with one query_many call per set of retrieval options, packs each dialog
+    into the prompt budget and generates all answers with one chat_completion call. The
+    generator is loaded by the worker, so the server can answer health checks while a large
+    checkpoint loads.
+
+    With a model parallel checkpoint started by torchrun, rank 0 serves requests and every
+    other rank runs follow, which receives each batch of dialogs and generates in lockstep.
+    """
+
+    def __init__(self, chroma_manager, load_generator, build_dialog, num_result=3, max_seq_len=4096,
+                 max_batch_size=6, max_gen_len=None, reserved_gen_len=512, temperature=0.6, top_p=0.9,
+                 queue_size=64, batch_wait=0.005, answer_params=None):
+        """
+        :param chroma_manager: The ChromaDBManager used for retrieval.
+        :param load_generator: A callable returning an object with a tokenizer attribute and a
+            chat_completion method, like Llama.build or StubGenerator.
+        :param build_dialog: A callable taking a hit list and a query and returning the dialog.
+        :param num_result: The default number of chunks retrieved per question.
+        :param max_seq_len: The maximum sequence length of the generator.
+        :param max_batch_size: The maximum number of questions generated together.
+        :param max_gen_len: The maximum answer length, or None for the generator's default.
+        :param reserved_gen_len: The tokens kept free for the answer when max_gen_len is not set.
+        :param temperature: The sampling temperature.
+        :param top_p: The top-p sampling threshold.
+        :param queue_size: The maximum number of waiting questions before requests are rejected.
+        :param batch_wait: The number of seconds the worker waits for more questions to fill a batch.
+        :param answer_params: The generation settings cached answers must match, when
+            chroma_manager has an answer cache.
+        """
+        self.chroma_manager = chroma_manager
+        self.load_generator = load_generator
+        self.build_dialog = build_dialog
+        self.num_result = num_result
+        self.max_seq_len = max_seq_len
+        self.max_batch_size = max_batch_size
+        self.max_gen_len = max_gen_len
+        self.reserved_gen_len = reserved_gen_len
+        self.temperature = temperature
+        self.top_p = top_p
+        self.batch_wait = batch_wait
+        self.answer_params = answer_params
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.generator = None
+        self.packer = None
+        self.load_error = None
+        self.ready = threading.Event()
+        self.batches = 0
+        self.batched_requests = 0
+        self._worker = threading.Thread(target=self._run, name='rag-worker', daemon=True)
+
+    def start(self):
+        self._worker.start()
+        return self
+
+    def close(self):
+        if self._worker.is_alive():
+            # A None request tells the worker to stop
+            self.requests.put(None)
+            self._worker.join()
+
+    @staticmethod
+    def _distributed():
+        # torch is only imported by a generator that needs it
+        torch = sys.modules.get('torch')
+        return torch is not None and torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1
+
+    def _generate(self, dialogs):
+        if self._distributed():
+            import torch.distributed
+
+            torch.distributed.broadcast_object_list([dialogs], src=0)
+        return self.generator.chat_completion(
+            dialogs, max_gen_len=self.max_gen_len, temperature=self.temperature, top_p=self.top_p
+        )
+
+    def follow(self):
+        """
+        Load the generator and take part in the generation of every batch of rank 0, until it stops.
+        """
+        import torch.distributed
+
+        self.generator = self.load_generator()
+        while True:
+            dialogs = [None]
+            torch.distributed.broadcast_object_list(dialogs, src=0)
+            if dialogs[0] is None:
+                return
+            self.generator.chat_completion(
+                dialogs[0], max_gen_len=self.max_gen_len, temperature=self.temperature, top_p=self.top_p
+            )
+
+    @property
+    def healthy(self):
+        return self.load_error is None and (self._worker.is_alive() or not self.ready.is_set())
+
+    @property
+    def is_ready(self):
+        return self.ready.is_set() and self._worker.is_alive()
+
+    def submit(self, query, num_result=None, filters=None):
+        """
+        Queue a question.
+
+        :param query: The question.
+        :param num_result: The number of chunks to retrieve, or None for the default.
+        :param filters: Optional retrieval filters, see ChromaDBManager.query.
+        :return: A Future resolved with the answer dictionary, see _answer.
+        :raises queue.Full: If the queue is full.
+        """
+        future = Future()
+        self.requests.put_nowait((query, num_result or self.num_result, filters, time.perf_counter(), future))
+        return future
+
+    def _run(self):
+        try:
+            self.generator = self.load_generator()
+            self.packer = ContextPacker(self.generator.tokenizer)
+        except Exception as e:
+            self.load_error = e
+            print(f"Failed to load the generator: {e}")
+            return
+        self.ready.set()
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                if self._distributed():
+                    import torch.distributed
+
+                    # Release the other ranks from follow
+                    torch.distributed.broadcast_object_list([None], src=0)
+                return
+            batch = [request]
+            deadline = time.perf_counter() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+
+            batch = [request for request in batch if request[4].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                answers = self._answer(batch)
+            except Exception as e:
+                for request in batch:
+                    request[4].set_exception(e)
+                continue
+            self.batches += 1
+            self.batched_requests += len(batch)
+            for request, answer in zip(batch, answers):
+                if isinstance(answer, Exception):
+                    request[4].set_exception(answer)
+                else:
+                    request[4].set_result(answer)
+
+    def _answer(self, batch):
+        """
+        :param batch: A list of (query, num_result, filters, submitted, future) requests.
+        :return: A list aligned with batch of dictionaries with 'query', 'answer', 'sources',
+            'cached' and 'timings' keys, or of the exceptions raised while retrieving chunks for
+            a request.
+        """
+        started = time.perf_counter()
+        # Questions sharing retrieval options are embedded and searched together
+        groups = {}
+        for i, (_, num_result, filters, _, _) in enumerate(batch):
+            groups.setdefault((num_result, json.dumps(filters, sort_keys=True)), []).append(i)
+        hits = [None] * len(batch)
+        for (num_result, _), indices in groups.items():
+            try:
+                group_hits = self.chroma_manager.query_many(
+                    [batch[i][0] for i in indices], num_result=num_result, filters=batch[indices[0]][2]
+                )
+            except Exception as e:
+                # Bad filters only fail the requests that sent them
+                group_hits = [e] * len(indices)
+            for i, group_hit in zip(indices, group_hits):
+                hits[i] = group_hit
+        retrieved = time.perf_counter()
+
+        answers = list(hits)
+        answered = [i for i, query_hits in enumerate(hits) if not isinstance(query_hits, Exception)]
+        cache = self.chroma_manager.answer_cache
+        embeddings = {}
+        if cache is not None and answered:
+            embeddings = dict(zip(answered, self.chroma_manager.embed_queries([batch[i][0] for i in answered])))
+            for i in list(answered):
+                cached = cache.lookup(embeddings[i], self.answer_params, hits[i])
+                if cached is not None:
+                    answers[i] = self._response(
+                        batch[i], cached[0], cached[1], started, retrieved, retrieved, len(batch), True
+                    )
+                    answered.remove(i)
+
+        answer_len = self.max_gen_len if self.max_gen_len is not None else self.reserved_gen_len
+        dialogs = []
+        spans = []
+        for i in answered:
+            query = batch[i][0]
+            dialog, packed = self.packer.pack(
+                hits[i], lambda spans, query=query: self.build_dialog(spans, query), self.max_seq_len - answer_len
+            )
+            dialogs.append(dialog)
+            spans.append(packed)
+        results = self._generate(dialogs) if dialogs else []
+        generated = time.perf_counter()
+
+        for i, packed, result in zip(answered, spans, results):
+            answer = result['generation']['content']
+            answers[i] = self._response(batch[i], answer, packed, started, retrieved, generated, len(batch), False)
+            if cache is not None:
+                cache.put(batch[i][0], embeddings[i], self.answer_params, hits[i], answer, packed)
+        return answers
+
+    @staticmethod
+    def _response(request, answer, sources, started, retrieved, generated, batch_size, cached):
+        query, _, _, submitted, _ = request
+        return {
+            'query': query,
+            'answer': answer,
+            'sources': [
+                {'id': span['id'], 'source': span['source'], 'page': span['page'], 'score': span['score']}
+                for span in sources
+            ],
+            'cached': cached,
+            'timings': {
+                'queued': started - submitted,
+                'retrieval': retrieved - started,
+                'generation': generated - retrieved,
+                'batch_size': batch_size,
+            },
+        }
+
+
+class RAGRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /healthz, GET /readyz and POST /query with a JSON body of 'query' and the optional
+    'num_result' and 'filters' keys.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, code='-', size='-'):
+        # Only failed requests are logged, a busy server answers many per second
+        if str(code) != '200':
+            super().log_request(code, size)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/healthz':
+            if service.healthy:
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(503, {'status': 'failed', 'error': str(service.load_error)})
+        elif self.path == '/readyz':
+            if service.is_ready:
+                self._send_json(200, {'status': 'ready', 'queued': service.requests.qsize()})
+            else:
+                self._send_json(503, {'status': 'loading' if service.healthy else 'failed'})
+        else:
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path != '/query':
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            query = body['query']
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {'error': "Expected a JSON object with a 'query' key."})
+            return
+        if not service.is_ready:
+            self._send_json(503, {'error': 'The generator is not loaded yet.'}, [('Retry-After', '5')])
+            return
+        try:
+            future = service.submit(query, body.get('num_result'), body.get('filters'))
+        except queue.Full:
+            self._send_json(503, {'error': 'Too many queued requests.'}, [('Retry-After', '1')])
+            return
+        try:
+            answer = future.result(timeout=self.server.request_timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._send_json(504, {'error': 'The request timed out.'})
+            return
+        except ValueError as e:
+            # Unknown filter keys
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, answer)
+
+
+class RAGHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, service, request_timeout=600.0):
+        self.service = service
+        self.request_timeout = request_timeout
+        super().__init__(address, RAGRequestHandler)
+
+
+class RAGUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, path, service, request_timeout=600.0):
+        self.service = service
+        self.request_timeout = request_timeout
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, RAGRequestHandler)
+
+    def server_bind(self):
+        super().server_bind()
+        # Read by BaseHTTPRequestHandler when it writes the Server header
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+
+def make_server(service, host='127.0.0.1', port=8000, unix_socket=None, request_timeout=600.0):
+    """
+    :param service: A RAGService.
+    :param host: The address to listen on over TCP.
+    :param port: The TCP port, 0 for any free port.
+    :param unix_socket: A socket path to listen on instead of TCP.
+    :param request_timeout: The number of seconds a request may wait for its answer.
+    :return: A server whose serve_forever method handles requests, each in its own thread.
+    """
+    if unix_socket:
+        return RAGUnixServer(unix_socket, service, request_timeout)
+    return RAGHTTPServer((host, port), service, request_timeout)
+
+
+def serve(service, host='127.0.0.1', port=8000, unix_socket=None, request_timeout=600.0):
+    """
+    Start the service and answer requests until interrupted.
+    """
+    server = make_server(service, host, port, unix_socket, request_timeout)
+    service.start()
+    print(f"Serving on {unix_socket or f'http://{server.server_address[0]}:{server.server_address[1]}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.unlink(unix_socket)
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class PhaseTimer:
+    """
+    Record the wall-clock span of named startup phases, which may run on several threads.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.phases[name] = (start - self.started, end - self.started)
+
+    def run(self, name, function, *args, **kwargs):
+        """
+        Call a function as a timed phase, e.g. on an executor.
+
+        :return: What the function returns.
+        """
+        with self.phase(name):
+            return function(*args, **kwargs)
+
+    def report(self):
+        """
+        Print when each phase started and ended, and the time saved by running phases concurrently.
+        """
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda item: item[1])
+        print(f"{'phase':>20} {'start s':>8} {'end s':>8} {'took s':>8}")
+        for name, (start, end) in phases:
+            print(f"{name:>20} {start:>8.2f} {end:>8.2f} {end - start:>8.2f}")
+        sequential = sum(end - start for _, (start, end) in phases)
+        print(f"{'total':>20} {0:>8.2f} {elapsed:>8.2f} {elapsed:>8.2f} "
+              f"({sequential:.2f} s if run in sequence, {max(0.0, sequential - elapsed):.2f} s saved)")
+
+
+def available_memory():
+    """
+    :return: The number of bytes of memory available without swapping, or None if unknown.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def prefetch_checkpoint(ckpt_dir, rank=0, max_bytes=None, block_size=16 * 2 ** 20, stop=None):
+    """
+    Read the checkpoint shard that Llama.build will load, so that it is served from the page
+    cache instead of disk when the model is built.
+
+    Reading is I/O bound and releases the GIL, so it overlaps well with ingestion and retrieval
+    on other threads. Shards that would not fit in max_bytes are skipped, since reading them
+    would only evict other cached data.
+
+    :param ckpt_dir: The checkpoint directory, with consolidated.*.pth shards and params.json.
+    :param rank: The model parallel rank, whose shard Llama.build loads.
+    :param max_bytes: The maximum number of bytes to read. Defaults to half the available memory.
+    :param block_size: The number of bytes read per call.
+    :param stop: An optional threading.Event that ends the prefetch early once set, e.g. when
+        the model turns out not to be needed.
+    :return: The number of bytes read.
+    """
+    checkpoints = sorted(Path(ckpt_dir).glob('*.pth'))
+    if rank >= len(checkpoints):
+        return 0
+    paths = [Path(ckpt_dir) / 'params.json', checkpoints[rank]]
+    if max_bytes is None:
+        available = available_memory()
+        max_bytes = available // 2 if available is not None else float('inf')
+
+    read = 0
+    buffer = bytearray(block_size)
+    for path in paths:
+        if not path.exists() or read + path.stat().st_size > max_bytes:
+            continue
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while stop is None or not stop.is_set():
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                read += size
+    return read
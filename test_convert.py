@@ -0,0 +1,56 @@
+import filecmp
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import convert
+from benchmark import make_llama_checkpoint
+
+# reshard_streaming memory-maps its inputs, which torch.load supports from 2.1 on
+pytestmark = pytest.mark.skipif(
+    tuple(int(part) for part in torch.__version__.split('+')[0].split('.')[:2]) < (2, 1),
+    reason='reshard_streaming requires torch 2.1 or later',
+)
+
+INPUT_SHARDS = 8
+
+
+@pytest.fixture(scope='module')
+def checkpoint(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('input'))
+    make_llama_checkpoint(path, INPUT_SHARDS, n_layers=2, dim=512, n_heads=8 * INPUT_SHARDS, n_kv_heads=8,
+                          hidden_dim=1024, vocab_size=256)
+    return path
+
+
+@pytest.mark.parametrize('output_shards', [2, 4])
+def test_streaming_matches_consolidating(checkpoint, tmp_path, output_shards):
+    legacy_dir = tmp_path / 'legacy'
+    streaming_dir = tmp_path / 'streaming'
+    legacy_dir.mkdir()
+    streaming_dir.mkdir()
+
+    state_dict = convert.convert_to_llama_70b_1(checkpoint, num_shards=INPUT_SHARDS)
+    convert.convert_to_llama_70b_2(state_dict, checkpoint, str(legacy_dir), num_shards=output_shards)
+    convert.reshard_streaming(checkpoint, str(streaming_dir), INPUT_SHARDS, output_shards)
+
+    names = [f"consolidated.0{shard_i}.pth" for shard_i in range(output_shards)]
+    assert sorted(os.listdir(streaming_dir)) == names
+    for name in names:
+        assert filecmp.cmp(legacy_dir / name, streaming_dir / name, shallow=False), name
+
+
+def test_streaming_keeps_scratch_dir(checkpoint, tmp_path):
+    output_dir = tmp_path / 'output'
+    scratch_dir = tmp_path / 'scratch'
+    output_dir.mkdir()
+    scratch_dir.mkdir()
+    (scratch_dir / 'keep').write_text('not ours')
+
+    convert.reshard_streaming(checkpoint, str(output_dir), INPUT_SHARDS, 2, scratch_dir=str(scratch_dir))
+
+    # Only the temporary directory created inside scratch_dir is removed
+    assert os.listdir(scratch_dir) == ['keep']
+    assert sorted(os.listdir(output_dir)) == ['consolidated.00.pth', 'consolidated.01.pth']
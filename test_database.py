@@ -0,0 +1,130 @@
+import pytest
+
+pytest.importorskip('numpy')
+schema = pytest.importorskip('langchain.schema')
+
+
+def make_documents(source, count, prefix='chunk'):
+    return [schema.Document(page_content=f"{prefix} {i} of {source}", metadata={'source': source, 'page': i // 2})
+            for i in range(count)]
+
+
+def stored_ids(manager):
+    with manager.sqlite_db_manager.pool.connection() as conn:
+        return {row[1]: row[0] for row in conn.execute('SELECT ID, Content FROM documents')}
+
+
+def assert_stores_agree(manager):
+    assert {str(id_) for id_ in stored_ids(manager).values()} == set(manager.vector_store.get_ids())
+
+
+def test_add_embeds_only_new_chunks(manager, embeddings):
+    documents = make_documents('/corpus/a.pdf', 20)
+    assert len(manager.add_documents_to_chroma(documents, batch_size=8)) == 20
+    assert embeddings.embedded == 20
+    before = stored_ids(manager)
+
+    changed = [
+        schema.Document(page_content=document.page_content[::-1], metadata=document.metadata) if i % 4 == 0 else document
+        for i, document in enumerate(documents)
+    ]
+    embeddings.embedded = 0
+    assert len(manager.add_documents_to_chroma(changed, batch_size=8)) == 5
+    assert embeddings.embedded == 5
+
+    # Unchanged chunks keep their IDs
+    after = stored_ids(manager)
+    assert {content: after[content] for content in before} == before
+    assert len(after) == 25
+
+    embeddings.embedded = 0
+    assert manager.add_documents_to_chroma(changed, batch_size=8) == []
+    assert embeddings.embedded == 0
+    assert_stores_agree(manager)
+
+
+def test_add_rolls_back_vectors_of_failed_commit(manager, monkeypatch):
+    sqlite_db_manager = manager.sqlite_db_manager
+    manager.add_documents_to_chroma(make_documents('/corpus/a.pdf', 4))
+
+    def failing_insert(documents, sync_vectors=None):
+        with sqlite_db_manager.pool.transaction() as conn:
+            sync_vectors(sqlite_db_manager._insert_staged_documents(conn, documents))
+            raise RuntimeError('commit failed')
+
+    monkeypatch.setattr(sqlite_db_manager, 'insert_documents_bulk', failing_insert)
+    assert manager.add_documents_to_chroma(make_documents('/corpus/b.pdf', 4)) == []
+    assert manager.vector_store.count() == 4
+    assert_stores_agree(manager)
+
+
+def test_replace_source_returns_string_ids(manager):
+    manager.add_documents_to_chroma(make_documents('/corpus/a.pdf', 4))
+    old_ids = {str(id_) for id_ in stored_ids(manager).values()}
+
+    added, deleted = manager.replace_source('/corpus/a.pdf', make_documents('/corpus/a.pdf', 3, prefix='new'))
+    assert all(isinstance(id_, str) for id_ in added + deleted)
+    assert set(deleted) == old_ids
+    assert set(added) == set(manager.vector_store.get_ids())
+    assert_stores_agree(manager)
+
+
+def write_files(directory, count, lines=5):
+    paths = []
+    for i in range(count):
+        path = directory / f"file_{i:03d}.pdf"
+        path.write_text('\n'.join(f"line {j} of file {i}" for j in range(lines)))
+        paths.append(str(path))
+    return paths
+
+
+def test_ingest_files_resumes_after_interruption(manager, processor, embeddings, tmp_path, monkeypatch):
+    paths = write_files(tmp_path, 10)
+    entries = {path: (0, 0, path) for path in paths}
+    embed_documents = embeddings.embed_documents
+
+    def interrupted(texts):
+        if embeddings.embedded + len(texts) > 20:
+            raise RuntimeError('interrupted')
+        return embed_documents(texts)
+
+    monkeypatch.setattr(embeddings, 'embed_documents', interrupted)
+    first = manager.ingest_files(processor, paths, entries, batch_size=5, queue_size=1)
+    # Only chunks of committed batches are reported, and they are all stored
+    assert 0 < len(first['added']) <= 20
+    assert set(first['added']) == set(manager.vector_store.get_ids())
+    assert_stores_agree(manager)
+
+    monkeypatch.setattr(embeddings, 'embed_documents', embed_documents)
+    remaining = [path for path in paths if path not in manager.sqlite_db_manager.get_source_manifest()]
+    second = manager.ingest_files(processor, remaining, entries, batch_size=5, queue_size=1)
+    assert len(first['added']) + len(second['added']) == 50
+    assert len(stored_ids(manager)) == 50
+    assert_stores_agree(manager)
+
+
+def test_ingest_files_reports_nothing_for_failed_commit(manager, processor, tmp_path, monkeypatch):
+    paths = write_files(tmp_path, 2)
+
+    def failing_insert(documents, sync_vectors=None):
+        with manager.sqlite_db_manager.pool.transaction() as conn:
+            sync_vectors(manager.sqlite_db_manager._insert_staged_documents(conn, documents))
+            raise RuntimeError('commit failed')
+
+    monkeypatch.setattr(manager.sqlite_db_manager, 'insert_documents_bulk', failing_insert)
+    summary = manager.ingest_files(processor, paths)
+    assert summary['added'] == [] and summary['ingested'] == []
+    assert manager.vector_store.count() == 0
+
+
+def test_sync_files_replaces_sources_ingested_without_manifest(manager, processor, tmp_path):
+    path, = write_files(tmp_path, 1)
+    # Ingested before the manifest existed
+    manager.add_documents_to_chroma(next(processor.iter_files([path]))[1])
+    with open(path, 'w') as f:
+        f.write('line 0 of file 0\nrewritten line')
+
+    summary = manager.sync_files(processor, [path])
+    assert summary['modified'] == [path] and summary['added'] == []
+    assert set(stored_ids(manager)) == {'line 0 of file 0', 'rewritten line'}
+    assert_stores_agree(manager)
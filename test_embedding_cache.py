@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+
+
+class FakeEmbeddings:
+    """
+    A deterministic embedding function that records the texts it embeds.
+    """
+
+    model_name = 'fake'
+
+    def __init__(self, dim=4):
+        self.dim = dim
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text) + i) for i in range(self.dim)] for text in texts]
+
+    def embed_query(self, text):
+        return [0.0] * self.dim
+
+
+def test_entries_persist_across_reopen(tmp_path):
+    texts = ['alpha', 'beta', 'gamma']
+    embeddings = CachedEmbeddings(FakeEmbeddings(), str(tmp_path))
+    first = embeddings.embed_documents(texts)
+    embeddings.close()
+
+    model = FakeEmbeddings()
+    embeddings = CachedEmbeddings(model, str(tmp_path))
+    assert embeddings.embed_documents(texts) == first
+    assert model.embedded == []
+    assert embeddings.stats()['hits'] == 3
+    embeddings.close()
+
+
+def test_put_many_commits_without_pending_lookups(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put_many(['a', 'b'], [[1.0, 2.0], [3.0, 4.0]])
+
+    # Another connection sees the entries while the cache is still open
+    conn = sqlite3.connect(os.path.join(str(tmp_path), 'index.db'))
+    assert conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0] == 2
+    conn.close()
+    cache.close()
+
+
+def test_eviction_reuses_least_recently_used_slots(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_entries=3)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.put_many([key], [[float(i), 0.0]])
+        time.sleep(0.01)
+    # Reading a makes b the least recently used entry
+    cache.get_many(['a'])
+    time.sleep(0.01)
+    cache.put_many(['d'], [[9.0, 9.0]])
+
+    vectors = cache.get_many(['a', 'b', 'c', 'd'])
+    assert vectors[1] is None
+    assert [list(vector) for vector in (vectors[0], vectors[2], vectors[3])] == [[0.0, 0.0], [2.0, 0.0], [9.0, 9.0]]
+    assert cache.capacity[2] == 3
+    assert cache.evictions == 1
+    cache.close()
+
+
+def test_dimensions_are_stored_apart(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put_many(['a'], [[1.0, 2.0]])
+    cache.put_many(['a'], [[1.0, 2.0, 3.0]])
+
+    assert list(cache.get_many(['a'], dim=2)[0]) == [1.0, 2.0]
+    assert list(cache.get_many(['a'], dim=3)[0]) == [1.0, 2.0, 3.0]
+    assert cache.get_many(['a'], dim=4) == [None]
+    cache.close()
+
+
+def test_migrates_single_matrix_layout(tmp_path):
+    # The layout written before vectors were split by dimension
+    cache_dir = str(tmp_path)
+    conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'))
+    conn.execute('CREATE TABLE entries (Key TEXT PRIMARY KEY, Slot INTEGER UNIQUE, LastUsed REAL)')
+    conn.execute('CREATE INDEX idx_entries_last_used ON entries (LastUsed)')
+    conn.execute('CREATE TABLE meta (Name TEXT PRIMARY KEY, Value INTEGER)')
+    conn.executemany('INSERT INTO entries VALUES (?, ?, ?)', [('a', 0, 1.0), ('b', 1, 2.0)])
+    conn.executemany('INSERT INTO meta VALUES (?, ?)', [('dim', 3), ('capacity', 4), ('next_slot', 2)])
+    conn.commit()
+    conn.close()
+    matrix = np.zeros((4, 3), dtype=np.float32)
+    matrix[0] = [1.0, 2.0, 3.0]
+    matrix[1] = [4.0, 5.0, 6.0]
+    matrix.tofile(os.path.join(cache_dir, 'vectors.f32'))
+
+    cache = EmbeddingCache(cache_dir)
+    assert [list(vector) for vector in cache.get_many(['a', 'b'], dim=3)] == [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]
+    assert cache.next_slot == {3: 2}
+    assert os.path.exists(os.path.join(cache_dir, 'vectors-3.f32'))
+    assert not os.path.exists(os.path.join(cache_dir, 'vectors.f32'))
+
+    # New entries go after the migrated ones
+    cache.put_many(['c'], [[7.0, 8.0, 9.0]])
+    cache.close()
+    cache = EmbeddingCache(cache_dir)
+    assert [list(vector) for vector in cache.get_many(['a', 'c'], dim=3)] == [[1.0, 2.0, 3.0], [7.0, 8.0, 9.0]]
+    cache.close()
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+from watcher import DirectoryWatcher
+
+
+@pytest.fixture
+def directory(tmp_path):
+    path = tmp_path / 'pdfs'
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def watcher(manager, processor, directory):
+    watcher = DirectoryWatcher(manager, processor, str(directory), poll_interval=0, debounce=5, max_delay=60)
+    # The first poll records the empty directory
+    assert watcher.poll(now=0) is None
+    return watcher
+
+
+def settle(watcher, now):
+    # Changes are seen by one poll and applied once they have been stable for the debounce
+    assert watcher.poll(now=now) is None
+    return watcher.poll(now=now + watcher.debounce)
+
+
+def sources(manager):
+    with manager.sqlite_db_manager.pool.connection() as conn:
+        stored = {row[0] for row in conn.execute('SELECT DISTINCT Source FROM documents')}
+    vector_store = manager.vector_store
+    assert stored == {vector_store.metadatas[row]['source'] for row in vector_store.row_of.values()}
+    return stored
+
+
+def test_watcher_adds_renames_and_removes(manager, embeddings, watcher, directory):
+    paths = []
+    for i in range(3):
+        path = directory / f"file_{i}.pdf"
+        path.write_text(f"first line of {i}\nsecond line of {i}")
+        paths.append(str(path))
+
+    summary = settle(watcher, 1)
+    assert sorted(summary['added']) == paths
+    assert sources(manager) == set(paths)
+
+    embedded = embeddings.embedded
+    renamed = str(directory / 'renamed.pdf')
+    os.rename(paths[0], renamed)
+    summary = settle(watcher, 10)
+    assert summary['renamed'] == {paths[0]: renamed}
+    # Renamed files are not parsed or embedded again
+    assert embeddings.embedded == embedded
+    assert sources(manager) == {renamed, paths[1], paths[2]}
+
+    os.remove(paths[1])
+    summary = settle(watcher, 20)
+    assert summary['removed'] == [paths[1]]
+    assert sources(manager) == {renamed, paths[2]}
+
+
+def test_watcher_waits_for_files_to_settle(manager, watcher, directory):
+    path = directory / 'file.pdf'
+    path.write_text('partial')
+    assert watcher.poll(now=1) is None
+    path.write_text('partial\ncomplete')
+    assert watcher.poll(now=4) is None
+    # Five seconds after the first write, but only two after the last one
+    assert watcher.poll(now=6) is None
+
+    summary = watcher.poll(now=9)
+    assert summary['added'] == [str(path)]
+    assert manager.count_document() == 2
+
+
+def test_rename_invalidates_cached_answers(manager, watcher, directory, tmp_path):
+    answer_cache = pytest.importorskip('answer_cache')
+    cache = answer_cache.AnswerCache(answer_cache.answer_cache_path(str(tmp_path / 'db.db')))
+    manager.answer_cache = cache
+    path = directory / 'file.pdf'
+    path.write_text('only line')
+    settle(watcher, 1)
+
+    hits = [{'id': 1, 'content': 'only line', 'source': str(path), 'page': 0, 'score': 1.0}]
+    cache.put('question', [1.0, 0.0], {}, hits, 'answer')
+    assert cache.lookup([1.0, 0.0], {}, hits) is not None
+
+    os.rename(path, directory / 'moved.pdf')
+    assert settle(watcher, 10)['renamed']
+    # The cached answer cites the old path
+    assert cache.lookup([1.0, 0.0], {}, hits) is None
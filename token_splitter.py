@@ -0,0 +1,127 @@
+import re
+
+# Gaps between tokens that make good chunk boundaries, best first
+BOUNDARIES = (re.compile(r'\n\s*\n'), re.compile(r'\n'), re.compile(r'(?<=[.!?])\s'))
+
+
+class TokenTextSplitter:
+    """
+    Split text into chunks measured in tokens of the embedding model, in a single pass.
+
+    Every page is tokenized once with a fast tokenizer that reports character offsets. Chunk
+    boundaries are chosen by offset arithmetic, preferring a paragraph, line or sentence break
+    near the end of each window and at the start of the overlap, and chunks are sliced from
+    the page text directly instead of being rebuilt from pieces. The default size fills the
+    256-token window of all-MiniLM-L6-v2 together with its [CLS] and [SEP] tokens, so no
+    chunk is truncated when embedded.
+
+    It implements split_text and split_documents, so it can replace the langchain splitter of
+    PDFProcessor.
+    """
+
+    def __init__(self, chunk_tokens=254, overlap_tokens=32, lookback_tokens=48,
+                 model_name='sentence-transformers/all-MiniLM-L6-v2', tokenizer=None):
+        """
+        :param chunk_tokens: The maximum number of tokens in a chunk.
+        :param overlap_tokens: The number of tokens repeated at the start of the next chunk.
+        :param lookback_tokens: How far back from the end of a full window to look for a break.
+        :param model_name: The Hugging Face model whose tokenizer measures chunks.
+        :param tokenizer: A fast tokenizer to use instead of loading the one of model_name.
+        """
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError("overlap_tokens must be smaller than chunk_tokens.")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.lookback_tokens = min(lookback_tokens, chunk_tokens - overlap_tokens - 1)
+        self.model_name = model_name
+        self._tokenizer = tokenizer
+        self._owns_tokenizer = tokenizer is None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+        return self._tokenizer
+
+    def __getstate__(self):
+        # Worker processes load their own copy of a tokenizer loaded by name
+        state = dict(self.__dict__)
+        if self._owns_tokenizer:
+            state['_tokenizer'] = None
+        return state
+
+    def _offsets(self, texts):
+        encodings = self.tokenizer(
+            texts, add_special_tokens=False, return_offsets_mapping=True, return_attention_mask=False, verbose=False
+        )
+        return encodings['offset_mapping']
+
+    def _split(self, text, offsets):
+        chunks = []
+        start = 0
+        while start < len(offsets):
+            end = min(start + self.chunk_tokens, len(offsets))
+            if end < len(offsets):
+                end = self._boundary(text, offsets, start, end)
+            chunk = text[offsets[start][0]:offsets[end - 1][1]].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end == len(offsets):
+                break
+            start = self._aligned_start(text, offsets, max(end - self.overlap_tokens, start + 1), end)
+        return chunks
+
+    @staticmethod
+    def _aligned_start(text, offsets, start, end):
+        """
+        :return: The first token of the overlap that follows a break, or start if there is none.
+        """
+        for i in range(start, end):
+            # The gap includes the last character of the previous token, to see sentence ends
+            gap = text[offsets[i - 1][1] - 1:offsets[i][0]]
+            if any(pattern.search(gap) for pattern in BOUNDARIES):
+                return i
+        return start
+
+    def _boundary(self, text, offsets, start, end):
+        """
+        :return: The end of the chunk starting at token start, moved back from end to the best
+            break between two tokens within the lookback window, or end if there is none.
+        """
+        first = max(start + 1, end - self.lookback_tokens)
+        window = text[offsets[first - 1][1]:offsets[end][0]]
+        for pattern in BOUNDARIES:
+            matches = list(pattern.finditer(window))
+            if matches:
+                position = offsets[first - 1][1] + matches[-1].start()
+                # The chunk ends after the last token that ends before the break
+                for i in range(end - 1, first - 2, -1):
+                    if offsets[i][1] <= position:
+                        return i + 1
+        return end
+
+    def split_text(self, text):
+        """
+        :param text: The text to split.
+        :return: A list of chunk strings.
+        """
+        return self._split(text, self._offsets([text])[0])
+
+    def split_documents(self, documents):
+        """
+        :param documents: A list of Document objects, e.g. the pages of a PDF.
+        :return: A list of Document chunks carrying the metadata of the document they came from.
+        """
+        from langchain.schema import Document
+
+        documents = list(documents)
+        texts = [document.page_content for document in documents]
+        # All pages are tokenized in one batched call
+        all_offsets = self._offsets(texts) if texts else []
+        return [
+            Document(page_content=chunk, metadata=dict(document.metadata))
+            for document, text, offsets in zip(documents, texts, all_offsets)
+            for chunk in self._split(text, offsets)
+        ]
@@ -0,0 +1,566 @@
+import json
+import os
+import sqlite3
+import threading
+
+QUANTIZATIONS = (None, 'int8', 'binary')
+
+
+class VectorStore:
+    """
+    The vector index behind ChromaDBManager.
+
+    The methods mirror the subset of the Chroma collection API the manager uses, and query
+    returns results in the same shape as chromadb's Collection.query, so backends can be
+    swapped without touching the retrieval code. Distances are squared L2, lower is better.
+    """
+
+    # Whether query restrictions are applied through allowed_ids, which the manager then has to
+    # resolve to the full set of matching IDs, rather than through the where clause
+    filters_by_ids = False
+
+    def upsert(self, ids, embeddings, metadatas, documents=None):
+        """
+        Insert or overwrite vectors.
+
+        :param ids: A list of string IDs.
+        :param embeddings: A list of vectors aligned with ids.
+        :param metadatas: A list of metadata dictionaries aligned with ids.
+        :param documents: An optional list of texts aligned with ids. Backends may choose not to
+            store them, in which case the manager reads chunk text from SQLite.
+        """
+        raise NotImplementedError
+
+    def delete(self, ids):
+        """
+        :param ids: A list of string IDs to remove. Unknown IDs are ignored.
+        """
+        raise NotImplementedError
+
+    def update_metadatas(self, ids, metadatas):
+        """
+        Merge keys into the metadata of stored vectors, leaving the vectors untouched.
+
+        :param ids: A list of string IDs. Unknown IDs are ignored.
+        :param metadatas: A list of metadata dictionaries aligned with ids, holding the keys to set.
+        """
+        raise NotImplementedError
+
+    def query(self, query_embeddings, n_results, allowed_ids=None, where=None):
+        """
+        :param query_embeddings: A list of query vectors.
+        :param n_results: The number of nearest neighbours per query.
+        :param allowed_ids: An optional set of string IDs the search is restricted to.
+        :param where: The same restriction as a Chroma metadata filter on 'source' and 'page',
+            for backends that filter on metadata rather than on IDs.
+        :return: A dictionary with 'ids', 'distances', 'metadatas' and 'documents' keys, each a
+            list with one entry per query, ordered nearest first.
+        """
+        raise NotImplementedError
+
+    def count(self):
+        """
+        :return: The number of stored vectors.
+        """
+        raise NotImplementedError
+
+    def get_ids(self):
+        """
+        :return: The list of stored IDs.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ChromaVectorStore(VectorStore):
+    """
+    A VectorStore backed by a persistent Chroma collection (HNSW), opened through langchain.
+    """
+
+    def __init__(self, persist_directory, embedding_function):
+        from langchain.vectorstores import Chroma
+
+        self.chroma_instance = Chroma(persist_directory=persist_directory, embedding_function=embedding_function)
+        self.collection = self.chroma_instance._collection
+
+    def upsert(self, ids, embeddings, metadatas, documents=None):
+        self.collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def update_metadatas(self, ids, metadatas):
+        if not ids:
+            return
+        stored = self.collection.get(ids=ids, include=['metadatas'])
+        updates = dict(zip(ids, metadatas))
+        found = stored['ids']
+        if found:
+            self.collection.update(
+                ids=found,
+                metadatas=[dict(metadata or {}, **updates[id_]) for id_, metadata in zip(found, stored['metadatas'])],
+            )
+
+    def query(self, query_embeddings, n_results, allowed_ids=None, where=None):
+        # Chroma filters inside the HNSW search on metadata, so only the where clause is used
+        return self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=where,
+            include=['documents', 'metadatas', 'distances'],
+        )
+
+    def count(self):
+        return self.collection.count()
+
+    def get_ids(self):
+        return self.collection.get(include=[])['ids']
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    A flat, exact VectorStore: a memory-mapped float32 or float16 matrix plus a SQLite ID map.
+
+    Queries compute exact squared L2 distances with batched matrix multiplies over blocks of
+    rows and select the top k with argpartition, so recall is deterministic. Opening the store
+    only maps the matrix file, which makes cold starts nearly instant. Deletes mark rows as
+    tombstones; once tombstones exceed compact_fraction of the rows, the matrix is compacted.
+    Chunk text is not stored; the manager reads it from SQLite. Queries restricted to a set of
+    IDs mask the other rows out of the scan, or score only the allowed rows when they are few.
+
+    With quantization, an int8 or binary copy of the matrix is kept in memory and scanned
+    instead. The best rescore_factor * k candidates of that first pass are then rescored
+    with exact distances, reading only their rows from the memory-mapped matrix.
+    """
+
+    filters_by_ids = True
+
+    def __init__(self, directory, dtype='float32', block_rows=65536, compact_fraction=0.25, quantization=None, rescore_factor=4):
+        """
+        :param directory: The directory holding the matrix file and the ID map.
+        :param dtype: 'float32' or 'float16', the precision of the stored vectors.
+        :param block_rows: The number of rows scored per matrix multiply, bounding query memory.
+        :param compact_fraction: The fraction of tombstoned rows that triggers compaction.
+        :param quantization: None for exact search over the full matrix, 'int8' for one byte per
+            dimension plus a scale per row, or 'binary' for one bit per dimension.
+        :param rescore_factor: The number of first-pass candidates per requested result that
+            are rescored at full precision when quantization is on.
+        """
+        import numpy as np
+
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}, expected None, 'int8' or 'binary'.")
+        self.np = np
+        self.directory = directory
+        self.block_rows = block_rows
+        self.compact_fraction = compact_fraction
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self._lock = threading.RLock()
+
+        if os.path.exists(os.path.join(directory, 'chroma.sqlite3')):
+            raise ValueError(f"{directory} holds a Chroma database, give the NumPy store a directory of its own.")
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, 'vectors.bin')
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS rows (
+            Row INTEGER PRIMARY KEY,
+            ID TEXT UNIQUE,
+            Metadata TEXT,
+            Deleted INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (Name TEXT PRIMARY KEY, Value TEXT)')
+        self.conn.commit()
+
+        meta = dict(self.conn.execute('SELECT Name, Value FROM meta'))
+        pending = meta.pop('pending_vectors', None)
+        if pending is not None:
+            # A compaction committed the new ID map but stopped before swapping in its matrix
+            pending_path = os.path.join(directory, pending)
+            if os.path.exists(pending_path):
+                os.replace(pending_path, self.vectors_path)
+            self.conn.execute("DELETE FROM meta WHERE Name = 'pending_vectors'")
+            self.conn.commit()
+        self.dtype = np.dtype(meta.get('dtype', dtype))
+        self.dim = int(meta['dim']) if 'dim' in meta else None
+        self.capacity = int(meta.get('capacity', 0))
+
+        rows = self.conn.execute('SELECT Row, ID, Metadata, Deleted FROM rows ORDER BY Row').fetchall()
+        self.num_rows = rows[-1][0] + 1 if rows else 0
+        self.ids = [None] * self.num_rows
+        self.metadatas = [None] * self.num_rows
+        self.alive = np.zeros(self.num_rows, dtype=bool)
+        self.row_of = {}
+        for row, id_, metadata, deleted in rows:
+            self.ids[row] = id_
+            self.metadatas[row] = json.loads(metadata)
+            if not deleted:
+                self.alive[row] = True
+                self.row_of[id_] = row
+
+        self.vectors = None
+        if self.dim is not None and self.capacity:
+            self.vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode='r+', shape=(self.capacity, self.dim))
+        self._norms = None
+        self._codes = None
+        self._scales = None
+
+    def _set_meta(self, name, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (Name, Value) VALUES (?, ?)', (name, str(value)))
+
+    def _grow(self, rows):
+        if rows <= self.capacity:
+            return
+        capacity = max(rows, self.capacity * 2, 1024)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(capacity * self.dim * self.dtype.itemsize)
+        self.vectors = self.np.memmap(self.vectors_path, dtype=self.dtype, mode='r+', shape=(capacity, self.dim))
+        self.capacity = capacity
+        self._set_meta('capacity', capacity)
+
+    def upsert(self, ids, embeddings, metadatas, documents=None):
+        np = self.np
+        if not ids:
+            return
+        matrix = np.asarray(embeddings, dtype=np.float32)
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._set_meta('dim', self.dim)
+                self._set_meta('dtype', self.dtype.name)
+
+            rows = []
+            for id_ in ids:
+                row = self.row_of.get(id_)
+                if row is None:
+                    row = self.num_rows
+                    self.num_rows += 1
+                    self.ids.append(id_)
+                    self.metadatas.append(None)
+                    self.row_of[id_] = row
+                rows.append(row)
+
+            self._grow(self.num_rows)
+            if len(self.alive) < self.num_rows:
+                self.alive = np.concatenate([self.alive, np.zeros(self.num_rows - len(self.alive), dtype=bool)])
+
+            rows_array = np.asarray(rows)
+            self.vectors[rows_array] = matrix.astype(self.dtype)
+            self.vectors.flush()
+            self.alive[rows_array] = True
+            for row, metadata in zip(rows, metadatas):
+                self.metadatas[row] = metadata
+            self._norms = None
+            if self._codes is not None:
+                self._update_codes(rows_array, matrix)
+
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO rows (Row, ID, Metadata, Deleted) VALUES (?, ?, ?, 0)',
+                [(row, id_, json.dumps(metadata)) for row, id_, metadata in zip(rows, ids, metadatas)],
+            )
+            self.conn.commit()
+
+    def update_metadatas(self, ids, metadatas):
+        with self._lock:
+            changed = []
+            for id_, update in zip(ids, metadatas):
+                row = self.row_of.get(id_)
+                if row is None:
+                    continue
+                self.metadatas[row] = dict(self.metadatas[row] or {}, **update)
+                changed.append((json.dumps(self.metadatas[row]), row))
+            self.conn.executemany('UPDATE rows SET Metadata = ? WHERE Row = ?', changed)
+            self.conn.commit()
+
+    def delete(self, ids):
+        with self._lock:
+            rows = [self.row_of.pop(id_) for id_ in ids if id_ in self.row_of]
+            if not rows:
+                return
+            self.alive[self.np.asarray(rows)] = False
+            self.conn.executemany('UPDATE rows SET Deleted = 1 WHERE Row = ?', [(row,) for row in rows])
+            self.conn.commit()
+
+            if self.num_rows - len(self.row_of) > self.compact_fraction * self.num_rows:
+                self.compact()
+
+    def compact(self):
+        """
+        Rewrite the matrix without tombstoned rows and renumber the ID map.
+        """
+        np = self.np
+        with self._lock:
+            live = np.flatnonzero(self.alive[:self.num_rows])
+            tmp_path = self.vectors_path + '.tmp'
+            capacity = max(len(live), 1024)
+            compacted = np.memmap(tmp_path, dtype=self.dtype, mode='w+', shape=(capacity, self.dim or 1))
+            for start in range(0, len(live), self.block_rows):
+                block = live[start:start + self.block_rows]
+                compacted[start:start + len(block)] = self.vectors[block]
+            compacted.flush()
+            del compacted
+
+            ids = [self.ids[row] for row in live]
+            metadatas = [self.metadatas[row] for row in live]
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM rows')
+            self.conn.executemany(
+                'INSERT INTO rows (Row, ID, Metadata, Deleted) VALUES (?, ?, ?, 0)',
+                [(row, id_, json.dumps(metadata)) for row, (id_, metadata) in enumerate(zip(ids, metadatas))],
+            )
+            self._set_meta('capacity', capacity)
+            # The matrix is swapped in once the new ID map is committed; if that is interrupted,
+            # opening the store finishes the swap
+            self._set_meta('pending_vectors', os.path.basename(tmp_path))
+            self.conn.commit()
+            self.vectors = None
+            os.replace(tmp_path, self.vectors_path)
+            self.conn.execute("DELETE FROM meta WHERE Name = 'pending_vectors'")
+            self.conn.commit()
+
+            self.vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode='r+', shape=(capacity, self.dim or 1))
+            self.capacity = capacity
+            self.num_rows = len(live)
+            self.ids = ids
+            self.metadatas = metadatas
+            self.alive = np.ones(self.num_rows, dtype=bool)
+            self.row_of = {id_: row for row, id_ in enumerate(ids)}
+            self._norms = None
+            self._codes = None
+            self._scales = None
+
+    def _row_norms(self):
+        # Squared norms of the stored rows, computed once and reused until the matrix changes
+        if self._norms is None:
+            norms = self.np.empty(self.num_rows, dtype=self.np.float32)
+            for start in range(0, self.num_rows, self.block_rows):
+                end = min(start + self.block_rows, self.num_rows)
+                block = self.np.asarray(self.vectors[start:end], dtype=self.np.float32)
+                norms[start:end] = self.np.einsum('ij,ij->i', block, block)
+            self._norms = norms
+        return self._norms
+
+    def _quantize(self, matrix):
+        """
+        :param matrix: A float32 matrix, one vector per row.
+        :return: A (codes, scales) tuple. int8 codes are rows scaled so that their largest
+            component maps to 127; binary codes are the packed sign bits and scales is None.
+        """
+        np = self.np
+        if self.quantization == 'binary':
+            return np.packbits(matrix > 0, axis=1), None
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(matrix / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def _quantized(self):
+        # The quantized matrix is built from the memory-mapped one on first use and then kept
+        # up to date by upsert, so only the first quantized query pays for a full read
+        if self._codes is None:
+            codes, scales = [], []
+            for start in range(0, self.num_rows, self.block_rows):
+                end = min(start + self.block_rows, self.num_rows)
+                block_codes, block_scales = self._quantize(self.np.asarray(self.vectors[start:end], dtype=self.np.float32))
+                codes.append(block_codes)
+                scales.append(block_scales)
+            self._codes = self.np.concatenate(codes)
+            self._scales = self.np.concatenate(scales) if self.quantization == 'int8' else None
+        return self._codes, self._scales
+
+    def _update_codes(self, rows, matrix):
+        np = self.np
+        codes, scales = self._quantize(matrix)
+        missing = self.num_rows - len(self._codes)
+        if missing > 0:
+            self._codes = np.concatenate([self._codes, np.zeros((missing, self._codes.shape[1]), dtype=self._codes.dtype)])
+            if self._scales is not None:
+                self._scales = np.concatenate([self._scales, np.ones(missing, dtype=np.float32)])
+        self._codes[rows] = codes
+        if self._scales is not None:
+            self._scales[rows] = scales
+
+    def memory_bytes(self):
+        """
+        :return: The number of bytes of vector data held in memory to answer queries: the
+            quantized matrix and row norms when quantization is on, otherwise the full matrix,
+            which is memory-mapped and has to stay in the page cache to be searched quickly.
+        """
+        with self._lock:
+            if not self.quantization:
+                return self.num_rows * (self.dim or 0) * self.dtype.itemsize
+            codes, scales = self._quantized()
+            total = codes.nbytes + (scales.nbytes if scales is not None else 0)
+            if self.quantization == 'int8':
+                total += self._row_norms().nbytes
+            return total
+
+    def _scan(self, num_queries, n_results, block_distances, live):
+        """
+        Select the n_results rows with the smallest distances, scoring the matrix block by block.
+
+        :param num_queries: The number of queries.
+        :param n_results: The number of rows to keep per query.
+        :param block_distances: A callable taking the (start, end) of a block of rows and
+            returning the float32 distances of every query to those rows.
+        :param live: A boolean mask of the rows that may be returned.
+        :return: A (rows, distances) tuple of arrays shaped (num_queries, k), unordered.
+        """
+        np = self.np
+        best_rows = np.empty((num_queries, 0), dtype=np.int64)
+        best_distances = np.empty((num_queries, 0), dtype=np.float32)
+
+        for start in range(0, self.num_rows, self.block_rows):
+            end = min(start + self.block_rows, self.num_rows)
+            distances = block_distances(start, end)
+            distances[:, ~live[start:end]] = np.inf
+
+            # Keep the running top k across blocks
+            rows = np.broadcast_to(np.arange(start, end), distances.shape)
+            distances = np.concatenate([best_distances, distances], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+            k = min(n_results, distances.shape[1])
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            best_distances = np.take_along_axis(distances, top, axis=1)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+        return best_rows, best_distances
+
+    def _exact_distances(self, queries, query_norms):
+        np = self.np
+        norms = self._row_norms()
+
+        def block_distances(start, end):
+            block = np.asarray(self.vectors[start:end], dtype=np.float32)
+            return norms[start:end] - 2.0 * (queries @ block.T) + query_norms[:, None]
+        return block_distances
+
+    def _quantized_distances(self, queries, query_norms):
+        np = self.np
+        codes, scales = self._quantized()
+
+        if self.quantization == 'int8':
+            norms = self._row_norms()
+
+            def block_distances(start, end):
+                dots = np.empty((len(queries), end - start), dtype=np.float32)
+                # Widen the codes in slices small enough to stay in cache
+                for offset in range(start, end, 1024):
+                    stop = min(offset + 1024, end)
+                    dots[:, offset - start:stop - start] = queries @ codes[offset:stop].astype(np.float32).T
+                dots *= scales[start:end]
+                return norms[start:end] - 2.0 * dots + query_norms[:, None]
+            return block_distances
+
+        # Hamming distance between sign bits
+        query_codes, _ = self._quantize(queries)
+        if hasattr(np, 'bitwise_count'):
+            popcount = np.bitwise_count
+        else:
+            table = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+            popcount = table.__getitem__
+
+        def block_distances(start, end):
+            block = codes[start:end]
+            distances = np.empty((len(queries), end - start), dtype=np.float32)
+            for i, query_code in enumerate(query_codes):
+                distances[i] = popcount(np.bitwise_xor(block, query_code)).sum(axis=1, dtype=np.uint32)
+            return distances
+        return block_distances
+
+    def _rescore(self, queries, candidates, n_results, live):
+        """
+        Replace first-pass candidates by the n_results nearest of them under exact distances.
+        """
+        np = self.np
+        best_rows = np.full((len(queries), n_results), -1, dtype=np.int64)
+        best_distances = np.full((len(queries), n_results), np.inf, dtype=np.float32)
+        for i, (query, rows) in enumerate(zip(queries, candidates)):
+            # Reading the candidate rows in file order keeps the page cache access sequential
+            rows = np.sort(rows[live[rows]])
+            if not len(rows):
+                continue
+            vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+            distances = np.einsum('ij,ij->i', vectors - query, vectors - query)
+            k = min(n_results, len(rows))
+            top = np.argpartition(distances, k - 1)[:k]
+            best_rows[i, :k] = rows[top]
+            best_distances[i, :k] = distances[top]
+        return best_rows, best_distances
+
+    def _gather(self, queries, query_norms, rows, n_results):
+        """
+        Score only the given rows with exact distances, which is faster than a full scan when a
+        filter leaves few candidates.
+        """
+        np = self.np
+        k = min(n_results, len(rows))
+        if not k:
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        distances = np.einsum('ij,ij->i', vectors, vectors) - 2.0 * (queries @ vectors.T) + query_norms[:, None]
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        return rows[top], np.take_along_axis(distances, top, axis=1)
+
+    def query(self, query_embeddings, n_results, allowed_ids=None, where=None):
+        np = self.np
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        with self._lock:
+            results = {'ids': [], 'distances': [], 'metadatas': [], 'documents': []}
+            if self.vectors is None or not self.row_of:
+                for _ in queries:
+                    for key in results:
+                        results[key].append([])
+                return results
+
+            query_norms = np.einsum('ij,ij->i', queries, queries)
+            live = self.alive
+            if allowed_ids is not None:
+                row_of = self.row_of
+                rows = np.fromiter((row_of[id_] for id_ in allowed_ids if id_ in row_of), dtype=np.int64)
+                live = np.zeros(self.num_rows, dtype=bool)
+                live[rows] = True
+
+            if allowed_ids is not None and len(rows) <= self.block_rows:
+                best_rows, best_distances = self._gather(queries, query_norms, np.sort(rows), n_results)
+            elif self.quantization:
+                candidates, _ = self._scan(
+                    len(queries), n_results * self.rescore_factor, self._quantized_distances(queries, query_norms), live
+                )
+                best_rows, best_distances = self._rescore(queries, candidates, n_results, live)
+            else:
+                best_rows, best_distances = self._scan(len(queries), n_results, self._exact_distances(queries, query_norms), live)
+
+            order = np.argsort(best_distances, axis=1)
+            best_distances = np.take_along_axis(best_distances, order, axis=1)
+            best_rows = np.take_along_axis(best_rows, order, axis=1)
+
+            for rows, distances in zip(best_rows, best_distances):
+                keep = np.isfinite(distances)
+                rows, distances = rows[keep], distances[keep]
+                results['ids'].append([self.ids[row] for row in rows])
+                results['distances'].append([float(distance) for distance in distances])
+                results['metadatas'].append([self.metadatas[row] for row in rows])
+                results['documents'].append([None] * len(rows))
+            return results
+
+    def count(self):
+        return len(self.row_of)
+
+    def get_ids(self):
+        return list(self.row_of)
+
+    def close(self):
+        with self._lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+                self.vectors = None
+            self.conn.close()
@@ -0,0 +1,228 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+
+class DirectoryWatcher:
+    """
+    Keep SQLite and Chroma in line with a directory of PDFs by polling it.
+
+    Every poll lists the directory and stats its PDFs, which is cheap next to parsing, and
+    diffs the result with the previous poll. Changed paths are held back until their stat
+    data has been stable for debounce seconds, so files still being copied are not parsed
+    half written and a burst of new files is ingested as one batch. A path that disappears
+    while a path with the same inode, size and modification time appears is a rename: its
+    chunks are moved to the new source without being parsed or embedded again. Everything
+    else goes through ChromaDBManager.sync_files, which skips files whose content did not
+    change and purges deleted ones.
+    """
+
+    def __init__(self, chroma_manager, pdf_processor, directory='', poll_interval=2.0, debounce=5.0,
+                 max_delay=60.0, batch_size=256):
+        """
+        :param chroma_manager: The ChromaDBManager to keep up to date.
+        :param pdf_processor: The PDFProcessor used to parse changed files.
+        :param directory: The directory to watch. Defaults to the directory of the processor.
+        :param poll_interval: The number of seconds between polls.
+        :param debounce: The number of seconds a path must go unchanged before it is applied.
+        :param max_delay: The number of seconds after which pending paths that are stable are
+            applied even if other files keep changing.
+        :param batch_size: The number of chunks embedded and written at a time.
+        """
+        if directory == '':
+            directory = pdf_processor.pdf_directory
+        # The same path format as PDFProcessor.list_pdf_files, so sources match the manifest
+        self.directory = str(Path(directory))
+        self.chroma_manager = chroma_manager
+        self.pdf_processor = pdf_processor
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self._snapshot = None
+        # Paths changed since they were last applied, with the times of their first and latest change
+        self._pending = {}
+        # The last stat data seen for pending paths that have disappeared, to pair renames
+        self._vanished = {}
+        self._stop = threading.Event()
+
+    def scan(self):
+        """
+        List the PDFs of the directory with their stat data.
+
+        :return: A dictionary with paths as keys and (size, mtime_ns, device, inode) tuples as values.
+        """
+        snapshot = {}
+        stack = [self.directory]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                # The directory was removed between listing and scanning it
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            stack.append(entry.path)
+                        elif entry.name.endswith('.pdf') and entry.is_file():
+                            stat = entry.stat()
+                            snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino)
+                    except OSError:
+                        continue
+        return snapshot
+
+    def poll(self, now=None):
+        """
+        Scan the directory once and apply the pending changes that have settled.
+
+        :param now: The current time.monotonic(), for testing.
+        :return: The summary of the applied batch, see apply, or None if nothing was applied.
+        """
+        if now is None:
+            now = time.monotonic()
+        snapshot = self.scan()
+        previous = self._snapshot if self._snapshot is not None else snapshot
+        for path in snapshot.keys() | previous.keys():
+            stat = snapshot.get(path)
+            if stat != previous.get(path):
+                self._pending[path] = (self._pending.get(path, (now,))[0], now)
+                if stat is None:
+                    self._vanished[path] = previous[path]
+        self._snapshot = snapshot
+
+        if not self._pending:
+            return None
+        quiet = now - max(last for _, last in self._pending.values()) >= self.debounce
+        overdue = now - min(first for first, _ in self._pending.values()) >= self.max_delay
+        if not (quiet or overdue):
+            return None
+        ready = [path for path, (_, last) in self._pending.items() if now - last >= self.debounce]
+        if not ready:
+            return None
+        waited = now - min(self._pending.pop(path)[0] for path in ready)
+        return self.apply(ready, waited)
+
+    def apply(self, paths, waited=0.0):
+        """
+        Bring SQLite and Chroma in line with a set of changed paths.
+
+        :param paths: A list of paths that were added, modified or removed since the last poll.
+        :param waited: The number of seconds the oldest of them was pending, for reporting.
+        :return: A dictionary with lists of 'added', 'modified', 'removed', 'unchanged' and
+            'failed' sources, and a 'renamed' dictionary of old sources to new sources.
+        """
+        start = time.perf_counter()
+        manifest = self.chroma_manager.sqlite_db_manager.get_source_manifest()
+        present = [path for path in paths if path in self._snapshot]
+        vanished = {path: self._vanished.pop(path, None) for path in paths}
+        vanished = {path: stat for path, stat in vanished.items() if path not in self._snapshot}
+        removed = [path for path in vanished if path in manifest]
+
+        # A rename keeps the inode, size and modification time of the file it moves
+        by_inode = {}
+        for path in present:
+            size, mtime, device, inode = self._snapshot[path]
+            if path not in manifest:
+                by_inode[(device, inode)] = (path, size, mtime)
+        renames = {}
+        for source in removed:
+            _, _, device, inode = vanished[source]
+            candidate = by_inode.pop((device, inode), None)
+            if candidate is not None and candidate[1:] == manifest[source][:2]:
+                renames[source] = candidate[0]
+
+        renamed = self.chroma_manager.rename_sources(renames) if renames else {}
+        applied = {old: new for old, new in renames.items() if new in renamed}
+        summary = self.chroma_manager.sync_files(
+            self.pdf_processor,
+            [path for path in present if path not in renamed],
+            [source for source in removed if source not in applied],
+            self.batch_size,
+        )
+        summary['renamed'] = applied
+
+        print(f"Applied {len(paths)} changes in {time.perf_counter() - start:.2f} s after waiting {waited:.2f} s: "
+              f"{len(summary['added'])} added, {len(summary['modified'])} modified, {len(applied)} renamed, "
+              f"{len(summary['removed'])} removed, {len(summary['failed'])} failed.")
+        return summary
+
+    def run(self, max_polls=None):
+        """
+        Catch up with the directory, then poll it until stop is called.
+
+        :param max_polls: An optional number of polls after which to return.
+        """
+        self._stop.clear()
+        # Changes made after this scan are seen by the first poll
+        self._snapshot = self.scan()
+        self.chroma_manager.sqlite_db_manager.seed_source_manifest()
+        manifest = self.chroma_manager.sqlite_db_manager.get_source_manifest()
+        prefix = os.path.join(self.directory, '')
+        removed = [source for source in manifest if source.startswith(prefix) and source not in self._snapshot]
+        summary = self.chroma_manager.sync_files(
+            self.pdf_processor, sorted(self._snapshot), removed, self.batch_size, manifest
+        )
+        print(f"Caught up with {self.directory}: {len(summary['added'])} added, {len(summary['modified'])} modified, "
+              f"{len(summary['removed'])} removed, {len(summary['unchanged'])} unchanged, "
+              f"{len(summary['failed'])} failed.")
+
+        polls = 0
+        while not self._stop.wait(self.poll_interval):
+            self.poll()
+            polls += 1
+            if max_polls is not None and polls >= max_polls:
+                break
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(
+    pdf_directory: str,
+    database: str = 'my_database.db',
+    vector_database: str = './chroma_db',
+    poll_interval: float = 2.0,
+    debounce: float = 5.0,
+    max_delay: float = 60.0,
+    batch_size: int = 256,
+    embedding_cache_dir: str = None,
+    num_workers: int = 1,
+    page_cache_dir: str = None,
+    chunk_tokens: int = None,
+    chunk_overlap_tokens: int = 32,
+    answer_cache: bool = True,
+):
+    from database import ChromaDBManager
+    from pdfloader import PDFProcessor
+
+    text_splitter = None
+    if chunk_tokens:
+        from token_splitter import TokenTextSplitter
+
+        text_splitter = TokenTextSplitter(chunk_tokens, chunk_overlap_tokens)
+    pdf_processor = PDFProcessor(pdf_directory, text_splitter, num_workers=num_workers, page_cache_dir=page_cache_dir)
+    cache = None
+    if answer_cache:
+        from answer_cache import AnswerCache, answer_cache_path
+
+        # The answers cached by main.py next to the database cite sources the watcher changes,
+        # so they are dropped whenever a source is re-ingested, renamed or deleted
+        cache = AnswerCache(answer_cache_path(database))
+    chroma_manager = ChromaDBManager(database, vector_database, embedding_cache_dir=embedding_cache_dir,
+                                     answer_cache=cache)
+    watcher = DirectoryWatcher(chroma_manager, pdf_processor, pdf_directory, poll_interval, debounce, max_delay, batch_size)
+    print(f"Watching {watcher.directory} every {poll_interval} s, press Ctrl+C to stop.")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)